@@ -0,0 +1,399 @@
+from typing import Dict, List
+
+import frappe
+from frappe.desk.query_report import run
+from frappe.desk.reportview import build_match_conditions
+from frappe.utils import cint, cstr, now
+from waba_integration import graph_api
+from waba_integration.realtime import publish_message_updates
+from waba_integration.whatsapp_business_api_integration.doctype.waba_bulk_send.waba_bulk_send import (  # noqa
+    create_bulk_send,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    get_waba_settings,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_contact.waba_whatsapp_contact import (  # noqa
+    decrement_unread_count,
+    refresh_last_message_statuses,
+)
+
+# Fields returned for every message of a conversation, see `get_conversation`
+CONVERSATION_FIELDS = (
+    "name",
+    "creation",
+    "type",
+    "status",
+    "message_type",
+    "message_body",
+    "media_file",
+    "media_mime_type",
+    "media_filename",
+    "media_caption",
+    "error",
+)
+
+# Maximum number of messages returned per page of a conversation
+MAX_CONVERSATION_PAGE_SIZE = 200
+
+# Fields returned for every contact of the inbox, see `get_inbox`
+INBOX_FIELDS = (
+    "name",
+    "display_name",
+    "last_message",
+    "last_message_type",
+    "last_message_status",
+    "last_message_preview",
+    "last_message_at",
+    "unread_count",
+)
+
+
+@frappe.whitelist()
+def send_bulk(
+    recipients: List[str] = None,
+    message_type: str = "Text",
+    message_body: str = None,
+    message_template: str = None,
+    document_type: str = None,
+    document_name: str = None,
+    recipients_doctype: str = None,
+    recipients_report: str = None,
+    filters: Dict = None,
+    recipient_field: str = "mobile_no",
+) -> Dict:
+    """
+    Sends a text or template message to many recipients in the background.
+
+    The recipients are either passed as a list of WhatsApp IDs, or read from
+    the `recipient_field` of the records of `recipients_doctype` or of the
+    rows of the `recipients_report` matching `filters`.
+
+    Returns the WABA Bulk Send, which tracks the progress. The result of
+    every recipient is saved on its WABA WhatsApp Message.
+
+    :param recipients: The WhatsApp IDs to send the message to.
+    :param message_type: `Text` or `Template`.
+    :param message_body: The body of a text message.
+    :param message_template: The WABA WhatsApp Message Template to send.
+    :param document_type: The doctype of the document used to render the template.
+    :param document_name: The name of the document used to render the template.
+    :param recipients_doctype: The doctype to read the recipients from.
+    :param recipients_report: The report to read the recipients from.
+    :param filters: The filters applied to the doctype or report.
+    :param recipient_field: The field holding the WhatsApp ID of a recipient.
+    :return: The WABA Bulk Send, as a dict.
+    :rtype: Dict
+    """  # noqa
+    frappe.has_permission("WABA WhatsApp Message", "create", throw=True)
+
+    if not get_waba_settings().enabled:
+        frappe.throw("WhatsApp Business API integration is not enabled.")
+
+    if message_type not in ("Text", "Template"):
+        frappe.throw("Only text and template messages can be sent in bulk.")
+
+    if message_type == "Text" and not message_body:
+        frappe.throw("`message_body` is required to send a text message.")
+
+    if message_type == "Template" and not message_template:
+        frappe.throw("`message_template` is required to send a template.")
+
+    filters = frappe.parse_json(filters) or {}
+    if recipients_doctype:
+        recipients = frappe.get_list(
+            recipients_doctype, filters=filters, pluck=recipient_field
+        )
+    elif recipients_report:
+        recipients = get_report_recipients(
+            recipients_report, filters, recipient_field
+        )
+    else:
+        recipients = frappe.parse_json(recipients) or []
+
+    # Skip blanks and duplicates, keeping the order
+    recipients = list(dict.fromkeys(filter(None, map(clean_whatsapp_id, recipients))))  # noqa
+    if not recipients:
+        frappe.throw("There are no recipients to send the message to.")
+
+    bulk_send = create_bulk_send(
+        recipients,
+        message_type=message_type,
+        message_body=message_body,
+        message_template=message_template,
+        document_type=document_type,
+        document_name=document_name,
+    )
+
+    return bulk_send.as_dict()
+
+
+def get_report_recipients(
+    report_name: str, filters: Dict, recipient_field: str
+) -> List[str]:
+    """
+    Returns the values of a column of a report, for the given filters.
+
+    :param report_name: The name of the report.
+    :type report_name: str
+    :param filters: The filters of the report.
+    :type filters: Dict
+    :param recipient_field: The fieldname of the column.
+    :type recipient_field: str
+    :return: The values of the column.
+    :rtype: List[str]
+    """
+    report = run(report_name, filters=filters)
+    columns = [
+        column.get("fieldname") if isinstance(column, dict) else column
+        for column in report.get("columns", [])
+    ]
+
+    recipients = []
+    for row in report.get("result", []):
+        if isinstance(row, dict):
+            recipients.append(row.get(recipient_field))
+        elif recipient_field in columns:
+            recipients.append(row[columns.index(recipient_field)])
+
+    return recipients
+
+
+def clean_whatsapp_id(value: str) -> str:
+    """
+    Returns a phone number as a WhatsApp ID, with digits only.
+
+    :param value: The phone number, e.g. `+91 98765 43210`.
+    :type value: str
+    :return: The WhatsApp ID, e.g. `919876543210`.
+    :rtype: str
+    """
+    return "".join(char for char in cstr(value) if char.isdigit())
+
+
+@frappe.whitelist()
+def get_conversation(
+    contact: str, before: str = None, limit: int = 50
+) -> Dict:
+    """
+    Returns a page of the messages exchanged with a contact, newest first.
+
+    Pages are read with keyset pagination: pass the `next_cursor` of a page
+    as `before` to get the next, older, page. Every page costs the same,
+    however deep in the conversation it is, since both directions are read
+    through their `(from, creation)` and `(to, creation)` indexes. Only the
+    messages the user can read are returned, see `get_match_condition`.
+
+    :param contact: The WABA WhatsApp Contact.
+    :param before: The `next_cursor` of the previous page, if any.
+    :param limit: The number of messages per page, at most `MAX_CONVERSATION_PAGE_SIZE`.
+    :return: The `messages` and the `next_cursor`, None on the last page.
+    :rtype: Dict
+    """  # noqa
+    frappe.has_permission("WABA WhatsApp Message", "read", throw=True)
+
+    limit = min(max(cint(limit), 1), MAX_CONVERSATION_PAGE_SIZE)
+    values = {"contact": contact, "limit": limit + 1}
+    conditions = ""
+    if before:
+        values["before_creation"], _, values["before_name"] = before.rpartition("|")  # noqa
+        conditions = """
+            and creation <= %(before_creation)s
+            and (creation < %(before_creation)s or name < %(before_name)s)
+        """
+    conditions += get_match_condition("WABA WhatsApp Message")
+
+    fields = ", ".join(f"`{field}`" for field in CONVERSATION_FIELDS)
+    messages = frappe.db.sql(
+        f"""
+        select * from (
+            (
+                select {fields} from `tabWABA WhatsApp Message`
+                where `from` = %(contact)s {conditions}
+                order by creation desc, name desc
+                limit %(limit)s
+            )
+            union all
+            (
+                select {fields} from `tabWABA WhatsApp Message`
+                where `to` = %(contact)s {conditions}
+                order by creation desc, name desc
+                limit %(limit)s
+            )
+        ) conversation
+        order by creation desc, name desc
+        limit %(limit)s
+        """,
+        values,
+        as_dict=True,
+    )
+
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = f"{messages[-1].creation}|{messages[-1].name}"
+
+    return {"messages": messages, "next_cursor": next_cursor}
+
+
+@frappe.whitelist()
+def get_inbox(before: str = None, limit: int = 50) -> Dict:
+    """
+    Returns a page of the contacts, most recently active first.
+
+    The last message and unread count of every contact are kept up to date
+    as messages come and go, so a page is a single read of the index on
+    `last_message_at`. Pass the `next_cursor` of a page as `before` to get
+    the next one. Only the contacts the user can read are returned, see
+    `get_match_condition`.
+
+    :param before: The `next_cursor` of the previous page, if any.
+    :param limit: The number of contacts per page, at most `MAX_CONVERSATION_PAGE_SIZE`.
+    :return: The `contacts` and the `next_cursor`, None on the last page.
+    :rtype: Dict
+    """  # noqa
+    frappe.has_permission("WABA WhatsApp Contact", "read", throw=True)
+
+    limit = min(max(cint(limit), 1), MAX_CONVERSATION_PAGE_SIZE)
+    values = {"limit": limit + 1}
+    conditions = ""
+    if before:
+        values["before_at"], _, values["before_name"] = before.rpartition("|")
+        conditions = """
+            and last_message_at <= %(before_at)s
+            and (last_message_at < %(before_at)s or name < %(before_name)s)
+        """
+    conditions += get_match_condition("WABA WhatsApp Contact")
+
+    contacts = frappe.db.sql(
+        f"""
+        select {", ".join(f"`{field}`" for field in INBOX_FIELDS)}
+        from `tabWABA WhatsApp Contact`
+        where last_message_at is not null {conditions}
+        order by last_message_at desc, name desc
+        limit %(limit)s
+        """,
+        values,
+        as_dict=True,
+    )
+
+    next_cursor = None
+    if len(contacts) > limit:
+        contacts = contacts[:limit]
+        next_cursor = f"{contacts[-1].last_message_at}|{contacts[-1].name}"
+
+    return {"contacts": contacts, "next_cursor": next_cursor}
+
+
+def get_match_condition(doctype: str) -> str:
+    """
+    Returns the condition restricting a query to the records the user can
+    read: user permissions, `permission_query_conditions` and shares, as
+    applied by `frappe.get_list`.
+
+    :param doctype: The doctype queried, from its own table.
+    :type doctype: str
+    :return: The condition, starting with `and`, empty if unrestricted.
+    :rtype: str
+    """
+    match_conditions = build_match_conditions(doctype)
+    return f" and ({match_conditions})" if match_conditions else ""
+
+
+@frappe.whitelist()
+def mark_conversation_seen(contact: str) -> int:
+    """
+    Marks every incoming message of a conversation as seen.
+
+    A single read receipt is sent, for the newest unread message, since
+    WhatsApp treats it as reading every message before it. The messages are
+    then marked as seen with one update, the unread count and last message
+    of the contact are updated, and the new statuses are published to the
+    desk. Only the messages the update changed are counted and published,
+    so concurrent calls do not count a message twice. Like
+    `get_conversation`, only the messages the user can read are considered,
+    see `get_match_condition`.
+
+    :param contact: The WABA WhatsApp Contact.
+    :raises frappe.exceptions.ValidationError: If the read receipt could not be sent.
+    :return: The number of messages marked as seen.
+    :rtype: int
+    """  # noqa
+    frappe.has_permission("WABA WhatsApp Message", "write", throw=True)
+
+    values = {"contact": contact}
+    conditions = get_match_condition("WABA WhatsApp Message")
+    newest = frappe.db.sql(
+        f"""
+        select id, creation from `tabWABA WhatsApp Message`
+        where
+            `from` = %(contact)s
+            and type = 'Incoming'
+            and status = 'Received'
+            {conditions}
+        order by creation desc, name desc
+        limit 1
+        """,
+        values,
+        as_dict=True,
+    )
+    if not newest:
+        return 0
+
+    settings = get_waba_settings()
+    response = graph_api.post(
+        f"{settings.phone_number_id}/messages",
+        settings=settings,
+        endpoint="mark_as_seen",
+        json={
+            "messaging_product": "whatsapp",
+            "status": "read",
+            "message_id": newest[0].id,
+        },
+    )
+    if not response.ok:
+        frappe.throw(graph_api.get_error_message(response))
+
+    # Messages received after the read receipt was sent stay unread
+    values.update(creation=newest[0].creation, modified=now())
+    frappe.db.sql(
+        f"""
+        update `tabWABA WhatsApp Message`
+        set status = 'Marked As Seen', modified = %(modified)s
+        where
+            `from` = %(contact)s
+            and type = 'Incoming'
+            and status = 'Received'
+            and creation <= %(creation)s
+            {conditions}
+        """,
+        values,
+    )
+    message_names = frappe.get_all(
+        "WABA WhatsApp Message",
+        filters={
+            "from": contact,
+            "type": "Incoming",
+            "status": "Marked As Seen",
+            "modified": values["modified"],
+        },
+        pluck="name",
+    )
+    if not message_names:
+        return 0
+
+    decrement_unread_count(contact, len(message_names))
+    refresh_last_message_statuses(message_names)
+    publish_message_updates(
+        [
+            {
+                "name": name,
+                "status": "Marked As Seen",
+                "type": "Incoming",
+                "from": contact,
+                "modified": values["modified"],
+            }
+            for name in message_names
+        ]
+    )
+
+    return len(message_names)
@@ -0,0 +1,21 @@
+import frappe
+from waba_integration.metrics import get_prometheus_text
+
+from werkzeug.wrappers import Response
+
+
+@frappe.whitelist()
+def prometheus():
+    """
+    Returns the metrics of the integration in the Prometheus text format.
+
+    Scrape it with the API key and secret of a System Manager, e.g. with the
+    `Authorization: token <api_key>:<api_secret>` header.
+    """
+    frappe.only_for("System Manager")
+
+    return Response(
+        get_prometheus_text(),
+        status=200,
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
@@ -1,46 +1,568 @@
+import json
+import random
+from collections import Counter
+from typing import Dict, Iterable, List
+
 import frappe
+from frappe.utils import add_days, add_to_date, getdate, now
+from waba_integration import metrics
+from waba_integration.dedup import get_unseen, mark_as_seen
+from waba_integration.whatsapp_business_api_integration.doctype.waba_message_status_update.waba_message_status_update import (  # noqa
+    apply_status_updates,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    get_waba_settings,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_webhook_dead_letter.waba_webhook_dead_letter import (  # noqa
+    insert_dead_letters,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_webhook_log.waba_webhook_log import (  # noqa
+    get_webhook_log_payload,
+    insert_webhook_log,
+    should_log_success,
+)
 from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_message.waba_whatsapp_message import (  # noqa
-    create_waba_whatsapp_message,
-    process_status_update,
+    create_waba_whatsapp_messages,
 )
 
 from werkzeug.wrappers import Response
 
+# Logs stuck in `Processing` for longer than this are assumed to belong to
+# a worker that died and are handed out again.
+STALE_PROCESSING_MINUTES = 10
+
+# Savepoint the events of a webhook are saved in, see `process_payload`
+EVENTS_SAVEPOINT = "waba_webhook_events"
+
+# Number of logs queued again per transaction, see `replay_webhook_logs`
+REPLAY_CHUNK_SIZE = 1000
+
+# Histogram of the time spent in each stage of processing a webhook
+STAGE_METRIC = "waba_webhook_stage_duration_seconds"
+
 
 @frappe.whitelist(allow_guest=True)
 def handle():
     if frappe.request.method == "GET":
         return verify_token_and_fulfill_challenge()
 
-    try:
-        form_dict = frappe.local.form_dict
-        messages = form_dict["entry"][0]["changes"][0]["value"].get("messages", [])  # noqa
-        statuses = form_dict["entry"][0]["changes"][0]["value"].get("statuses", [])  # noqa
-
-        for status in statuses:
-            process_status_update(status)
-
-        for message in messages:
-            create_waba_whatsapp_message(message)
+    if get_waba_settings().process_webhooks_in_background:
+        return queue_webhook()
 
-        frappe.get_doc(
-            {"doctype": "WABA Webhook Log", "payload": frappe.as_json(form_dict)}  # noqa
-        ).insert(ignore_permissions=True)
+    try:
+        failures = process_payload(frappe.local.form_dict)
+        with metrics.measure(STAGE_METRIC, stage="log"):
+            if failures:
+                insert_dead_letters(
+                    failures,
+                    insert_webhook_log(
+                        frappe.request.get_data(),
+                        "Failed",
+                        get_failures_summary(failures),
+                    ),
+                )
+            elif should_log_success():
+                insert_webhook_log(frappe.request.get_data(), "Processed")
     except Exception:
+        # Nothing of a failed payload is kept, nor remembered as processed
+        frappe.db.rollback()
         message = frappe.get_traceback()
         frappe.log_error(title="WABA Webhook Log Error", message=message)
 
-        form_dict = frappe.local.form_dict
-        frappe.get_doc(
-            {"doctype": "WABA Webhook Log", "payload": frappe.as_json(form_dict)}  # noqa
-        ).insert(ignore_permissions=True)
+        insert_webhook_log(frappe.request.get_data(), "Failed", message)
 
 
 def verify_token_and_fulfill_challenge():
     meta_challenge = frappe.form_dict.get("hub.challenge")
-    expected_token = frappe.db.get_single_value("WABA Settings", "webhook_verify_token")  # noqa
+    expected_token = get_waba_settings().webhook_verify_token
 
     if frappe.form_dict.get("hub.verify_token") != expected_token:
         frappe.throw("Verify token does not match")
 
     return Response(meta_challenge, status=200)
+
+
+def process_payload(payload: Dict) -> List[Dict]:
+    """
+    Processes the statuses and messages of a webhook payload.
+
+    Meta can batch several entries, each with several changes, in a single
+    webhook. All of them are processed together, so that the number of
+    queries stays the same however many messages the payload carries.
+
+    Messages and statuses already processed, e.g. when Meta redelivers a
+    webhook, are dropped before touching the database, see
+    `drop_seen_events`.
+
+    If processing them together fails, they are processed again one by one,
+    each in its own savepoint, so that a bad message or status does not
+    prevent the others from being saved.
+
+    :param payload: The webhook payload as sent by the WhatsApp Cloud API.
+    :type payload: Dict
+    :return: The messages and statuses that could not be processed, see
+             `insert_dead_letters`.
+    :rtype: List[Dict]
+    """
+    with metrics.measure(STAGE_METRIC, stage="parse"):
+        batch = parse_payload(payload)
+        all_events = get_events(batch)
+        events = drop_seen_events(all_events)
+
+    try:
+        apply_events_in_savepoint(events.values(), batch.contacts)
+        failures = []
+    except Exception:
+        failures = []
+        for event_key, event in events.items():
+            try:
+                apply_events_in_savepoint([event], batch.contacts)
+            except Exception:
+                failures.append(
+                    frappe._dict(
+                        event_type=event.event_type,
+                        event_key=event_key,
+                        payload=event.payload,
+                        error=frappe.get_traceback(),
+                    )
+                )
+
+    failed_keys = {failure.event_key for failure in failures}
+    mark_as_seen([event_key for event_key in events if event_key not in failed_keys])  # noqa
+    count_events(all_events, events, failed_keys)
+
+    return failures
+
+
+def apply_events_in_savepoint(events: Iterable[Dict], contacts: List[Dict]):
+    """
+    Saves messages and statuses, rolling back to where it started on error.
+
+    :param events: The events to save, see `get_events`.
+    :type events: Iterable[Dict]
+    :param contacts: The `contacts` of the webhook payload.
+    :type contacts: List[Dict]
+    """
+    frappe.db.savepoint(EVENTS_SAVEPOINT)
+    callbacks = get_transaction_callbacks()
+    try:
+        with metrics.measure(STAGE_METRIC, stage="statuses"):
+            apply_status_updates(
+                [event.payload for event in events if event.event_type == "Status"]  # noqa
+            )
+        with metrics.measure(STAGE_METRIC, stage="messages"):
+            create_waba_whatsapp_messages(
+                [event.payload for event in events if event.event_type == "Message"],  # noqa
+                contacts,
+            )
+    except Exception:
+        frappe.db.rollback(save_point=EVENTS_SAVEPOINT)
+        restore_transaction_callbacks(callbacks)
+        raise
+
+    frappe.db.release_savepoint(EVENTS_SAVEPOINT)
+
+
+def get_transaction_callbacks() -> Dict:
+    """
+    Snapshots what the transaction will do once committed or rolled back.
+
+    Rolling back to a savepoint does not undo the callbacks registered since
+    it, see `restore_transaction_callbacks`.
+
+    :return: The `after_commit` and `after_rollback` callbacks, and the
+             realtime updates of the transaction.
+    :rtype: Dict
+    """
+    realtime_updates = getattr(frappe.local, "waba_realtime_updates", None)
+    return frappe._dict(
+        after_commit=list(frappe.db.after_commit._functions),
+        after_rollback=list(frappe.db.after_rollback._functions),
+        realtime_updates=(
+            None if realtime_updates is None else dict(realtime_updates)
+        ),
+    )
+
+
+def restore_transaction_callbacks(callbacks: Dict):
+    """
+    Drops the callbacks registered since a snapshot, after rolling back to
+    the savepoint it was taken at.
+
+    Otherwise rolled back contacts would be remembered as known, and rolled
+    back messages published to the desk, once the transaction commits. The
+    `after_rollback` callbacks registered since the snapshot are run, as
+    their rows are gone, e.g. to remove downloaded files.
+
+    :param callbacks: The snapshot, see `get_transaction_callbacks`.
+    :type callbacks: Dict
+    """
+    start = len(callbacks.after_rollback)
+    for callback in list(frappe.db.after_rollback._functions)[start:]:
+        callback()
+
+    for manager, functions in (
+        (frappe.db.after_commit, callbacks.after_commit),
+        (frappe.db.after_rollback, callbacks.after_rollback),
+    ):
+        manager._functions.clear()
+        manager._functions.extend(functions)
+
+    frappe.local.waba_realtime_updates = callbacks.realtime_updates
+
+
+def get_events(batch: Dict) -> Dict[str, Dict]:
+    """
+    Returns the statuses and messages of a batch, by event key.
+
+    Messages are identified by their ID, statuses by their message ID and
+    status. Duplicates within the batch are dropped.
+
+    :param batch: The batch, see `parse_payload`.
+    :type batch: Dict
+    :return: The `event_type` and `payload` of the events, by event key.
+    :rtype: Dict[str, Dict]
+    """
+    events = {}
+    for status in batch.statuses:
+        events[f"status:{status.get('id')}:{status.get('status')}"] = (
+            frappe._dict(event_type="Status", payload=status)
+        )
+
+    for message in batch.messages:
+        events[f"message:{message.get('id')}"] = frappe._dict(
+            event_type="Message", payload=message
+        )
+
+    return events
+
+
+def drop_seen_events(events: Dict[str, Dict]) -> Dict[str, Dict]:
+    """
+    Drops the messages and statuses that were already processed.
+
+    :param events: The events, see `get_events`.
+    :type events: Dict[str, Dict]
+    :return: The events that were not processed yet.
+    :rtype: Dict[str, Dict]
+    """
+    unseen = get_unseen(events)
+    return {
+        event_key: event
+        for event_key, event in events.items()
+        if event_key in unseen
+    }
+
+
+def count_events(
+    all_events: Dict[str, Dict], new_events: Dict[str, Dict], failed_keys: set
+):
+    """
+    Counts the messages and statuses of a webhook, by type and outcome.
+
+    :param all_events: All the events of the webhook, see `get_events`.
+    :type all_events: Dict[str, Dict]
+    :param new_events: The events not seen before, see `drop_seen_events`.
+    :type new_events: Dict[str, Dict]
+    :param failed_keys: The keys of the events that failed.
+    :type failed_keys: set
+    """
+    counts = Counter()
+    for event_key, event in all_events.items():
+        if event_key not in new_events:
+            outcome = "duplicate"
+        elif event_key in failed_keys:
+            outcome = "failed"
+        else:
+            outcome = "processed"
+        counts[event.event_type.lower(), outcome] += 1
+    for (event_type, outcome), count in counts.items():
+        metrics.increment(
+            "waba_webhook_events_total",
+            count,
+            type=event_type,
+            outcome=outcome,
+        )
+
+
+def get_failures_summary(failures: List[Dict]) -> str:
+    """
+    Returns the error of a webhook with messages or statuses that failed.
+
+    :param failures: The failed messages and statuses.
+    :type failures: List[Dict]
+    :return: The number of failures, and the first traceback.
+    :rtype: str
+    """
+    return (
+        f"{len(failures)} message(s) or status(es) could not be processed, "
+        "see WABA Webhook Dead Letter.\n\n"
+        f"{failures[0].error}"
+    )
+
+
+def parse_payload(payload: Dict) -> Dict:
+    """
+    Collects the messages and statuses of every entry and change of a payload.
+
+    :param payload: The webhook payload as sent by the WhatsApp Cloud API.
+    :type payload: Dict
+    :return: A dict with the `messages`, `statuses` and `contacts` of the
+             payload.
+    :rtype: Dict
+    """
+    batch = frappe._dict(messages=[], statuses=[], contacts=[])
+
+    for entry in payload.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            batch.messages.extend(value.get("messages", []))
+            batch.statuses.extend(value.get("statuses", []))
+            batch.contacts.extend(value.get("contacts", []))
+
+    return batch
+
+
+def queue_webhook():
+    """
+    Stores the raw webhook payload and hands it over to the webhook workers.
+
+    The payload is saved as is, without parsing or re-serializing it, in a
+    `Queued` WABA Webhook Log so that Meta gets its acknowledgement right
+    away. The actual processing happens in `process_queued_webhooks`.
+    """
+    insert_webhook_log(frappe.request.get_data(), "Queued")
+
+    enqueue_webhook_worker(random.randrange(get_webhook_worker_concurrency()))
+
+
+def enqueue_webhook_worker(slot: int = 0):
+    """
+    Enqueues a webhook worker for the given slot.
+
+    Every slot maps to a fixed job id, so there are never more than
+    `Worker Concurrency` workers draining the queue at the same time and a
+    slot that is already queued or running is not enqueued again.
+
+    :param slot: The worker slot, between 0 and `Worker Concurrency` - 1.
+    :type slot: int
+    """
+    frappe.enqueue(
+        "waba_integration.api.webhook.process_queued_webhooks",
+        queue=get_waba_settings().webhook_queue,
+        job_id=f"waba_webhook_worker_{slot}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+    )
+
+
+def process_queued_webhooks():
+    """
+    Background job that drains the queued WABA Webhook Logs.
+
+    Claims `Webhook Batch Size` logs at a time and processes them one by
+    one, until there are no queued logs left.
+    """
+    batch_size = get_waba_settings().webhook_batch_size or 1
+
+    while log_names := claim_queued_webhook_logs(batch_size):
+        for log_name in log_names:
+            process_webhook_log(log_name)
+
+
+def claim_queued_webhook_logs(batch_size: int) -> List[str]:
+    """
+    Marks the oldest queued WABA Webhook Logs as `Processing`.
+
+    Rows locked by another worker are skipped, which lets several workers
+    drain the queue concurrently without picking the same payload twice.
+
+    :param batch_size: The maximum number of logs to claim.
+    :type batch_size: int
+    :return: The names of the claimed logs.
+    :rtype: List[str]
+    """
+    log_names = frappe.db.sql(
+        """
+        select name from `tabWABA Webhook Log`
+        where status = 'Queued'
+        order by creation
+        limit %(batch_size)s
+        for update skip locked
+        """,
+        {"batch_size": batch_size},
+        pluck=True,
+    )
+
+    if log_names:
+        frappe.db.sql(
+            """
+            update `tabWABA Webhook Log`
+            set status = 'Processing', modified = %(modified)s
+            where name in %(log_names)s
+            """,
+            {"modified": now(), "log_names": tuple(log_names)},
+        )
+
+    frappe.db.commit()
+    return log_names
+
+
+def process_webhook_log(log_name: str):
+    """
+    Processes the payload stored in a WABA Webhook Log.
+
+    The log is marked as `Processed` on success, or deleted if it is not
+    sampled, see `should_log_success`. If some messages or statuses failed,
+    they are saved as WABA Webhook Dead Letters and the log is marked as
+    `Failed`. If the payload could not be processed at all, the changes
+    made while processing are rolled back and the log is marked as `Failed`
+    along with the traceback.
+
+    :param log_name: The name of the WABA Webhook Log.
+    :type log_name: str
+    """
+    payload = get_webhook_log_payload(log_name)
+
+    try:
+        status, error = "Processed", None
+        if failures := process_payload(json.loads(payload)):
+            status, error = "Failed", get_failures_summary(failures)
+            with metrics.measure(STAGE_METRIC, stage="log"):
+                insert_dead_letters(failures, log_name)
+    except Exception:
+        frappe.db.rollback()
+        error = frappe.get_traceback()
+        status = "Failed"
+        frappe.log_error(title="WABA Webhook Log Error", message=error)
+
+    with metrics.measure(STAGE_METRIC, stage="log"):
+        if status == "Processed" and not should_log_success():
+            frappe.db.delete("WABA Webhook Log", {"name": log_name})
+        else:
+            frappe.db.set_value(
+                "WABA Webhook Log",
+                log_name,
+                {"status": status, "error": error},
+            )
+    frappe.db.commit()
+
+
+def enqueue_pending_webhooks():
+    """
+    Scheduled job that makes sure no queued webhook is left behind.
+
+    Logs stuck in `Processing` because their worker died are queued again,
+    and workers are enqueued if there are queued logs without one.
+    """
+    if not get_waba_settings().process_webhooks_in_background:
+        return
+
+    frappe.db.sql(
+        """
+        update `tabWABA Webhook Log`
+        set status = 'Queued'
+        where status = 'Processing' and modified < %(stale_before)s
+        """,
+        {"stale_before": add_to_date(None, minutes=-STALE_PROCESSING_MINUTES)},  # noqa
+    )
+
+    if frappe.db.exists("WABA Webhook Log", {"status": "Queued"}):
+        for slot in range(get_webhook_worker_concurrency()):
+            enqueue_webhook_worker(slot)
+
+
+def get_webhook_worker_concurrency() -> int:
+    """
+    Returns the maximum number of webhook workers, at least one.
+
+    :return: The configured `Worker Concurrency`.
+    :rtype: int
+    """
+    return max(get_waba_settings().webhook_worker_concurrency, 1)
+
+
+@frappe.whitelist()
+def replay_webhook_logs(
+    from_date: str, to_date: str, statuses: List[str] = None
+) -> int:
+    """
+    Processes the stored webhooks received between two dates again.
+
+    The logs are queued again, in chunks, and drained by `Worker
+    Concurrency` webhook workers in parallel. Replaying is idempotent:
+    messages and statuses already processed are skipped or left as they
+    are, and statuses already in the history are not recorded again, see
+    `insert_status_history`, so only the ones that failed are saved. The
+    open dead letters of the logs are marked as `Replayed`, the ones failing
+    again get new ones.
+
+    :param from_date: The first day, inclusive.
+    :type from_date: str
+    :param to_date: The last day, inclusive.
+    :type to_date: str
+    :param statuses: The statuses of the logs to replay, `Failed` and/or
+                     `Processed`. Only `Failed` if not given.
+    :type statuses: List[str]
+    :return: The number of logs queued again.
+    :rtype: int
+    """  # noqa
+    frappe.only_for("System Manager")
+
+    statuses = frappe.parse_json(statuses) if statuses else ["Failed"]
+    if isinstance(statuses, str):
+        statuses = [statuses]
+    if not statuses or set(statuses) - {"Failed", "Processed"}:
+        frappe.throw("Only `Failed` and `Processed` webhooks can be replayed.")
+
+    values = {
+        "from_date": getdate(from_date),
+        "to_date": add_days(getdate(to_date), 1),
+        "statuses": tuple(statuses),
+        "limit": REPLAY_CHUNK_SIZE,
+        "modified": now(),
+        "last_name": "",
+    }
+    replayed = 0
+    # Paged by name, so that logs processed again by a worker meanwhile are
+    # not picked up a second time
+    while log_names := frappe.db.sql(
+        """
+        select name from `tabWABA Webhook Log`
+        where
+            creation >= %(from_date)s
+            and creation < %(to_date)s
+            and status in %(statuses)s
+            and name > %(last_name)s
+        order by name
+        limit %(limit)s
+        """,
+        values,
+        pluck=True,
+    ):
+        values["last_name"] = log_names[-1]
+        values["log_names"] = tuple(log_names)
+        frappe.db.sql(
+            """
+            update `tabWABA Webhook Log`
+            set status = 'Queued', modified = %(modified)s
+            where name in %(log_names)s
+            """,
+            values,
+        )
+        frappe.db.sql(
+            """
+            update `tabWABA Webhook Dead Letter`
+            set status = 'Replayed', modified = %(modified)s
+            where webhook_log in %(log_names)s and status = 'Open'
+            """,
+            values,
+        )
+        frappe.db.commit()
+        replayed += len(log_names)
+
+    if replayed:
+        for slot in range(get_webhook_worker_concurrency()):
+            enqueue_webhook_worker(slot)
+
+    return replayed
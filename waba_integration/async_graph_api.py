@@ -0,0 +1,242 @@
+import asyncio
+import json
+import time
+from typing import TYPE_CHECKING, Awaitable, Dict, Iterable, List
+
+from waba_integration.graph_api import (
+    RETRY_STATUS_CODES,
+    get_backoff,
+    get_request_outcome,
+    record_request,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    CachedWABASettings,
+)
+
+if TYPE_CHECKING:
+    import aiohttp
+
+
+class AsyncGraphClient:
+    """
+    An asyncio client for the Graph API, to make many calls from one thread.
+
+    The client owns an event loop and a shared `aiohttp.ClientSession`,
+    whose keep-alive connections are reused by every batch run on it, see
+    `run` and `gather`. At most `concurrency` calls are in flight at a time.
+
+    Like `graph_api.request`, calls are retried on server and connection
+    errors, but not on read timeouts, and counted and timed in the metrics.
+    No call touches the database, so batches are built before and written
+    back after a run.
+
+    Only sending messages is supported, the calls outbox batches are made
+    of. Media uploads and downloads are bound by file I/O and stay on the
+    bounded thread pools of `waba_integration.media`, and marking a
+    conversation as seen is a single call, made with `graph_api`.
+
+    Use it as a context manager, from code without a running event loop
+    (requests and background jobs). `aiohttp` is only imported once a client
+    is created, so that the other send paths do not load it.
+    """
+
+    def __init__(self, settings: CachedWABASettings, concurrency: int = None):
+        import aiohttp
+
+        # Errors raised when the Graph API could not be reached or did not
+        # answer in time. Connection errors (including resets) are retried,
+        # like `graph_api.request` does.
+        self.request_errors = (aiohttp.ClientError, asyncio.TimeoutError)
+
+        self.settings = settings
+        self.concurrency = max(concurrency or settings.async_concurrency, 1)
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def run(self, coroutine: Awaitable):
+        """
+        Runs a coroutine on the event loop of the client.
+
+        :param coroutine: The coroutine, e.g. `client.send_message(...)`.
+        :type coroutine: Awaitable
+        :return: The result of the coroutine.
+        """
+        return self.loop.run_until_complete(coroutine)
+
+    def gather(self, coroutines: Iterable[Awaitable]) -> List:
+        """
+        Runs a batch of coroutines concurrently, in a single event loop run.
+
+        :param coroutines: The calls of the batch.
+        :type coroutines: Iterable[Awaitable]
+        :return: The results of the calls, in order. Calls that raised have
+                 their exception as result.
+        :rtype: List
+        """
+
+        async def gather_all():
+            return await asyncio.gather(*coroutines, return_exceptions=True)
+
+        return self.run(gather_all())
+
+    def close(self):
+        """Closes the connections and the event loop."""
+        if self.loop.is_closed():
+            return
+
+        if self.session:
+            self.run(self.session.close())
+        self.loop.close()
+
+    def get_session(self) -> "aiohttp.ClientSession":
+        """
+        Returns the session of the client, created on first use since it
+        is bound to the running event loop.
+
+        :return: The session.
+        :rtype: aiohttp.ClientSession
+        """
+        import aiohttp
+
+        if not self.session:
+            self.session = aiohttp.ClientSession(
+                headers={"Authorization": "Bearer " + self.settings.access_token},  # noqa
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=self.settings.connect_timeout,
+                    sock_read=self.settings.read_timeout,
+                ),
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+            )
+
+        return self.session
+
+    async def request(
+        self, method: str, path: str, endpoint: str = "other", **kwargs
+    ) -> "AsyncGraphResponse":
+        """
+        Makes an authenticated request to the Graph API, see
+        `graph_api.request`.
+
+        :param method: The HTTP method, e.g. `POST`.
+        :type method: str
+        :param path: The path relative to the versioned Graph API base URL,
+                     or an absolute URL.
+        :type path: str
+        :param endpoint: The operation, as reported in the metrics.
+        :type endpoint: str
+        :param kwargs: Passed on to `aiohttp.ClientSession.request`.
+        :return: The response.
+        :rtype: AsyncGraphResponse
+        :raises aiohttp.ClientConnectionError: If the Graph API could not be
+                                               reached, or did not answer in
+                                               time.
+        """  # noqa
+        import aiohttp
+
+        url = path if path.startswith(("http://", "https://")) else f"{self.settings.api_base}/{path}"  # noqa
+
+        async with self.semaphore:
+            start = time.perf_counter()
+            for attempt in range(self.settings.max_retries + 1):
+                is_last_attempt = attempt == self.settings.max_retries
+                try:
+                    response = await self.get_session().request(
+                        method, url, **kwargs
+                    )
+                    content = await response.read()
+                except aiohttp.ClientConnectionError as e:
+                    if is_last_attempt or is_read_timeout(e):
+                        record_request(
+                            endpoint, "connection_error", start, self.settings
+                        )
+                        raise
+                else:
+                    response = AsyncGraphResponse(response, content)
+                    if is_last_attempt or response.status_code not in RETRY_STATUS_CODES:  # noqa
+                        record_request(
+                            endpoint,
+                            get_request_outcome(response),
+                            start,
+                            self.settings,
+                        )
+                        return response
+                    response.release()
+
+                await asyncio.sleep(get_backoff(attempt))
+
+    async def send_message(self, request_data: Dict) -> "AsyncGraphResponse":
+        """
+        Sends a message, see `WABAWhatsAppMessage.get_request_data`.
+
+        :param request_data: The request data of the message.
+        :type request_data: Dict
+        :return: The response of the `/messages` endpoint.
+        :rtype: AsyncGraphResponse
+        """
+        return await self.request(
+            "POST",
+            f"{self.settings.phone_number_id}/messages",
+            endpoint="send",
+            json=request_data,
+        )
+
+
+def is_read_timeout(error: Exception) -> bool:
+    """
+    Whether a request timed out after it was sent.
+
+    Like `requests.ReadTimeout`, such timeouts are not retried: the Graph API
+    may have received the request, and a message would be sent twice.
+    Connection timeouts are retried, nothing was sent.
+
+    :param error: The error raised by `aiohttp`.
+    :type error: Exception
+    :return: Whether the request timed out once connected.
+    :rtype: bool
+    """
+    import aiohttp
+
+    # Raised by aiohttp 3.10+ for connection timeouts only, older versions
+    # raise a bare `ServerTimeoutError` for both kinds.
+    connection_timeout = getattr(aiohttp, "ConnectionTimeoutError", ())
+    return isinstance(error, aiohttp.ServerTimeoutError) and not isinstance(
+        error, connection_timeout
+    )
+
+
+class AsyncGraphResponse:
+    """
+    A response of `AsyncGraphClient`.
+
+    Has the attributes of `requests.Response` that the helpers of
+    `graph_api` and `dispatch` read, so that responses are handled the same
+    whichever client made the call.
+    """
+
+    def __init__(self, response: "aiohttp.ClientResponse", content: bytes):
+        self.raw = response
+        self.status_code = response.status
+        self.headers = response.headers
+        self.content = content
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return (self.content or b"").decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def release(self):
+        self.raw.release()
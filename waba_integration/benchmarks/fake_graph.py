@@ -0,0 +1,205 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+# Graph API errors returned by the fake server, see `FakeGraphAPI`
+RATE_LIMIT_ERROR = {
+    "message": "(#130429) Rate limit hit",
+    "type": "OAuthException",
+    "code": 130429,
+}
+SERVER_ERROR = {
+    "message": "An unexpected error has occurred. Please retry your request later.",  # noqa
+    "type": "OAuthException",
+    "code": 2,
+}
+
+# Size of the media files served for download
+MEDIA_FILE_SIZE = 64 * 1024
+
+
+class FakeGraphAPI:
+    """
+    A local stand-in for the Graph API, to benchmark without hitting Meta.
+
+    Every request waits for `latency` seconds (with up to `jitter` more),
+    then fails with a rate limit error (429) for `rate_limit_ratio` of the
+    requests and with a server error (500) for `error_ratio` of them.
+    Otherwise it answers like the Graph API would for sending messages,
+    marking them as read, uploading media, getting media URLs and
+    downloading media.
+
+    Use it as a context manager, and point `Graph API URL` at its `url`.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.02,
+        rate_limit_ratio: float = 0.0,
+        error_ratio: float = 0.0,
+        seed: int = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.error_ratio = error_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "rate_limited": 0, "errors": 0}
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        fake = self
+
+        class Handler(GraphRequestHandler):
+            graph = fake
+
+        self.server = GraphServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def get_failure(self) -> tuple:
+        """
+        Counts a request and decides whether it fails.
+
+        :return: The status code and error to fail with, None if it does not.
+        :rtype: tuple
+        """
+        with self.lock:
+            self.counts["requests"] += 1
+            draw = self.random.random()
+            if draw < self.rate_limit_ratio:
+                self.counts["rate_limited"] += 1
+                return 429, RATE_LIMIT_ERROR
+            if draw < self.rate_limit_ratio + self.error_ratio:
+                self.counts["errors"] += 1
+                return 500, SERVER_ERROR
+
+        return None
+
+    def get_delay(self) -> float:
+        with self.lock:
+            return self.latency + self.random.uniform(0, self.jitter)
+
+
+class GraphServer(ThreadingHTTPServer):
+    # Concurrent clients open many connections at once, the default backlog
+    # of 5 would have the kernel reset some of them
+    request_queue_size = 1024
+
+
+class GraphRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as the Graph API does
+    protocol_version = "HTTP/1.1"
+    # The headers and body are written separately, Nagle's algorithm would
+    # hold the body back until the client acknowledges the headers
+    disable_nagle_algorithm = True
+    graph: FakeGraphAPI = None
+
+    def do_GET(self):
+        self.handle_graph_request()
+
+    def do_POST(self):
+        self.handle_graph_request()
+
+    def handle_graph_request(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(self.graph.get_delay())
+
+        if failure := self.graph.get_failure():
+            status_code, error = failure
+            return self.send_json(status_code, {"error": error})
+
+        path = self.path.strip("/").split("?")[0].split("/")
+        if self.command == "POST" and path[-1] == "messages":
+            return self.send_json(200, get_messages_response(body))
+        if self.command == "POST" and path[-1] == "media":
+            return self.send_json(200, {"id": get_id()})
+        if self.command == "GET" and path[0] == "media":
+            return self.send_media()
+        if self.command == "GET":
+            return self.send_json(
+                200,
+                {
+                    "url": f"{self.graph.url}/media/{path[-1]}",
+                    "mime_type": "image/jpeg",
+                    "file_size": MEDIA_FILE_SIZE,
+                    "id": path[-1],
+                },
+            )
+
+        self.send_json(404, {"error": {"message": "Unknown path", "code": 100}})  # noqa
+
+    def send_json(self, status_code: int, data: Dict):
+        body = json.dumps(data).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_media(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(MEDIA_FILE_SIZE))
+        self.end_headers()
+        self.wfile.write(b"\0" * MEDIA_FILE_SIZE)
+
+    def log_message(self, format, *args):
+        # Requests are counted, not logged
+        pass
+
+
+def get_messages_response(body: bytes) -> Dict:
+    """
+    Returns the response of the Graph API to a message or a read receipt.
+
+    :param body: The body of the request.
+    :type body: bytes
+    :return: The response.
+    :rtype: Dict
+    """
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        data = {}
+
+    if data.get("status") == "read":
+        return {"success": True}
+
+    return {
+        "messaging_product": "whatsapp",
+        "contacts": [{"input": data.get("to"), "wa_id": data.get("to")}],
+        "messages": [{"id": f"wamid.{uuid.uuid4().hex}"}],
+    }
+
+
+def get_id() -> str:
+    return str(uuid.uuid4().int)[:16]
@@ -0,0 +1,415 @@
+import dataclasses
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+from unittest.mock import patch
+
+import frappe
+from frappe.utils import now
+from waba_integration import metrics
+from waba_integration.api.webhook import process_payload
+from waba_integration.async_graph_api import AsyncGraphClient
+from waba_integration.benchmarks.fake_graph import FakeGraphAPI
+from waba_integration.benchmarks.webhooks import generate_payloads
+from waba_integration.dispatch import (
+    save_send_results,
+    send_chunk,
+    send_chunk_async,
+)
+from waba_integration.outbox import SEND_CHUNK_SIZE
+from waba_integration.whatsapp_business_api_integration.doctype.waba_bulk_send.waba_bulk_send import (  # noqa
+    create_bulk_send,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    CachedWABASettings,
+    get_waba_settings,
+)
+
+# Latency percentiles reported, see `get_latency`
+PERCENTILES = (50, 95, 99)
+
+# Phone number the benchmarks send from, so that they never pause a real one
+BENCHMARK_PHONE_NUMBER_ID = "benchmark"
+
+
+def run_benchmarks(
+    payloads: int = 100,
+    messages_per_payload: int = 20,
+    statuses_per_payload: int = 20,
+    entries_per_payload: int = 2,
+    media_ratio: float = 0.3,
+    sends: int = 200,
+    dispatches: int = 1000,
+    latency: float = 0.05,
+    rate_limit_ratio: float = 0.0,
+    error_ratio: float = 0.0,
+    seed: int = None,
+) -> Dict:
+    """
+    Benchmarks webhook ingestion and sending against a fake Graph API.
+
+    Three benchmarks are run, each in a transaction that is rolled back, so
+    that no record is left on the site:
+
+    - `webhook`: synthetic payloads processed with `process_payload`.
+    - `send`: messages sent one by one with `WABAWhatsAppMessage.send`.
+    - `dispatch`: messages of a bulk send sent in chunks by the outbox.
+
+    The Graph API calls go to a local `FakeGraphAPI` that simulates latency,
+    rate limits and server errors, with the WABA Settings of the site
+    overridden for the run. They are sent from a phone number of their own,
+    whose rate limit state is cleared from Redis afterwards, and are left
+    out of the metrics of the site.
+
+    :param payloads: The number of webhook payloads.
+    :param messages_per_payload: The incoming messages per payload.
+    :param statuses_per_payload: The statuses per payload.
+    :param entries_per_payload: The entries the payload is split into.
+    :param media_ratio: The share of incoming messages carrying media.
+    :param sends: The number of messages sent one by one.
+    :param dispatches: The number of messages sent by the outbox.
+    :param latency: The latency of the fake Graph API, in seconds.
+    :param rate_limit_ratio: The share of Graph API calls rate limited.
+    :param error_ratio: The share of Graph API calls failing.
+    :param seed: Seeds the payloads and failures, for reproducible runs.
+    :return: The parameters and results of the run, JSON serializable.
+    :rtype: Dict
+    """
+    parameters = {
+        "payloads": payloads,
+        "messages_per_payload": messages_per_payload,
+        "statuses_per_payload": statuses_per_payload,
+        "entries_per_payload": entries_per_payload,
+        "media_ratio": media_ratio,
+        "sends": sends,
+        "dispatches": dispatches,
+        "latency": latency,
+        "rate_limit_ratio": rate_limit_ratio,
+        "error_ratio": error_ratio,
+        "seed": seed,
+    }
+    results = {}
+
+    with FakeGraphAPI(
+        latency=latency,
+        rate_limit_ratio=rate_limit_ratio,
+        error_ratio=error_ratio,
+        seed=seed,
+    ) as graph:
+        settings = get_benchmark_settings(graph.url)
+        benchmarks = {
+            "webhook": lambda: benchmark_webhooks(
+                payloads,
+                messages_per_payload,
+                statuses_per_payload,
+                entries_per_payload,
+                media_ratio,
+                seed,
+            ),
+            "send": lambda: benchmark_send(sends),
+            "dispatch": lambda: benchmark_dispatch(dispatches, settings),
+        }
+        # Calls to the fake Graph API must not show in the metrics of the site
+        with metrics.disabled():
+            try:
+                for name, benchmark in benchmarks.items():
+                    frappe.local.waba_settings = settings
+                    try:
+                        results[name] = benchmark()
+                    finally:
+                        frappe.db.rollback()
+                        frappe.local.waba_settings = None
+                        frappe.local.message_log = []
+            finally:
+                clear_rate_limits()
+
+        graph_api = dict(graph.counts)
+
+    return {
+        "run_at": now(),
+        "parameters": parameters,
+        "results": results,
+        "graph_api": graph_api,
+    }
+
+
+def benchmark_webhooks(
+    payloads: int,
+    messages_per_payload: int,
+    statuses_per_payload: int,
+    entries_per_payload: int,
+    media_ratio: float,
+    seed: int = None,
+) -> Dict:
+    """
+    Times `process_payload` over synthetic payloads.
+
+    The statuses are about outgoing messages inserted beforehand, so that
+    they update real rows.
+
+    :return: The throughput in events (messages and statuses) per second,
+             the latency per payload and the queries per event.
+    :rtype: Dict
+    """
+    status_message_ids = []
+    if statuses_per_payload:
+        recipients = min(payloads * statuses_per_payload, 1000)
+        bulk_send = create_bulk_send(
+            [f"9188{i:08d}" for i in range(recipients)],
+            message_type="Text",
+            message_body="Benchmark",
+        )
+        message_names = frappe.get_all(
+            "WABA WhatsApp Message",
+            filters={"bulk_send": bulk_send.name},
+            pluck="name",
+        )
+        status_message_ids = [f"wamid.benchmark.{name}" for name in message_names]  # noqa
+        frappe.db.bulk_update(
+            "WABA WhatsApp Message",
+            {
+                name: {"id": message_id, "status": "Sent"}
+                for name, message_id in zip(message_names, status_message_ids)
+            },
+        )
+
+    generated = list(
+        generate_payloads(
+            payloads,
+            messages_per_payload=messages_per_payload,
+            statuses_per_payload=statuses_per_payload,
+            entries_per_payload=entries_per_payload,
+            media_ratio=media_ratio,
+            status_message_ids=status_message_ids,
+            seed=seed,
+        )
+    )
+
+    latencies, failures = [], 0
+    with count_queries() as queries:
+        for payload in generated:
+            start = time.perf_counter()
+            failures += len(process_payload(payload))
+            latencies.append(time.perf_counter() - start)
+
+    events = payloads * (messages_per_payload + statuses_per_payload)
+    return get_result(events, latencies, queries.count, failures)
+
+
+def benchmark_send(sends: int) -> Dict:
+    """
+    Times `WABAWhatsAppMessage.send` on text messages, one at a time.
+
+    :return: The throughput in messages per second, the latency per message
+             and the queries per message.
+    :rtype: Dict
+    """
+    if not sends:
+        return {}
+
+    bulk_send = create_bulk_send(
+        [f"9177{i:08d}" for i in range(sends)],
+        message_type="Text",
+        message_body="Benchmark",
+    )
+    message_docs = [
+        frappe.get_doc("WABA WhatsApp Message", name)
+        for name in frappe.get_all(
+            "WABA WhatsApp Message",
+            filters={"bulk_send": bulk_send.name},
+            pluck="name",
+        )
+    ]
+
+    latencies, failures = [], 0
+    with count_queries() as queries:
+        for message_doc in message_docs:
+            start = time.perf_counter()
+            try:
+                if not message_doc.send():
+                    failures += 1
+            except Exception:
+                failures += 1
+                frappe.clear_last_message()
+            latencies.append(time.perf_counter() - start)
+
+    return get_result(sends, latencies, queries.count, failures)
+
+
+def benchmark_dispatch(dispatches: int, settings: CachedWABASettings) -> Dict:
+    """
+    Times the outbox sending the messages of a bulk send, chunk by chunk.
+
+    The rate limit of the phone number is left out, only the concurrency of
+    the sends (`Bulk Send Concurrency`, or `Async Concurrency` if `Use Async
+    Graph Client` is set) limits the throughput.
+
+    :return: The throughput in messages per second, the latency per chunk
+             and the queries per message.
+    :rtype: Dict
+    """
+    if not dispatches:
+        return {}
+
+    bulk_send = create_bulk_send(
+        [f"9166{i:08d}" for i in range(dispatches)],
+        message_type="Text",
+        message_body="Benchmark",
+    )
+    messages = frappe.get_all(
+        "WABA WhatsApp Message",
+        filters={"bulk_send": bulk_send.name},
+        fields=["*"],
+        order_by="creation asc",
+    )
+
+    if settings.use_async_graph_client:
+        with AsyncGraphClient(settings) as client:
+            return time_dispatch(
+                messages,
+                lambda chunk: send_chunk_async(chunk, client, settings),
+            )
+
+    with ThreadPoolExecutor(
+        max_workers=max(settings.bulk_send_concurrency, 1)
+    ) as executor:
+        return time_dispatch(
+            messages, lambda chunk: send_chunk(chunk, executor, settings)
+        )
+
+
+def time_dispatch(
+    messages: List[Dict], send: Callable[[List[Dict]], Dict[str, Dict]]
+) -> Dict:
+    """
+    Times sending messages chunk by chunk, see `benchmark_dispatch`.
+
+    :param messages: The WABA WhatsApp Messages to send, as dicts.
+    :type messages: List[Dict]
+    :param send: Sends a chunk of messages, see `send_chunk` and
+                 `send_chunk_async`.
+    :type send: Callable[[List[Dict]], Dict[str, Dict]]
+    :return: The result of the benchmark, see `get_result`.
+    :rtype: Dict
+    """
+    latencies, failures = [], 0
+    with count_queries() as queries:
+        for start in range(0, len(messages), SEND_CHUNK_SIZE):
+            end = start + SEND_CHUNK_SIZE
+            chunk = messages[start:end]
+            started_at = time.perf_counter()
+            results = send(chunk)
+            save_send_results(results)
+            latencies.append(time.perf_counter() - started_at)
+            failures += sum(
+                updates["status"] != "Sent" for updates in results.values()
+            )
+
+    return get_result(len(messages), latencies, queries.count, failures)
+
+
+def get_benchmark_settings(graph_api_url: str) -> CachedWABASettings:
+    """
+    Returns the WABA Settings of the site, pointed at the fake Graph API.
+
+    :param graph_api_url: The URL of the fake Graph API.
+    :type graph_api_url: str
+    :return: The settings used for the run.
+    :rtype: CachedWABASettings
+    """
+    return dataclasses.replace(
+        get_waba_settings(),
+        enabled=True,
+        access_token="benchmark",
+        phone_number_id=BENCHMARK_PHONE_NUMBER_ID,
+        api_version="v17.0",
+        graph_api_url=graph_api_url,
+        automatically_download_images=False,
+        automatically_download_audio=False,
+        webhook_log_sample_rate=0.0,
+    )
+
+
+def clear_rate_limits():
+    """
+    Removes the token bucket and the pause of the benchmark phone number
+    from Redis.
+    """
+    cache = frappe.cache()
+    cache.delete(
+        cache.make_key(f"waba_token_bucket:{BENCHMARK_PHONE_NUMBER_ID}"),
+        cache.make_key(f"waba_sending_paused:{BENCHMARK_PHONE_NUMBER_ID}"),
+    )
+
+
+@contextmanager
+def count_queries():
+    """
+    Counts the queries run on the database connection of the site.
+
+    :return: A dict whose `count` is the number of queries so far.
+    :rtype: Dict
+    """
+    counter = frappe._dict(count=0)
+    sql = frappe.db.sql
+
+    def counted_sql(*args, **kwargs):
+        counter.count += 1
+        return sql(*args, **kwargs)
+
+    with patch.object(frappe.db, "sql", counted_sql):
+        yield counter
+
+
+def get_result(
+    items: int, latencies: List[float], queries: int, failures: int
+) -> Dict:
+    """
+    Summarizes a benchmark.
+
+    :param items: The number of events or messages processed.
+    :type items: int
+    :param latencies: The durations of the timed operations, in seconds.
+    :type latencies: List[float]
+    :param queries: The number of queries run.
+    :type queries: int
+    :param failures: The number of events or messages that failed.
+    :type failures: int
+    :return: The `items`, `seconds`, `throughput` (items per second),
+             `latency_ms` percentiles, `queries_per_item` and `failures`.
+    :rtype: Dict
+    """
+    seconds = sum(latencies)
+    return {
+        "items": items,
+        "seconds": round(seconds, 3),
+        "throughput": round(items / seconds, 2) if seconds else None,
+        "latency_ms": get_latency(latencies),
+        "queries_per_item": round(queries / items, 2) if items else None,
+        "failures": failures,
+    }
+
+
+def get_latency(latencies: List[float]) -> Dict[str, float]:
+    """
+    Returns the latency percentiles, using the nearest-rank method.
+
+    :param latencies: The durations, in seconds.
+    :type latencies: List[float]
+    :return: The percentiles in milliseconds, e.g. `{"p50": 12.5, ...}`.
+    :rtype: Dict[str, float]
+    """
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+
+    return {
+        f"p{percentile}": round(
+            latencies[max(math.ceil(percentile / 100 * len(latencies)) - 1, 0)]
+            * 1000,
+            3,
+        )
+        for percentile in PERCENTILES
+    }
@@ -0,0 +1,169 @@
+import hashlib
+import random
+import time
+from typing import Dict, Iterator, List
+
+# Incoming message types generated, with their relative weights
+MESSAGE_TYPE_WEIGHTS = {
+    "text": 70,
+    "image": 12,
+    "audio": 8,
+    "document": 6,
+    "video": 4,
+}
+
+# MIME types of the generated media messages
+MEDIA_MIME_TYPES = {
+    "image": "image/jpeg",
+    "audio": "audio/ogg",
+    "document": "application/pdf",
+    "video": "video/mp4",
+}
+
+STATUSES = ("sent", "delivered", "read")
+
+
+def generate_payloads(
+    payloads: int,
+    messages_per_payload: int = 10,
+    statuses_per_payload: int = 0,
+    entries_per_payload: int = 1,
+    contacts: int = 100,
+    media_ratio: float = 0.3,
+    status_message_ids: List[str] = None,
+    seed: int = None,
+) -> Iterator[Dict]:
+    """
+    Generates synthetic webhook payloads, as sent by the WhatsApp Cloud API.
+
+    The messages and statuses of a payload are spread over
+    `entries_per_payload` entries, to exercise batching across entries and
+    changes. Message IDs are random, so that payloads are never dropped as
+    redelivered.
+
+    :param payloads: The number of payloads.
+    :type payloads: int
+    :param messages_per_payload: The number of incoming messages per payload.
+    :type messages_per_payload: int
+    :param statuses_per_payload: The number of statuses per payload.
+    :type statuses_per_payload: int
+    :param entries_per_payload: The number of entries per payload.
+    :type entries_per_payload: int
+    :param contacts: The number of distinct senders.
+    :type contacts: int
+    :param media_ratio: The share of the messages that carry media, 0 to 1.
+    :type media_ratio: float
+    :param status_message_ids: The IDs of the outgoing messages the statuses
+                               are about. Random IDs if not given.
+    :type status_message_ids: List[str]
+    :param seed: Seeds the generator, for reproducible runs.
+    :type seed: int
+    :return: The payloads.
+    :rtype: Iterator[Dict]
+    """  # noqa
+    rng = random.Random(seed)
+    wa_ids = [f"9199{rng.randrange(10**8):08d}" for _ in range(contacts)]
+
+    for _ in range(payloads):
+        messages = [
+            get_message(rng, rng.choice(wa_ids), media_ratio)
+            for _ in range(messages_per_payload)
+        ]
+        statuses = [
+            get_status(rng, rng.choice(wa_ids), status_message_ids)
+            for _ in range(statuses_per_payload)
+        ]
+        yield get_payload(messages, statuses, entries_per_payload)
+
+
+def get_payload(
+    messages: List[Dict], statuses: List[Dict], entries: int
+) -> Dict:
+    """
+    Wraps messages and statuses in the entries and changes of a payload.
+
+    :return: The payload.
+    :rtype: Dict
+    """
+    entries = max(entries, 1)
+    payload = {"object": "whatsapp_business_account", "entry": []}
+    for i in range(entries):
+        entry_messages = messages[i::entries]
+        value = {
+            "messaging_product": "whatsapp",
+            "metadata": {
+                "display_phone_number": "15550000000",
+                "phone_number_id": "benchmark",
+            },
+            "contacts": [
+                {"profile": {"name": f"Contact {wa_id[-4:]}"}, "wa_id": wa_id}
+                for wa_id in dict.fromkeys(m["from"] for m in entry_messages)
+            ],
+            "messages": entry_messages,
+            "statuses": statuses[i::entries],
+        }
+        payload["entry"].append(
+            {
+                "id": "benchmark",
+                "changes": [{"field": "messages", "value": value}],
+            }
+        )
+
+    return payload
+
+
+def get_message(rng: random.Random, wa_id: str, media_ratio: float) -> Dict:
+    """
+    Returns a random incoming message.
+
+    :return: The message, as found in the `messages` of a payload.
+    :rtype: Dict
+    """
+    message = {
+        "from": wa_id,
+        "id": get_message_id(rng),
+        "timestamp": str(int(time.time())),
+    }
+
+    if rng.random() >= media_ratio:
+        message["type"] = "text"
+        message["text"] = {"body": " ".join(["Hello"] * rng.randint(1, 40))}
+        return message
+
+    media_types = [t for t in MESSAGE_TYPE_WEIGHTS if t != "text"]
+    media_type = rng.choices(
+        media_types, [MESSAGE_TYPE_WEIGHTS[t] for t in media_types]
+    )[0]
+    media_id = str(rng.randrange(10**15, 10**16))
+    message["type"] = media_type
+    message[media_type] = {
+        "id": media_id,
+        "mime_type": MEDIA_MIME_TYPES[media_type],
+        "sha256": hashlib.sha256(media_id.encode()).hexdigest(),
+    }
+    if media_type == "document":
+        message[media_type]["filename"] = f"{media_id}.pdf"
+        message[media_type]["caption"] = "Invoice"
+
+    return message
+
+
+def get_status(
+    rng: random.Random, wa_id: str, message_ids: List[str] = None
+) -> Dict:
+    """
+    Returns a random status of an outgoing message.
+
+    :return: The status, as found in the `statuses` of a payload.
+    :rtype: Dict
+    """
+    return {
+        "id": rng.choice(message_ids) if message_ids else get_message_id(rng),
+        "status": rng.choice(STATUSES),
+        "timestamp": str(int(time.time())),
+        "recipient_id": wa_id,
+    }
+
+
+def get_message_id(rng: random.Random) -> str:
+    return f"wamid.{rng.getrandbits(128):032x}"
@@ -1,7 +1,8 @@
-import frappe
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    get_waba_settings,
+)
 
 
 def boot_session(bootinfo):
     """Include twilio enabled flag into boot."""
-    settings = frappe.get_single("WABA Settings")
-    bootinfo.waba_enabled = settings.enabled
+    bootinfo.waba_enabled = get_waba_settings().enabled
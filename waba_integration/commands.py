@@ -0,0 +1,69 @@
+import click
+from frappe.commands import get_site, pass_context
+
+
+@click.command("replay-waba-webhooks")
+@click.option("--from-date", required=True, help="First day, inclusive")
+@click.option("--to-date", required=True, help="Last day, inclusive")
+@click.option(
+    "--status",
+    "statuses",
+    multiple=True,
+    default=["Failed"],
+    type=click.Choice(["Failed", "Processed"]),
+    help="Status of the webhook logs to replay, can be repeated",
+)
+@pass_context
+def replay_waba_webhooks(context, from_date, to_date, statuses):
+    """Process the webhooks received between two dates again."""
+    import frappe
+    from waba_integration.api.webhook import replay_webhook_logs
+
+    frappe.init(site=get_site(context))
+    frappe.connect()
+    try:
+        frappe.set_user("Administrator")
+        replayed = replay_webhook_logs(from_date, to_date, list(statuses))
+        frappe.db.commit()
+        click.echo(f"Queued {replayed} webhook log(s) for replay")
+    finally:
+        frappe.destroy()
+
+
+@click.command("waba-benchmark")
+@click.option("--payloads", default=100, help="Number of webhook payloads")
+@click.option("--messages-per-payload", default=20)
+@click.option("--statuses-per-payload", default=20)
+@click.option("--entries-per-payload", default=2)
+@click.option("--media-ratio", default=0.3, help="Share of media messages")
+@click.option("--sends", default=200, help="Messages sent one by one")
+@click.option("--dispatches", default=1000, help="Messages sent by the outbox")
+@click.option("--latency", default=0.05, help="Graph API latency, in seconds")
+@click.option("--rate-limit-ratio", default=0.0, help="Share of 429s")
+@click.option("--error-ratio", default=0.0, help="Share of server errors")
+@click.option("--seed", type=int, help="Seed, for reproducible runs")
+@click.option("--output", type=click.Path(), help="JSON results file")
+@pass_context
+def waba_benchmark(context, output, **parameters):
+    """Benchmark webhooks and sending against a fake Graph API."""
+    import json
+
+    import frappe
+    from waba_integration.benchmarks.runner import run_benchmarks
+
+    frappe.init(site=get_site(context))
+    frappe.connect()
+    try:
+        frappe.set_user("Administrator")
+        results = json.dumps(run_benchmarks(**parameters), indent=2)
+    finally:
+        frappe.destroy()
+
+    if output:
+        with open(output, "w") as f:
+            f.write(results)
+    else:
+        click.echo(results)
+
+
+commands = [replay_waba_webhooks, waba_benchmark]
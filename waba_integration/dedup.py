@@ -0,0 +1,62 @@
+from typing import Iterable, List, Set
+
+import frappe
+
+# How long an event is remembered, Meta redelivers within minutes to hours
+SEEN_EVENTS_TTL = 24 * 60 * 60
+
+
+def get_unseen(event_keys: Iterable[str]) -> Set[str]:
+    """
+    Returns the events that were not processed before, see `mark_as_seen`.
+
+    Only Redis is queried. A missed duplicate is harmless, since writes are
+    idempotent anyway; this only saves the work of processing it again.
+
+    :param event_keys: The keys of the events, e.g. `message:<id>`.
+    :type event_keys: Iterable[str]
+    :return: The keys of the events that were not seen yet.
+    :rtype: Set[str]
+    """
+    event_keys = list(dict.fromkeys(event_keys))
+    if not event_keys:
+        return set()
+
+    cache = frappe.cache()
+    pipeline = cache.pipeline()
+    for event_key in event_keys:
+        pipeline.exists(cache.make_key(f"waba_seen_event:{event_key}"))
+
+    return {
+        event_key
+        for event_key, seen in zip(event_keys, pipeline.execute())
+        if not seen
+    }
+
+
+def mark_as_seen(event_keys: List[str]):
+    """
+    Remembers events as processed, for `SEEN_EVENTS_TTL`, once committed.
+
+    Events are only remembered after the transaction processing them is
+    committed, so that events of a failed transaction are processed again
+    when they are redelivered.
+
+    :param event_keys: The keys of the events.
+    :type event_keys: List[str]
+    """
+    if not event_keys:
+        return
+
+    def remember():
+        cache = frappe.cache()
+        pipeline = cache.pipeline()
+        for event_key in event_keys:
+            pipeline.set(
+                cache.make_key(f"waba_seen_event:{event_key}"),
+                1,
+                ex=SEEN_EVENTS_TTL,
+            )
+        pipeline.execute()
+
+    frappe.db.after_commit.add(remember)
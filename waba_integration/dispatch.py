@@ -0,0 +1,389 @@
+import mimetypes
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import frappe
+import requests
+from frappe.utils import add_to_date, cint, now, now_datetime
+from waba_integration import graph_api
+from waba_integration.async_graph_api import AsyncGraphClient
+from waba_integration.media import upload_media_bulk
+from waba_integration.rate_limit import pause_sending
+from waba_integration.realtime import publish_message_updates
+from waba_integration.whatsapp_business_api_integration.doctype.waba_message_status_update.waba_message_status_update import (  # noqa
+    apply_unmatched_statuses,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    CachedWABASettings,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_contact.waba_whatsapp_contact import (  # noqa
+    refresh_last_message_statuses,
+)
+
+# Graph API error codes meaning the phone number or the pair of numbers is
+# sending too fast, see https://developers.facebook.com/docs/whatsapp/cloud-api/support/error-codes  # noqa
+RATE_LIMIT_ERROR_CODES = (4, 80007, 130429, 131048, 131056)
+
+# How long sending is paused after being rate limited, if Meta does not say
+DEFAULT_RATE_LIMIT_PAUSE = 60
+
+# Exponential backoff between attempts of a message, in seconds
+RETRY_BACKOFF_BASE = 30
+RETRY_BACKOFF_MAX = 30 * 60
+
+
+def send_chunk(
+    messages: List[Dict],
+    executor: ThreadPoolExecutor,
+    settings: CachedWABASettings,
+) -> Dict[str, Dict]:
+    """
+    Sends a chunk of messages concurrently.
+
+    The attachments that are not uploaded yet are uploaded first, in
+    parallel, see `upload_media_bulk`. The requests are then built in the
+    current thread and posted to the Graph API from the thread pool. Only
+    the HTTP calls run in the pool, since they are the only part that does
+    not need the site context. If Meta rate limits the phone number, sending
+    from it is paused.
+
+    :param messages: The WABA WhatsApp Messages to send, as dicts.
+    :type messages: List[Dict]
+    :param executor: The thread pool the requests are posted from.
+    :type executor: ThreadPoolExecutor
+    :param settings: The WABA Settings, threads have no site context.
+    :type settings: CachedWABASettings
+    :return: The fields to update on every message by name, see
+             `get_message_updates`.
+    :rtype: Dict[str, Dict]
+    """
+    upload_attachments(messages, executor, settings)
+    outcomes, requests_data = get_requests_data(messages)
+
+    futures = {
+        name: executor.submit(post_message, request_data, settings)
+        for name, request_data in requests_data.items()
+    }
+    for name, future in futures.items():
+        outcomes[name] = future.result()
+
+    return get_chunk_updates(messages, outcomes, settings)
+
+
+def send_chunk_async(
+    messages: List[Dict],
+    client: AsyncGraphClient,
+    settings: CachedWABASettings,
+) -> Dict[str, Dict]:
+    """
+    Sends a chunk of messages concurrently, from the event loop of `client`.
+
+    Same as `send_chunk`, except that the requests are posted as a single
+    batch of the async Graph client, at most `Async Concurrency` at a time,
+    instead of from a thread pool. Attachments are still uploaded by
+    `upload_media_bulk`, since hashing them is bound by the disk.
+
+    :param messages: The WABA WhatsApp Messages to send, as dicts.
+    :type messages: List[Dict]
+    :param client: The async Graph client the requests are posted from.
+    :type client: AsyncGraphClient
+    :param settings: The WABA Settings.
+    :type settings: CachedWABASettings
+    :return: The fields to update on every message by name, see
+             `get_message_updates`.
+    :rtype: Dict[str, Dict]
+    """
+    upload_attachments(messages, None, settings)
+    outcomes, requests_data = get_requests_data(messages)
+
+    results = client.gather(
+        post_message_async(client, request_data)
+        for request_data in requests_data.values()
+    )
+    for name, result in zip(requests_data, results):
+        if isinstance(result, Exception):
+            result = get_outcome(error=str(result), retryable=True)
+        outcomes[name] = result
+
+    return get_chunk_updates(messages, outcomes, settings)
+
+
+def get_requests_data(messages: List[Dict]) -> Tuple[Dict, Dict]:
+    """
+    Builds the request data of a chunk of messages, in the current thread.
+
+    :param messages: The WABA WhatsApp Messages to send, as dicts.
+    :type messages: List[Dict]
+    :return: The outcomes of the messages whose request data could not be
+             built, and the request data of the others, both by name.
+    :rtype: Tuple[Dict, Dict]
+    """
+    outcomes, requests_data = {}, {}
+    for message in messages:
+        message_doc = frappe.get_doc({**message, "doctype": "WABA WhatsApp Message"})  # noqa
+        try:
+            requests_data[message.name] = message_doc.get_request_data()
+        except Exception as e:
+            outcomes[message.name] = get_outcome(error=str(e))
+            frappe.clear_last_message()
+
+    return outcomes, requests_data
+
+
+def get_chunk_updates(
+    messages: List[Dict],
+    outcomes: Dict[str, Dict],
+    settings: CachedWABASettings,
+) -> Dict[str, Dict]:
+    """
+    Returns the fields to update on a chunk of messages after sending it.
+
+    If Meta rate limited any of them, sending from the phone number is
+    paused.
+
+    :param messages: The WABA WhatsApp Messages sent, as dicts.
+    :type messages: List[Dict]
+    :param outcomes: The outcome of every message by name, see `get_outcome`.
+    :type outcomes: Dict[str, Dict]
+    :param settings: The WABA Settings.
+    :type settings: CachedWABASettings
+    :return: The fields to update on every message by name, see
+             `get_message_updates`.
+    :rtype: Dict[str, Dict]
+    """
+    if pause := max((outcome.pause for outcome in outcomes.values()), default=0):  # noqa
+        pause_sending(settings.phone_number_id, pause)
+
+    return {
+        message.name: get_message_updates(
+            message, outcomes[message.name], settings
+        )
+        for message in messages
+    }
+
+
+def upload_attachments(
+    messages: List[Dict],
+    executor: ThreadPoolExecutor,
+    settings: CachedWABASettings,
+):
+    """
+    Uploads the attachments of media messages that have none uploaded yet.
+
+    The media ID is set on the messages that could be uploaded, the others
+    fail to build their request data.
+
+    :param messages: The WABA WhatsApp Messages to send, as dicts.
+    :type messages: List[Dict]
+    :param executor: The thread pool the files are uploaded from.
+    :type executor: ThreadPoolExecutor
+    :param settings: The WABA Settings, threads have no site context.
+    :type settings: CachedWABASettings
+    """
+    to_upload = [
+        message
+        for message in messages
+        if message.media_file and not message.media_id
+        and message.message_type in ("Audio", "Image", "Video", "Document")
+    ]
+    uploads = upload_media_bulk(
+        {
+            message.media_file: message.media_mime_type
+            or mimetypes.guess_type(message.media_file)[0]
+            for message in to_upload
+        },
+        executor,
+        settings,
+    )
+
+    for message in to_upload:
+        if media_id := uploads[message.media_file].media_id:
+            message.media_id = media_id
+            message.media_uploaded = 1
+
+
+def post_message(request_data: Dict, settings: CachedWABASettings) -> Dict:
+    """
+    Posts a message to the Graph API.
+
+    Runs in the threads of the pool, so it must not touch the database.
+
+    :param request_data: The request data of the message.
+    :type request_data: Dict
+    :param settings: The WABA Settings.
+    :type settings: CachedWABASettings
+    :return: The outcome, see `get_outcome`.
+    :rtype: Dict
+    """
+    try:
+        response = graph_api.post(
+            f"{settings.phone_number_id}/messages",
+            settings=settings,
+            endpoint="send",
+            json=request_data,
+        )
+    except requests.RequestException as e:
+        return get_outcome(error=str(e), retryable=True)
+
+    return get_response_outcome(response)
+
+
+async def post_message_async(
+    client: AsyncGraphClient, request_data: Dict
+) -> Dict:
+    """
+    Posts a message to the Graph API, from the event loop of `client`.
+
+    :param client: The async Graph client.
+    :type client: AsyncGraphClient
+    :param request_data: The request data of the message.
+    :type request_data: Dict
+    :return: The outcome, see `get_outcome`.
+    :rtype: Dict
+    """
+    try:
+        response = await client.send_message(request_data)
+    except client.request_errors as e:
+        return get_outcome(error=str(e), retryable=True)
+
+    return get_response_outcome(response)
+
+
+def get_response_outcome(response: requests.Response) -> Dict:
+    """
+    Tells whether a message was sent from the response of the Graph API.
+
+    Rate limited requests and server errors can be retried, other errors
+    are final.
+
+    :param response: The response of the `/messages` endpoint.
+    :type response: requests.Response
+    :return: The outcome, see `get_outcome`.
+    :rtype: Dict
+    """
+    if response.ok:
+        return get_outcome(id=response.json()["messages"][0]["id"])
+
+    error = graph_api.get_error(response)
+    if response.status_code == 429 or error.get("code") in RATE_LIMIT_ERROR_CODES:  # noqa
+        return get_outcome(
+            error=graph_api.get_error_message(response),
+            retryable=True,
+            pause=cint(response.headers.get("Retry-After"))
+            or DEFAULT_RATE_LIMIT_PAUSE,
+        )
+
+    return get_outcome(
+        error=graph_api.get_error_message(response),
+        retryable=response.status_code >= 500,
+    )
+
+
+def get_outcome(
+    id: str = None, error: str = None, retryable: bool = False, pause: int = 0
+) -> Dict:
+    """
+    Returns the outcome of an attempt to send a message.
+
+    :param id: The message ID returned by the Graph API, if sent.
+    :type id: str
+    :param error: Why the message could not be sent.
+    :type error: str
+    :param retryable: Whether sending the message can be attempted again.
+    :type retryable: bool
+    :param pause: Seconds to stop sending for, when rate limited.
+    :type pause: int
+    :return: The outcome.
+    :rtype: Dict
+    """
+    return frappe._dict(id=id, error=error, retryable=retryable, pause=pause)
+
+
+def get_message_updates(
+    message: Dict, outcome: Dict, settings: CachedWABASettings
+) -> Dict:
+    """
+    Returns the fields to update on a message after an attempt to send it.
+
+    A message that failed with a retryable error stays `Pending` in the
+    outbox, with exponential backoff, until `Outbox Max Attempts` is reached.
+    Then, or for any other error, it is marked as `Failed`.
+
+    :param message: The WABA WhatsApp Message, as a dict.
+    :type message: Dict
+    :param outcome: The outcome of the attempt, see `get_outcome`.
+    :type outcome: Dict
+    :param settings: The WABA Settings.
+    :type settings: CachedWABASettings
+    :return: The `status`, `id`, `error`, `attempts`, `in_outbox` and
+             `next_attempt_at` of the message, and its `media_id` if it was
+             uploaded, see `upload_attachments`.
+    :rtype: Dict
+    """
+    attempts = cint(message.attempts) + 1
+    updates = {
+        "status": "Failed",
+        "id": outcome.id,
+        "error": outcome.error,
+        "attempts": attempts,
+        "in_outbox": 0,
+        "next_attempt_at": None,
+    }
+
+    if message.get("media_uploaded") and message.get("media_id"):
+        updates["media_id"] = message.media_id
+        updates["media_uploaded"] = 1
+
+    if outcome.id:
+        updates["status"] = "Sent"
+    elif outcome.retryable and attempts < settings.outbox_max_attempts:
+        updates["status"] = "Pending"
+        updates["in_outbox"] = 1
+        updates["next_attempt_at"] = add_to_date(
+            now_datetime(), seconds=max(get_retry_backoff(attempts), outcome.pause)  # noqa
+        )
+
+    return updates
+
+
+def save_send_results(results: Dict[str, Dict]):
+    """
+    Writes the results of sent messages back with a single bulk update.
+
+    The inbox summaries of the recipients are updated with another one, and
+    the new statuses are published to the desk. Statuses Meta reported
+    before the IDs of the messages were saved are then applied, see
+    `apply_unmatched_statuses`.
+
+    :param results: The fields to update on every message by name.
+    :type results: Dict[str, Dict]
+    """
+    if not results:
+        return
+
+    modified = now()
+    frappe.db.bulk_update("WABA WhatsApp Message", results, modified=modified)
+    refresh_last_message_statuses(list(results))
+    publish_message_updates(
+        [
+            {"name": name, "status": updates["status"], "modified": modified}
+            for name, updates in results.items()
+        ]
+    )
+    apply_unmatched_statuses(
+        [updates["id"] for updates in results.values() if updates.get("id")]
+    )
+
+
+def get_retry_backoff(attempts: int) -> float:
+    """
+    Returns how long to wait before attempting to send a message again.
+
+    :param attempts: The number of attempts made so far.
+    :type attempts: int
+    :return: The delay, in seconds, with jitter.
+    :rtype: float
+    """
+    backoff = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempts - 1))
+    return backoff * random.uniform(0.5, 1)
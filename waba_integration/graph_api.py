@@ -0,0 +1,263 @@
+import random
+import time
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from waba_integration import metrics
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    CachedWABASettings,
+    get_waba_settings,
+)
+
+# Server errors worth retrying, anything else is returned to the caller
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+# Exponential backoff between retries, in seconds
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+
+# Keep-alive sessions of this process, by connection pool size
+_sessions: Dict[int, requests.Session] = {}
+
+
+def get_session(settings: CachedWABASettings = None) -> requests.Session:
+    """
+    Returns the keep-alive session of this process.
+
+    The session keeps up to `Connection Pool Size` connections open per host,
+    so that calls to the Graph API reuse TLS connections instead of opening
+    a new one every time.
+
+    :param settings: The WABA Settings, fetched if not passed.
+    :type settings: CachedWABASettings
+    :return: The session.
+    :rtype: requests.Session
+    """
+    settings = settings or get_waba_settings()
+    pool_size = max(settings.connection_pool_size, 1)
+    if pool_size not in _sessions:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)  # noqa
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _sessions[pool_size] = session
+
+    return _sessions[pool_size]
+
+
+def request(
+    method: str,
+    path: str,
+    settings: CachedWABASettings = None,
+    endpoint: str = "other",
+    **kwargs,
+) -> requests.Response:
+    """
+    Makes an authenticated request to the Graph API.
+
+    Server errors and connection errors (including resets) are retried up to
+    `Max Retries` times, with exponential backoff and full jitter. Other
+    responses, successful or not, are returned as is.
+
+    Every call is counted and timed, until the response headers are
+    received, by `endpoint` and outcome, see `waba_integration.metrics`.
+
+    :param method: The HTTP method, e.g. `POST`.
+    :type method: str
+    :param path: The path relative to the versioned Graph API base URL, e.g.
+                 `<phone_number_id>/messages`, or an absolute URL.
+    :type path: str
+    :param settings: The WABA Settings, fetched if not passed. Must be passed
+                     when called outside of a request or job, e.g. from a
+                     thread of a pool, where there is no site context.
+    :type settings: CachedWABASettings
+    :param endpoint: The operation, as reported in the metrics, e.g. `send`.
+    :type endpoint: str
+    :param kwargs: Passed on to `requests.Session.request`.
+    :return: The response.
+    :rtype: requests.Response
+    :raises requests.ConnectionError: If the Graph API could not be reached.
+    """  # noqa
+    settings = settings or get_waba_settings()
+    url = path if path.startswith(("http://", "https://")) else f"{settings.api_base}/{path}"  # noqa
+    headers = {
+        "Authorization": "Bearer " + settings.access_token,
+        **kwargs.pop("headers", {}),
+    }
+    kwargs.setdefault(
+        "timeout", (settings.connect_timeout, settings.read_timeout)
+    )
+
+    start = time.perf_counter()
+    for attempt in range(settings.max_retries + 1):
+        is_last_attempt = attempt == settings.max_retries
+        rewind_body(kwargs.get("data"), kwargs.get("files"))
+
+        try:
+            response = get_session(settings).request(
+                method, url, headers=headers, **kwargs
+            )
+        except requests.ConnectionError:
+            if is_last_attempt:
+                record_request(endpoint, "connection_error", start, settings)
+                raise
+        else:
+            if is_last_attempt or response.status_code not in RETRY_STATUS_CODES:  # noqa
+                record_request(
+                    endpoint, get_request_outcome(response), start, settings
+                )
+                return response
+            response.close()
+
+        time.sleep(get_backoff(attempt))
+
+
+def get(
+    path: str,
+    settings: CachedWABASettings = None,
+    endpoint: str = "other",
+    **kwargs,
+) -> requests.Response:
+    """
+    Makes an authenticated GET request to the Graph API, see `request`.
+
+    :param path: The path relative to the versioned Graph API base URL.
+    :type path: str
+    :param settings: The WABA Settings, fetched if not passed.
+    :type settings: CachedWABASettings
+    :param endpoint: The operation, as reported in the metrics.
+    :type endpoint: str
+    :return: The response.
+    :rtype: requests.Response
+    """
+    return request("GET", path, settings, endpoint, **kwargs)
+
+
+def post(
+    path: str,
+    settings: CachedWABASettings = None,
+    endpoint: str = "other",
+    **kwargs,
+) -> requests.Response:
+    """
+    Makes an authenticated POST request to the Graph API, see `request`.
+
+    :param path: The path relative to the versioned Graph API base URL.
+    :type path: str
+    :param settings: The WABA Settings, fetched if not passed.
+    :type settings: CachedWABASettings
+    :param endpoint: The operation, as reported in the metrics.
+    :type endpoint: str
+    :return: The response.
+    :rtype: requests.Response
+    """
+    return request("POST", path, settings, endpoint, **kwargs)
+
+
+def record_request(
+    endpoint: str, outcome: str, start: float, settings: CachedWABASettings
+):
+    """
+    Counts and times a Graph API call, see `request`.
+
+    :param endpoint: The operation, e.g. `send`.
+    :type endpoint: str
+    :param outcome: The outcome, see `get_request_outcome`.
+    :type outcome: str
+    :param start: When the call started, from `time.perf_counter`.
+    :type start: float
+    :param settings: The WABA Settings the call was made with, for the site
+                     it is recorded for.
+    :type settings: CachedWABASettings
+    """
+    metrics.increment(
+        "waba_graph_requests_total",
+        site=settings.site,
+        endpoint=endpoint,
+        outcome=outcome,
+    )
+    metrics.observe(
+        "waba_graph_request_duration_seconds",
+        time.perf_counter() - start,
+        site=settings.site,
+        endpoint=endpoint,
+        outcome=outcome,
+    )
+
+
+def get_request_outcome(response: requests.Response) -> str:
+    """
+    Returns the outcome of a Graph API call, as reported in the metrics.
+
+    :param response: The response.
+    :type response: requests.Response
+    :return: `ok`, `rate_limited`, `client_error` or `server_error`.
+    :rtype: str
+    """
+    if response.ok:
+        return "ok"
+    if response.status_code == 429:
+        return "rate_limited"
+    if response.status_code < 500:
+        return "client_error"
+    return "server_error"
+
+
+def get_backoff(attempt: int) -> float:
+    """
+    Returns how long to wait before retrying, with full jitter.
+
+    :param attempt: The attempt that failed, starting at 0.
+    :type attempt: int
+    :return: The delay, in seconds.
+    :rtype: float
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def rewind_body(data, files: Dict):
+    """
+    Seeks the streamed body or files of a request back to the start, for
+    retries.
+
+    :param data: The `data` passed to `request`, if any.
+    :param files: The `files` passed to `request`, if any.
+    :type files: Dict
+    """
+    if hasattr(data, "seek"):
+        data.seek(0)
+
+    for value in (files or {}).values():
+        file = value[1] if isinstance(value, tuple) else value
+        if hasattr(file, "seek"):
+            file.seek(0)
+
+
+def get_error(response: requests.Response) -> Dict:
+    """
+    Returns the error object of a failed Graph API response.
+
+    :param response: The response.
+    :type response: requests.Response
+    :return: The error, empty if the response has none.
+    :rtype: Dict
+    """
+    try:
+        return response.json().get("error") or {}
+    except (ValueError, AttributeError):
+        return {}
+
+
+def get_error_message(response: requests.Response) -> str:
+    """
+    Returns the error message of a failed Graph API response.
+
+    :param response: The response.
+    :type response: requests.Response
+    :return: The error message, or the raw response if it has none.
+    :rtype: str
+    """
+    return get_error(response).get("message") or (
+        f"{response.status_code}: {response.text}"
+    )
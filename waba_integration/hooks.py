@@ -226,3 +226,28 @@ fixtures = [
         ],
     },
 ]
+
+scheduler_events = {
+    "all": [
+        "waba_integration.api.webhook.enqueue_pending_webhooks",
+        "waba_integration.realtime.publish_pending_updates",
+    ],
+    "hourly": [
+        "waba_integration.template_sync.sync_message_templates",
+    ],
+    "cron": {
+        "* * * * *": [
+            "waba_integration.outbox.enqueue_due_outbox_messages",
+            "waba_integration.whatsapp_business_api_integration.doctype.waba_message_status_update.waba_message_status_update.apply_unmatched_statuses",  # noqa
+        ],
+    },
+}
+
+# Old WABA Webhook Logs are deleted by Log Settings, after this many days
+default_log_clearing_doctypes = {
+    "WABA Webhook Log": 30,
+}
+
+# Metrics recorded while handling a request or job are written to Redis once
+after_request = ["waba_integration.metrics.flush"]
+after_job = ["waba_integration.metrics.flush"]
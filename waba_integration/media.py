@@ -0,0 +1,675 @@
+import base64
+import binascii
+import hashlib
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Dict, Iterable, Optional
+
+import frappe
+import requests
+from frappe.model.document import Document
+from frappe.utils import add_to_date, get_files_path, now, now_datetime
+from waba_integration import graph_api
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    CachedWABASettings,
+    get_waba_settings,
+)
+
+# Size of the chunks media is streamed in, in bytes
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Uploaded media IDs are valid for 30 days, they are reused for a bit less
+MEDIA_ID_TTL_DAYS = 29
+
+
+def download_media_file(
+    url: str,
+    file_name: str,
+    media_hash: str = None,
+    attached_to_doctype: str = None,
+    attached_to_name: str = None,
+    attached_to_field: str = None,
+) -> Dict:
+    """
+    Streams media from the Graph API into a new private File.
+
+    If media with the same `media_hash` was downloaded before, see
+    `get_indexed_file`, the File links to the existing file instead and
+    nothing is downloaded.
+
+    Otherwise the media is written to the private files directory chunk by
+    chunk while its sha256 is computed, so it is never held in memory as a
+    whole. The download is aborted, and nothing is saved, if the media is
+    larger than `Max Media Download Size` or does not match `media_hash`.
+
+    :param url: The URL of the media, as returned by the Graph API.
+    :type url: str
+    :param file_name: The name of the file.
+    :type file_name: str
+    :param media_hash: The sha256 of the media sent by Meta, hex or base64.
+    :type media_hash: str
+    :param attached_to_doctype: The DocType the File is attached to.
+    :type attached_to_doctype: str
+    :param attached_to_name: The document the File is attached to.
+    :type attached_to_name: str
+    :param attached_to_field: The field the File is attached to.
+    :type attached_to_field: str
+    :raises frappe.exceptions.ValidationError: If the media could not be
+                                               downloaded, is too large or is
+                                               corrupted.
+    :return: The File, as a dict.
+    :rtype: Dict
+    """  # noqa
+    attached_to = (attached_to_doctype, attached_to_name, attached_to_field)
+    expected_sha256 = get_sha256_hex(media_hash)
+
+    if expected_sha256 and (indexed_file := get_indexed_file(expected_sha256)):  # noqa
+        return insert_file(
+            file_name,
+            indexed_file.file_url,
+            *indexed_file.details,
+            *attached_to,
+        ).as_dict()
+
+    max_size = get_waba_settings().max_media_download_size * 1024 * 1024
+    file_name = get_unique_file_name(file_name)
+    file_path = get_files_path(file_name, is_private=True)
+    partial_path = f"{file_path}.part"
+
+    sha256, md5, file_size = hashlib.sha256(), hashlib.md5(), 0
+    response = graph_api.get(url, endpoint="media_download", stream=True)
+    with closing(response):
+        if not response.ok:
+            frappe.throw(f"Could not download the media: {response.text}")
+
+        content_length = int(response.headers.get("Content-Length") or 0)
+        if max_size and content_length > max_size:
+            throw_too_large(max_size)
+
+        try:
+            with open(partial_path, "wb") as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    file_size += len(chunk)
+                    if max_size and file_size > max_size:
+                        throw_too_large(max_size)
+
+                    sha256.update(chunk)
+                    md5.update(chunk)
+                    f.write(chunk)
+
+            if expected_sha256 and sha256.hexdigest() != expected_sha256:
+                frappe.throw(
+                    "The downloaded media does not match its hash, it may be corrupted."  # noqa
+                )
+        except BaseException:
+            os.remove(partial_path)
+            raise
+
+    os.replace(partial_path, file_path)
+    frappe.db.after_rollback.add(lambda: remove_file(file_path))
+
+    file_url = f"/private/files/{file_name}"
+    index_media(
+        sha256.hexdigest(),
+        replace_file=True,
+        file_url=file_url,
+        file_size=file_size,
+        mime_type=response.headers.get("Content-Type"),
+    )
+
+    return insert_file(
+        file_name, file_url, file_size, md5.hexdigest(), *attached_to
+    ).as_dict()
+
+
+def upload_media_file(file_url: str, mime_type: str) -> str:
+    """
+    Uploads a File to the WhatsApp Business API.
+
+    Identical content is only uploaded once: the media ID is kept in the
+    media index, see `index_media`, and reused by later uploads of the same
+    content from the same phone number until it is about to expire.
+
+    :param file_url: The URL of the File to upload.
+    :type file_url: str
+    :param mime_type: The MIME type of the file.
+    :type mime_type: str
+    :raises frappe.exceptions.ValidationError: If the upload fails.
+    :return: The media ID returned by the API.
+    :rtype: str
+    """
+    settings = get_waba_settings()
+    file_path = get_file_path(file_url)
+    sha256 = get_file_sha256(file_path)
+
+    if media_id := get_reusable_media_ids([sha256], settings).get(sha256):
+        return media_id
+
+    upload = post_media(file_path, mime_type, settings)
+    if upload.error:
+        frappe.throw(upload.error)
+
+    index_uploaded_media(sha256, file_url, mime_type, upload.media_id, settings)  # noqa
+    return upload.media_id
+
+
+def upload_media_bulk(
+    files: Dict[str, str],
+    executor: ThreadPoolExecutor = None,
+    settings: CachedWABASettings = None,
+) -> Dict[str, Dict]:
+    """
+    Uploads many Files to the WhatsApp Business API in parallel.
+
+    The files are hashed and uploaded from a bounded thread pool, at most
+    `Media Upload Concurrency` at a time if no pool is passed. Like
+    `upload_media_file`, identical content is only uploaded once, and media
+    IDs of the media index are reused. The database is only queried before
+    and after the uploads, from the current thread.
+
+    :param files: The MIME types of the Files to upload, by file URL.
+    :type files: Dict[str, str]
+    :param executor: The thread pool to upload from.
+    :type executor: ThreadPoolExecutor
+    :param settings: The WABA Settings, threads have no site context.
+    :type settings: CachedWABASettings
+    :return: The `media_id`, or the `error`, of every File by file URL.
+    :rtype: Dict[str, Dict]
+    """
+    if not files:
+        return {}
+
+    settings = settings or get_waba_settings()
+    if not executor:
+        with ThreadPoolExecutor(
+            max_workers=max(settings.media_upload_concurrency, 1)
+        ) as executor:
+            return upload_media_bulk(files, executor, settings)
+
+    uploads, file_paths, hashes = {}, {}, {}
+    for file_url in files:
+        try:
+            file_paths[file_url] = get_file_path(file_url)
+        except frappe.ValidationError as e:
+            uploads[file_url] = get_upload(error=str(e))
+            frappe.clear_last_message()
+            continue
+
+        hashes[file_url] = executor.submit(
+            get_file_sha256, file_paths[file_url]
+        )
+
+    for file_url, future in list(hashes.items()):
+        try:
+            hashes[file_url] = future.result()
+        except OSError as e:
+            uploads[file_url] = get_upload(error=str(e))
+            del hashes[file_url]
+
+    media_ids = get_reusable_media_ids(hashes.values(), settings)
+    futures = {}
+    for file_url, sha256 in hashes.items():
+        if sha256 not in media_ids and sha256 not in futures:
+            futures[sha256] = (
+                file_url,
+                executor.submit(
+                    post_media, file_paths[file_url], files[file_url], settings  # noqa
+                ),
+            )
+
+    uploads_by_hash = {
+        sha256: get_upload(media_id=media_id)
+        for sha256, media_id in media_ids.items()
+    }
+    for sha256, (file_url, future) in futures.items():
+        uploads_by_hash[sha256] = upload = future.result()
+        if upload.media_id:
+            index_uploaded_media(
+                sha256, file_url, files[file_url], upload.media_id, settings
+            )
+
+    for file_url, sha256 in hashes.items():
+        uploads[file_url] = uploads_by_hash[sha256]
+
+    return uploads
+
+
+def post_media(
+    file_path: str, mime_type: str, settings: CachedWABASettings
+) -> Dict:
+    """
+    Posts a file to the `/media` endpoint of the Graph API.
+
+    The multipart body is streamed from the disk, see `MultipartFileStream`,
+    and the file is closed once the request is done. Runs in the threads of
+    `upload_media_bulk`, so it must not touch the database.
+
+    :param file_path: The path of the file.
+    :type file_path: str
+    :param mime_type: The MIME type of the file.
+    :type mime_type: str
+    :param settings: The WABA Settings.
+    :type settings: CachedWABASettings
+    :return: The upload, see `get_upload`.
+    :rtype: Dict
+    """
+    try:
+        with MultipartFileStream(
+            file_path,
+            mime_type,
+            {"messaging_product": "whatsapp", "type": mime_type},
+        ) as body:
+            response = graph_api.post(
+                f"{settings.phone_number_id}/media",
+                settings=settings,
+                endpoint="media_upload",
+                data=body,
+                headers={"Content-Type": body.content_type},
+            )
+    except (OSError, requests.RequestException) as e:
+        return get_upload(error=str(e))
+
+    if not response.ok:
+        return get_upload(error=graph_api.get_error_message(response))
+
+    return get_upload(media_id=response.json().get("id"))
+
+
+def get_upload(media_id: str = None, error: str = None) -> Dict:
+    """
+    Returns the outcome of the upload of a file.
+
+    :param media_id: The media ID returned by the Graph API, if uploaded.
+    :type media_id: str
+    :param error: Why the file could not be uploaded.
+    :type error: str
+    :return: The outcome.
+    :rtype: Dict
+    """
+    return frappe._dict(media_id=media_id, error=error)
+
+
+def get_reusable_media_ids(
+    hashes: Iterable[str], settings: CachedWABASettings
+) -> Dict[str, str]:
+    """
+    Returns the media IDs of the media index that can still be sent.
+
+    :param hashes: The sha256 of the media, hex encoded.
+    :type hashes: Iterable[str]
+    :param settings: The WABA Settings.
+    :type settings: CachedWABASettings
+    :return: The media IDs uploaded from the phone number that have not
+             expired, by sha256.
+    :rtype: Dict[str, str]
+    """
+    if not (hashes := list(set(hashes))):
+        return {}
+
+    return dict(
+        frappe.get_all(
+            "WABA Media",
+            filters={
+                "name": ("in", hashes),
+                "media_id": ("is", "set"),
+                "phone_number_id": settings.phone_number_id,
+                "media_id_expires_at": (">", now_datetime()),
+            },
+            fields=["name", "media_id"],
+            as_list=True,
+        )
+    )
+
+
+def index_uploaded_media(
+    sha256: str,
+    file_url: str,
+    mime_type: str,
+    media_id: str,
+    settings: CachedWABASettings,
+):
+    """
+    Keeps the media ID of an uploaded file in the media index.
+
+    :param sha256: The sha256 of the file, hex encoded.
+    :type sha256: str
+    :param file_url: The URL of the File.
+    :type file_url: str
+    :param mime_type: The MIME type of the file.
+    :type mime_type: str
+    :param media_id: The media ID returned by the Graph API.
+    :type media_id: str
+    :param settings: The WABA Settings.
+    :type settings: CachedWABASettings
+    """
+    index_media(
+        sha256,
+        file_url=file_url,
+        file_size=os.path.getsize(get_file_path(file_url)),
+        mime_type=mime_type,
+        media_id=media_id,
+        phone_number_id=settings.phone_number_id,
+        media_id_expires_at=add_to_date(None, days=MEDIA_ID_TTL_DAYS),
+    )
+
+
+def index_media(sha256: str, replace_file: bool = False, **values):
+    """
+    Adds media to the media index (WABA Media), or updates it.
+
+    The index is keyed by the sha256 of the content, and written with an
+    insert that ignores duplicates, so concurrent workers never conflict.
+
+    :param sha256: The sha256 of the media, hex encoded.
+    :type sha256: str
+    :param replace_file: Whether the file of media already in the index is
+                         replaced, e.g. when it was deleted from the disk.
+    :type replace_file: bool
+    :param values: The `file_url`, `file_size`, `mime_type`, `media_id`,
+                   `phone_number_id` and `media_id_expires_at` to set, None
+                   values are left as they are.
+    """
+    values = {field: value for field, value in values.items() if value}
+    if frappe.db.exists("WABA Media", sha256):
+        if not replace_file:
+            values.pop("file_url", None)
+            values.pop("file_size", None)
+
+        if values:
+            frappe.db.set_value("WABA Media", sha256, values)
+        return
+
+    timestamp = now()
+    user = frappe.session.user
+    fields = ("name", "sha256", "creation", "modified", "owner", "modified_by")
+    frappe.db.bulk_insert(
+        "WABA Media",
+        fields + tuple(values),
+        [(sha256, sha256, timestamp, timestamp, user, user) + tuple(values.values())],  # noqa
+        ignore_duplicates=True,
+    )
+
+
+def get_indexed_file(sha256: str) -> Optional[Dict]:
+    """
+    Returns the private file of the media index with the given content.
+
+    Files deleted from the disk, or that are public, are ignored, so that a
+    download never links to a file it should not be able to see.
+
+    :param sha256: The sha256 of the media, hex encoded.
+    :type sha256: str
+    :return: The `file_url` and `details` (size and md5) of the file, if any.
+    :rtype: Optional[Dict]
+    """
+    file_url = frappe.db.get_value("WABA Media", sha256, "file_url")
+    if not file_url or not file_url.startswith("/private/files/"):
+        return None
+
+    file = frappe.db.get_value(
+        "File",
+        {"file_url": file_url},
+        ["file_size", "content_hash"],
+        as_dict=True,
+    )
+    if not file or not os.path.exists(frappe.get_site_path(file_url.lstrip("/"))):  # noqa
+        return None
+
+    return frappe._dict(
+        file_url=file_url, details=(file.file_size, file.content_hash)
+    )
+
+
+def insert_file(
+    file_name: str,
+    file_url: str,
+    file_size: int,
+    content_hash: str,
+    attached_to_doctype: str = None,
+    attached_to_name: str = None,
+    attached_to_field: str = None,
+) -> Document:
+    """
+    Inserts the File record of a private file already written to disk.
+
+    The record is inserted directly, because the hooks of File read the
+    whole file back into memory to hash it, which is done while streaming.
+    Records sharing a file have the same `content_hash`, so the file is
+    only deleted with the last of them.
+
+    :param file_name: The name of the file.
+    :type file_name: str
+    :param file_url: The URL of the file in the private files directory.
+    :type file_url: str
+    :param file_size: The size of the file, in bytes.
+    :type file_size: int
+    :param content_hash: The md5 of the file, as computed by Frappe.
+    :type content_hash: str
+    :return: The File.
+    :rtype: Document
+    """
+    timestamp = now()
+    file_doc = frappe.get_doc(
+        {
+            "doctype": "File",
+            "name": frappe.generate_hash(length=10),
+            "file_name": file_name,
+            "file_url": file_url,
+            "file_size": file_size,
+            "file_type": os.path.splitext(file_name)[1].lstrip(".").upper(),
+            "content_hash": content_hash,
+            "is_private": 1,
+            "folder": "Home/Attachments",
+            "attached_to_doctype": attached_to_doctype,
+            "attached_to_name": attached_to_name,
+            "attached_to_field": attached_to_field,
+            "owner": frappe.session.user,
+            "modified_by": frappe.session.user,
+            "creation": timestamp,
+            "modified": timestamp,
+        }
+    )
+    file_doc.db_insert()
+
+    return file_doc
+
+
+def get_unique_file_name(file_name: str) -> str:
+    """
+    Returns a file name that is not taken in the private files directory.
+
+    :param file_name: The wanted file name.
+    :type file_name: str
+    :return: The file name, with a random suffix if it is taken.
+    :rtype: str
+    """
+    file_name = os.path.basename(file_name or "attachment").replace("/", "")
+    if not os.path.exists(get_files_path(file_name, is_private=True)):
+        return file_name
+
+    stem, extension = os.path.splitext(file_name)
+    return f"{stem}{frappe.generate_hash(length=6)}{extension}"
+
+
+def get_file_path(file_url: str) -> str:
+    """
+    Returns the path of a local file from its URL.
+
+    :param file_url: The URL of the file, public or private.
+    :type file_url: str
+    :raises frappe.exceptions.ValidationError: If the file is not local.
+    :return: The path of the file.
+    :rtype: str
+    """
+    if file_url and file_url.startswith("/private/files/"):
+        return frappe.get_site_path(file_url.lstrip("/"))
+
+    if file_url and file_url.startswith("/files/"):
+        return frappe.get_site_path("public", file_url.lstrip("/"))
+
+    frappe.throw(f"`{file_url}` is not a file of this site.")
+
+
+def get_file_sha256(file_path: str) -> str:
+    """
+    Returns the sha256 of a file, read in chunks.
+
+    :param file_path: The path of the file.
+    :type file_path: str
+    :return: The sha256, hex encoded.
+    :rtype: str
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def get_sha256_hex(media_hash: str) -> Optional[str]:
+    """
+    Normalizes a sha256 sent by Meta to hex.
+
+    Webhooks send the hash base64 encoded, the media endpoint hex encoded.
+
+    :param media_hash: The hash sent by Meta.
+    :type media_hash: str
+    :return: The sha256, hex encoded, or None if it is not a valid sha256.
+    :rtype: Optional[str]
+    """
+    if not media_hash:
+        return None
+
+    if len(media_hash) == 64:
+        return media_hash.lower()
+
+    try:
+        digest = base64.b64decode(media_hash, validate=True)
+    except binascii.Error:
+        return None
+
+    return digest.hex() if len(digest) == 32 else None
+
+
+def throw_too_large(max_size: int):
+    """
+    Aborts a download larger than `Max Media Download Size`.
+
+    :param max_size: The maximum size, in bytes.
+    :type max_size: int
+    :raises frappe.exceptions.ValidationError: Always.
+    """
+    frappe.throw(
+        f"The media is larger than the maximum download size of {max_size // (1024 * 1024)} MB."  # noqa
+    )
+
+
+def remove_file(file_path: str):
+    """
+    Removes a downloaded file whose File record was rolled back.
+
+    :param file_path: The path of the file.
+    :type file_path: str
+    """
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+class MultipartFileStream:
+    """
+    A `multipart/form-data` body with one file, read from the disk in chunks.
+
+    Passed as `data` to `requests`, which sends it with its `Content-Length`
+    while reading it, so the file is never held in memory as a whole. The
+    file is opened on the first read, rewound by `seek(0)` for retries and
+    closed on exit.
+    """
+
+    def __init__(self, file_path: str, mime_type: str, fields: Dict[str, str]):  # noqa
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self.file_path = file_path
+        self.file = None
+
+        head = "".join(
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n"
+            for name, value in fields.items()
+        )
+        head += (
+            f"--{boundary}\r\n"
+            'Content-Disposition: form-data; name="file"; filename="file"\r\n'
+            f"Content-Type: {mime_type}\r\n\r\n"
+        )
+        self.head = head.encode()
+        self.tail = f"\r\n--{boundary}--\r\n".encode()
+        self.length = (
+            len(self.head) + os.path.getsize(file_path) + len(self.tail)
+        )
+        self.seek(0)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self):
+        while chunk := self.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads the next part of the body.
+
+        :param size: The maximum number of bytes to read, all if negative.
+        :type size: int
+        :return: The bytes read, empty at the end of the body.
+        :rtype: bytes
+        """
+        if size is None or size < 0:
+            size = self.length
+
+        chunk = b""
+        while len(chunk) < size and self.part < 3:
+            if self.part == 1:
+                if not self.file:
+                    self.file = open(self.file_path, "rb")
+                data = self.file.read(size - len(chunk))
+            else:
+                data = (self.head, None, self.tail)[self.part][self.offset : self.offset + size - len(chunk)]  # noqa
+                self.offset += len(data)
+
+            if not data:
+                self.part, self.offset = self.part + 1, 0
+            chunk += data
+
+        return chunk
+
+    def seek(self, offset: int, whence: int = 0):
+        """
+        Rewinds the body to the start, only `seek(0)` is supported.
+
+        :param offset: Must be 0.
+        :type offset: int
+        """
+        if offset or whence:
+            raise OSError("MultipartFileStream can only be rewound.")
+
+        self.part, self.offset = 0, 0
+        if self.file:
+            self.file.seek(0)
+
+    def close(self):
+        """Closes the file."""
+        if self.file:
+            self.file.close()
+            self.file = None
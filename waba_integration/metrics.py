@@ -0,0 +1,227 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict
+
+import frappe
+from frappe.utils import cstr
+
+# Metrics exposed by `get_prometheus_text`, name -> (type, help)
+METRICS = {
+    "waba_graph_requests_total": (
+        "counter",
+        "Graph API requests, by endpoint and outcome.",
+    ),
+    "waba_graph_request_duration_seconds": (
+        "histogram",
+        "Time until the Graph API responded, retries included.",
+    ),
+    "waba_webhook_events_total": (
+        "counter",
+        "Webhook messages and statuses, by type and outcome.",
+    ),
+    "waba_webhook_stage_duration_seconds": (
+        "histogram",
+        "Time spent in each stage of processing a webhook, by outcome.",
+    ),
+}
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Redis hash of the metrics of the site, series -> value
+METRICS_CACHE_KEY = "waba_metrics"
+
+# Metrics recorded by this process and not flushed to Redis yet, by site, see
+# `flush`. Graph API calls are also made from thread pools, which have no
+# site context, so they can not be written to Redis right away.
+_pending: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+_pending_lock = threading.Lock()
+
+# Sites whose metrics are not recorded for now, see `disabled`
+_disabled_sites = set()
+
+
+def increment(metric: str, value: float = 1, site: str = None, **labels):
+    """
+    Increments a counter.
+
+    :param metric: The name of the counter, see `METRICS`.
+    :type metric: str
+    :param value: The increment.
+    :type value: float
+    :param site: The site, must be passed where there is no site context.
+    :type site: str
+    :param labels: The labels of the series, e.g. `endpoint="send"`.
+    """
+    record({get_series(metric, labels): value}, site)
+
+
+def observe(metric: str, seconds: float, site: str = None, **labels):
+    """
+    Records a duration in a histogram.
+
+    :param metric: The name of the histogram, see `METRICS`.
+    :type metric: str
+    :param seconds: The duration.
+    :type seconds: float
+    :param site: The site, must be passed where there is no site context.
+    :type site: str
+    :param labels: The labels of the series, e.g. `stage="parse"`.
+    """
+    series = {
+        get_series(f"{metric}_count", labels): 1,
+        get_series(f"{metric}_sum", labels): seconds,
+        get_series(f"{metric}_bucket", {**labels, "le": "+Inf"}): 1,
+    }
+    for bucket in LATENCY_BUCKETS:
+        if seconds <= bucket:
+            series[get_series(f"{metric}_bucket", {**labels, "le": bucket})] = 1  # noqa
+
+    record(series, site)
+
+
+def record(series: Dict[str, float], site: str = None):
+    """
+    Adds values to the pending metrics of a site.
+
+    Metrics recorded without a site, or while they are disabled for the
+    site, are dropped.
+
+    :param series: The values to add, by series.
+    :type series: Dict[str, float]
+    :param site: The site, that of the current context if not passed.
+    :type site: str
+    """
+    site = site or getattr(frappe.local, "site", None)
+    if not site or site in _disabled_sites:
+        return
+
+    with _pending_lock:
+        pending = _pending[site]
+        for key, value in series.items():
+            pending[key] += value
+
+
+@contextmanager
+def measure(metric: str, **labels):
+    """
+    Records how long the block takes in a histogram, with its `outcome`.
+
+    The outcome is `ok`, or `error` if the block raised.
+
+    :param metric: The name of the histogram, see `METRICS`.
+    :type metric: str
+    :param labels: The labels of the series, e.g. `stage="parse"`.
+    """
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        observe(metric, time.perf_counter() - start, outcome=outcome, **labels)
+
+
+@contextmanager
+def disabled():
+    """
+    Stops recording the metrics of the current site while the block runs,
+    e.g. while benchmarking against a fake Graph API.
+    """
+    site = frappe.local.site
+    _disabled_sites.add(site)
+    try:
+        yield
+    finally:
+        _disabled_sites.discard(site)
+
+
+def flush():
+    """
+    Adds the metrics recorded by this process for the current site to the
+    ones of the site.
+
+    Called after every request and background job, so that a single Redis
+    round trip is made however many metrics were recorded.
+    """
+    if not getattr(frappe.local, "site", None):
+        return
+
+    with _pending_lock:
+        pending = _pending.pop(frappe.local.site, None)
+
+    if not pending:
+        return
+
+    cache = frappe.cache()
+    key = cache.make_key(METRICS_CACHE_KEY)
+    pipeline = cache.pipeline()
+    for series, value in pending.items():
+        pipeline.hincrbyfloat(key, series, value)
+    pipeline.execute()
+
+
+def get_prometheus_text() -> str:
+    """
+    Returns the metrics of the site in the Prometheus text format.
+
+    :return: The metrics, with their `HELP` and `TYPE`.
+    :rtype: str
+    """
+    cache = frappe.cache()
+    values = cache.pipeline().hgetall(cache.make_key(METRICS_CACHE_KEY)).execute()[0]  # noqa
+
+    series_by_metric = defaultdict(list)
+    for series, value in values.items():
+        series = cstr(series)
+        name = series.split("{", 1)[0]
+        for suffix in ("_bucket", "_sum", "_count"):
+            if name.endswith(suffix) and name[: -len(suffix)] in METRICS:
+                name = name[: -len(suffix)]
+        series_by_metric[name].append(f"{series} {format_value(value)}")
+
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(sorted(series_by_metric.get(name, [])))
+
+    return "\n".join(lines) + "\n"
+
+
+def get_series(metric: str, labels: Dict) -> str:
+    """
+    Returns the name of a series, e.g. `metric{endpoint="send"}`.
+
+    :param metric: The name of the metric.
+    :type metric: str
+    :param labels: The labels of the series.
+    :type labels: Dict
+    :return: The series, as written in the Prometheus text format.
+    :rtype: str
+    """
+    if not labels:
+        return metric
+
+    return "{}{{{}}}".format(
+        metric,
+        ",".join(
+            '{}="{}"'.format(
+                label,
+                cstr(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for label, value in sorted(labels.items())
+        ),
+    )
+
+
+def format_value(value) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
@@ -0,0 +1,300 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import frappe
+from frappe.utils import add_to_date, now, now_datetime
+from waba_integration.async_graph_api import AsyncGraphClient
+from waba_integration.dispatch import (
+    save_send_results,
+    send_chunk,
+    send_chunk_async,
+)
+from waba_integration.graph_api import BACKOFF_MAX
+from waba_integration.rate_limit import (
+    get_pause_remaining,
+    return_tokens,
+    wait_for_tokens,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_bulk_send.waba_bulk_send import (  # noqa
+    update_bulk_send_progress,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    CachedWABASettings,
+    get_waba_settings,
+)
+
+# Maximum number of messages claimed, sent and saved together
+SEND_CHUNK_SIZE = 100
+
+# Claimed messages are not handed out again before their lease expires,
+# unless sent. If the worker sending them dies, they are attempted again once
+# it does. The lease covers the slowest a chunk can be sent in, see
+# `get_claim_lease`, plus this margin, in seconds.
+CLAIM_LEASE_MARGIN = 60
+
+
+def add_to_outbox(message_names: List[str]):
+    """
+    Queues WABA WhatsApp Messages in the outbox, and wakes its worker up.
+
+    :param message_names: The names of the `Pending` messages to send.
+    :type message_names: List[str]
+    """
+    if not message_names:
+        return
+
+    frappe.db.sql(
+        """
+        update `tabWABA WhatsApp Message`
+        set in_outbox = 1, next_attempt_at = null, modified = %(modified)s
+        where name in %(message_names)s and status = 'Pending'
+        """,
+        {"modified": now(), "message_names": tuple(message_names)},
+    )
+    enqueue_outbox_worker()
+
+
+def enqueue_outbox_worker(bulk_send: str = None):
+    """
+    Enqueues a worker that sends the messages in the outbox.
+
+    :param bulk_send: Only send the messages of this WABA Bulk Send.
+    :type bulk_send: str
+    """
+    frappe.enqueue(
+        "waba_integration.outbox.drain_outbox",
+        queue="long",
+        job_id=f"waba_outbox_{bulk_send}" if bulk_send else "waba_outbox",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        bulk_send=bulk_send,
+    )
+
+
+def drain_outbox(bulk_send: str = None):
+    """
+    Background job that sends the messages in the outbox that are due.
+
+    Messages are sent in chunks, at the rate allowed by the token bucket of
+    the phone number (`Messages Per Second`). The job stops when the outbox
+    is empty or when Meta rate limits the phone number; the scheduler picks
+    up what is left once the pause is over.
+
+    The requests of a chunk are posted from a thread pool, or as a single
+    batch of the async Graph client if `Use Async Graph Client` is set.
+
+    :param bulk_send: Only send the messages of this WABA Bulk Send.
+    :type bulk_send: str
+    """
+    settings = get_waba_settings()
+
+    if settings.use_async_graph_client:
+        with AsyncGraphClient(settings) as client:
+            send_outbox_chunks(
+                lambda messages: send_chunk_async(messages, client, settings),
+                settings,
+                bulk_send,
+            )
+        return
+
+    with ThreadPoolExecutor(
+        max_workers=max(settings.bulk_send_concurrency, 1)
+    ) as executor:
+        send_outbox_chunks(
+            lambda messages: send_chunk(messages, executor, settings),
+            settings,
+            bulk_send,
+        )
+
+
+def send_outbox_chunks(
+    send: Callable[[List[Dict]], Dict[str, Dict]],
+    settings: CachedWABASettings,
+    bulk_send: str = None,
+):
+    """
+    Claims, sends and saves chunks of the outbox until it is drained.
+
+    :param send: Sends a chunk of messages, see `send_chunk` and
+                 `send_chunk_async`.
+    :type send: Callable[[List[Dict]], Dict[str, Dict]]
+    :param settings: The WABA Settings.
+    :type settings: CachedWABASettings
+    :param bulk_send: Only send the messages of this WABA Bulk Send.
+    :type bulk_send: str
+    """
+    while not get_pause_remaining(settings.phone_number_id):
+        tokens = wait_for_tokens(
+            settings.phone_number_id,
+            SEND_CHUNK_SIZE,
+            settings.messages_per_second,
+        )
+        messages = claim_outbox_messages(tokens, settings, bulk_send)
+
+        # Fewer messages were due than tokens taken
+        return_tokens(
+            settings.phone_number_id,
+            tokens - len(messages),
+            settings.messages_per_second,
+        )
+        if not messages:
+            break
+
+        save_send_results(
+            get_claimed_results(send(messages), messages[0].claim_token)
+        )
+        frappe.db.commit()
+
+        for name in {message.bulk_send for message in messages} - {None}:
+            update_bulk_send_progress(name)
+
+
+def claim_outbox_messages(
+    limit: int, settings: CachedWABASettings, bulk_send: str = None
+) -> List[Dict]:
+    """
+    Claims the oldest messages of the outbox that are due.
+
+    Claimed messages get a lease by moving their next attempt forward, see
+    `get_claim_lease`, and rows locked by another worker are skipped, so
+    that a message is never sent by two workers at the same time. They also
+    get a claim token, only the results of messages still holding it are
+    saved, see `get_claimed_results`.
+
+    :param limit: The maximum number of messages to claim.
+    :type limit: int
+    :param settings: The WABA Settings.
+    :type settings: CachedWABASettings
+    :param bulk_send: Only claim the messages of this WABA Bulk Send.
+    :type bulk_send: str
+    :return: The claimed WABA WhatsApp Messages, as dicts.
+    :rtype: List[Dict]
+    """
+    values = {
+        "limit": limit,
+        "now": now_datetime(),
+        "bulk_send": bulk_send,
+        "lease": add_to_date(None, seconds=get_claim_lease(limit, settings)),
+        "claim_token": frappe.generate_hash(),
+    }
+    message_names = frappe.db.sql(
+        f"""
+        select name from `tabWABA WhatsApp Message`
+        where
+            in_outbox = 1
+            and status = 'Pending'
+            and (next_attempt_at is null or next_attempt_at <= %(now)s)
+            {"and bulk_send = %(bulk_send)s" if bulk_send else ""}
+        order by creation
+        limit %(limit)s
+        for update skip locked
+        """,
+        values,
+        pluck=True,
+    )
+
+    if message_names:
+        values["message_names"] = tuple(message_names)
+        frappe.db.sql(
+            """
+            update `tabWABA WhatsApp Message`
+            set next_attempt_at = %(lease)s, claim_token = %(claim_token)s
+            where name in %(message_names)s
+            """,
+            values,
+        )
+
+    frappe.db.commit()
+
+    if not message_names:
+        return []
+
+    return frappe.get_all(
+        "WABA WhatsApp Message",
+        filters={"name": ("in", message_names)},
+        fields=["*"],
+        order_by="creation asc",
+    )
+
+
+def get_claim_lease(count: int, settings: CachedWABASettings) -> float:
+    """
+    Returns how long claimed messages are leased for.
+
+    That is the slowest a chunk can be sent in: every attachment uploaded
+    and every message posted times out on every attempt, waiting the longest
+    backoff in between, as many times as the concurrency requires.
+
+    :param count: The number of messages claimed.
+    :type count: int
+    :param settings: The WABA Settings.
+    :type settings: CachedWABASettings
+    :return: The lease, in seconds.
+    :rtype: float
+    """
+    concurrency = (
+        settings.async_concurrency
+        if settings.use_async_graph_client
+        else settings.bulk_send_concurrency
+    )
+    rounds = math.ceil(count / max(settings.media_upload_concurrency, 1))
+    rounds += math.ceil(count / max(concurrency, 1))
+    request_time = (settings.max_retries + 1) * (
+        settings.connect_timeout + settings.read_timeout + BACKOFF_MAX
+    )
+    return CLAIM_LEASE_MARGIN + rounds * request_time
+
+
+def get_claimed_results(
+    results: Dict[str, Dict], claim_token: str
+) -> Dict[str, Dict]:
+    """
+    Drops the results of the messages no longer claimed with a token.
+
+    Should sending a chunk outlast its lease, its messages may have been
+    claimed by another worker since, whose results must not be overwritten.
+    The rows still claimed are locked until the results are committed, and
+    their claim token is cleared with them.
+
+    :param results: The fields to update on every message by name.
+    :type results: Dict[str, Dict]
+    :param claim_token: The token the messages were claimed with.
+    :type claim_token: str
+    :return: The results of the messages still claimed with the token.
+    :rtype: Dict[str, Dict]
+    """
+    if not results:
+        return {}
+
+    claimed = frappe.db.sql(
+        """
+        select name from `tabWABA WhatsApp Message`
+        where name in %(message_names)s and claim_token = %(claim_token)s
+        for update
+        """,
+        {"message_names": tuple(results), "claim_token": claim_token},
+        pluck=True,
+    )
+    return {
+        name: {**results[name], "claim_token": None} for name in claimed
+    }
+
+
+def enqueue_due_outbox_messages():
+    """Scheduled job that enqueues the outbox worker if messages are due."""
+    if not get_waba_settings().enabled:
+        return
+
+    if frappe.db.exists(
+        "WABA WhatsApp Message",
+        {
+            "in_outbox": 1,
+            "status": "Pending",
+            "next_attempt_at": ("<=", now_datetime()),
+        },
+    ) or frappe.db.exists(
+        "WABA WhatsApp Message",
+        {"in_outbox": 1, "status": "Pending", "next_attempt_at": ("is", "not set")},  # noqa
+    ):
+        enqueue_outbox_worker()
@@ -1,3 +1,5 @@
+from typing import List
+
 import frappe
 
 from frappe.email.doctype.notification.notification import (  # noqa  # isort:skip
@@ -6,9 +8,16 @@ from frappe.email.doctype.notification.notification import (  # noqa  # isort:sk
     json,
 )
 
+from waba_integration.whatsapp_business_api_integration.doctype.waba_bulk_send.waba_bulk_send import (  # noqa  # isort:skip
+    create_bulk_send,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_contact.waba_whatsapp_contact import (  # noqa  # isort:skip
+    resolve_waba_whatsapp_contacts,
+)
 from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_message.waba_whatsapp_message import (  # noqa  # isort:skip
-    WABAWhatsAppMessage,
+    create_reference_pdf,
 )
+from waba_integration.media import upload_media_file  # isort:skip
 
 
 class SendNotification(Notification):
@@ -40,48 +49,78 @@ class SendNotification(Notification):
         """
         Sends a WhatsApp message via the WhatsApp Business API.
 
-        This method retrieves a list of receivers and sends a message to each receiver.
-        It checks if the receiver exists as a WABA WhatsApp Contact and creates one if necessary.
-        It then creates a WABA WhatsApp Message document with the message details and sends it.
+        The receivers and the message are resolved and rendered once, here, while
+        the rest is enqueued to run after the transaction that triggered the
+        notification is committed, so that saving the document never waits for
+        the Graph API. See `send_whatsapp_notification`.
 
         :param doc: The document triggering the notification.
         :param context: The context used for rendering the message template.
         """  # noqa
-        receiver_list = self.get_receiver_list(doc, context)
-        message = frappe.render_template(self.message, context)
-        doctype = doc.doctype
-        docname = doc.name
-
-        for receiver in receiver_list:
-            # Create new WABA Contact if not available
-            if not frappe.db.exists(
-                "WABA WhatsApp Contact", {"name": receiver}
-            ):  # noqa
-                frappe.get_doc(
-                    {
-                        "doctype": "WABA WhatsApp Contact",
-                        "whatsapp_id": receiver,
-                        "display_name": frappe.db.get_value(
-                            "User", {"mobile_no": receiver}, "full_name"
-                        ),
-                    }
-                ).insert(ignore_permissions=True)
-
-            wa_message: WABAWhatsAppMessage = frappe.get_doc(
-                {
-                    "doctype": "WABA WhatsApp Message",
-                    "to": receiver,
-                    "message_body": message,
-                    "document_type": doctype,
-                    "document_name": docname,
-                    "attach_print": self.attach_print,
-                    "print_format": self.print_format,
-                    "message_type": "Template"
-                    if self.waba_whatsapp_message_template
-                    else "Text",
-                    "message_template": self.waba_whatsapp_message_template,
-                }
+        receivers = list(
+            dict.fromkeys(
+                receiver.strip()
+                for receiver in self.get_receiver_list(doc, context)
+                if receiver and receiver.strip()
             )
+        )
+        if not receivers:
+            return
+
+        frappe.enqueue(
+            "waba_integration.overrides.notification.send_whatsapp_notification",  # noqa
+            queue="short",
+            enqueue_after_commit=True,
+            receivers=receivers,
+            message_body=frappe.render_template(self.message, context),
+            message_type="Template"
+            if self.waba_whatsapp_message_template
+            else "Text",
+            message_template=self.waba_whatsapp_message_template,
+            document_type=doc.doctype,
+            document_name=doc.name,
+            attach_print=self.attach_print,
+            print_format=self.print_format,
+        )
+
+
+def send_whatsapp_notification(receivers: List[str], **message):
+    """
+    Background job that sends a WhatsApp notification to its receivers.
+
+    The missing WABA WhatsApp Contacts are created at once, named after the
+    Users with the same mobile number, and the messages are sent through a
+    WABA Bulk Send, so that they go through the rate limited outbox. If the
+    print of the document is attached, it is rendered and uploaded once and
+    shared by all the messages.
+
+    :param receivers: The WhatsApp IDs to send the notification to.
+    :type receivers: List[str]
+    :param message: The fields of the message, see `create_bulk_send`.
+    """
+    display_names = dict(
+        frappe.get_all(
+            "User",
+            filters={"mobile_no": ("in", receivers)},
+            fields=["mobile_no", "full_name"],
+            as_list=True,
+        )
+    )
+    resolve_waba_whatsapp_contacts(receivers, display_names)
+
+    if message.get("attach_print"):
+        pdf_attachment = create_reference_pdf(
+            message["document_type"],
+            message["document_name"],
+            message.get("print_format"),
+        )
+        message.update(
+            media_file=pdf_attachment.file_url,
+            media_mime_type="application/pdf",
+            media_id=upload_media_file(
+                pdf_attachment.file_url, "application/pdf"
+            ),
+            media_uploaded=1,
+        )
 
-            wa_message.insert(ignore_permissions=True)
-            wa_message.send()
+    create_bulk_send(receivers, **message)
@@ -0,0 +1,42 @@
+import frappe
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_contact.waba_whatsapp_contact import (  # noqa
+    update_inbox_summaries,
+)
+
+# Number of messages read at a time
+CHUNK_SIZE = 10_000
+
+
+def execute():
+    """Builds the inbox summaries of the contacts from their messages."""
+    frappe.db.sql(
+        """
+        update `tabWABA WhatsApp Contact`
+        set
+            last_message = null,
+            last_message_type = null,
+            last_message_status = null,
+            last_message_preview = null,
+            last_message_at = null,
+            unread_count = 0
+        """
+    )
+
+    last_creation, last_name = "1900-01-01 00:00:00", ""
+    while messages := frappe.db.sql(
+        """
+        select
+            name, creation, type, `from`, `to`, status, message_type,
+            message_body, media_caption
+        from `tabWABA WhatsApp Message`
+        where
+            creation >= %(creation)s
+            and (creation > %(creation)s or name > %(name)s)
+        order by creation asc, name asc
+        limit %(limit)s
+        """,
+        {"creation": last_creation, "name": last_name, "limit": CHUNK_SIZE},
+        as_dict=True,
+    ):
+        update_inbox_summaries(messages)
+        last_creation, last_name = messages[-1].creation, messages[-1].name
@@ -0,0 +1,142 @@
+import time
+
+import frappe
+from frappe.utils import flt
+
+# Refills the bucket for the time elapsed since it was last used, then takes
+# as many of the requested tokens as are available. Runs atomically in Redis,
+# so the rate is shared by all the workers sending from a phone number.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+
+tokens = math.min(capacity, tokens + math.max(now - updated_at, 0) * rate)
+local taken = math.min(requested, math.floor(tokens))
+
+redis.call("HSET", KEYS[1], "tokens", tokens - taken, "updated_at", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return taken
+"""
+
+# Puts tokens that were taken but not used back in the bucket, without going
+# over its capacity
+RETURN_TOKENS_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local returned = tonumber(ARGV[2])
+
+local tokens = tonumber(redis.call("HGET", KEYS[1], "tokens"))
+if tokens then
+    tokens = math.min(capacity, tokens + returned)
+    redis.call("HSET", KEYS[1], "tokens", tokens)
+end
+"""
+
+
+def take_tokens(phone_number_id: str, tokens: int, rate: int) -> int:
+    """
+    Takes up to `tokens` tokens from the token bucket of a phone number.
+
+    The bucket refills at `rate` tokens per second and holds at most one
+    second worth of tokens, which allows short bursts at the full rate.
+
+    :param phone_number_id: The phone number the messages are sent from.
+    :type phone_number_id: str
+    :param tokens: The number of tokens wanted.
+    :type tokens: int
+    :param rate: The number of messages per second allowed.
+    :type rate: int
+    :return: The number of tokens taken, may be less than wanted or zero.
+    :rtype: int
+    """
+    rate = max(rate, 1)
+    return int(
+        frappe.cache().eval(
+            TOKEN_BUCKET_SCRIPT,
+            1,
+            frappe.cache().make_key(f"waba_token_bucket:{phone_number_id}"),
+            rate,
+            rate,
+            time.time(),
+            tokens,
+        )
+    )
+
+
+def wait_for_tokens(phone_number_id: str, tokens: int, rate: int) -> int:
+    """
+    Waits until at least one token can be taken, then takes up to `tokens`.
+
+    :param phone_number_id: The phone number the messages are sent from.
+    :type phone_number_id: str
+    :param tokens: The number of tokens wanted.
+    :type tokens: int
+    :param rate: The number of messages per second allowed.
+    :type rate: int
+    :return: The number of tokens taken, at least one.
+    :rtype: int
+    """
+    while not (taken := take_tokens(phone_number_id, tokens, rate)):
+        time.sleep(1 / max(rate, 1))
+
+    return taken
+
+
+def return_tokens(phone_number_id: str, tokens: int, rate: int):
+    """
+    Puts tokens back in the token bucket of a phone number, for messages
+    that were not sent after all, see `take_tokens`.
+
+    :param phone_number_id: The phone number the messages are sent from.
+    :type phone_number_id: str
+    :param tokens: The number of tokens not used.
+    :type tokens: int
+    :param rate: The number of messages per second allowed.
+    :type rate: int
+    """
+    if tokens <= 0:
+        return
+
+    frappe.cache().eval(
+        RETURN_TOKENS_SCRIPT,
+        1,
+        frappe.cache().make_key(f"waba_token_bucket:{phone_number_id}"),
+        max(rate, 1),
+        tokens,
+    )
+
+
+def pause_sending(phone_number_id: str, seconds: int):
+    """
+    Stops sending from a phone number for a while, after being rate limited.
+
+    :param phone_number_id: The phone number that was rate limited.
+    :type phone_number_id: str
+    :param seconds: How long to stop sending for.
+    :type seconds: int
+    """
+    frappe.cache().setex(
+        frappe.cache().make_key(f"waba_sending_paused:{phone_number_id}"),
+        max(int(seconds), 1),
+        time.time() + seconds,
+    )
+
+
+def get_pause_remaining(phone_number_id: str) -> float:
+    """
+    Returns for how long sending from a phone number is still paused.
+
+    :param phone_number_id: The phone number the messages are sent from.
+    :type phone_number_id: str
+    :return: The remaining pause in seconds, zero if not paused.
+    :rtype: float
+    """
+    paused_until = frappe.cache().get(
+        frappe.cache().make_key(f"waba_sending_paused:{phone_number_id}")
+    )
+    return max(flt(paused_until) - time.time(), 0)
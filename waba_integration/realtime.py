@@ -0,0 +1,149 @@
+import json
+import time
+from typing import Dict, List
+
+import frappe
+from frappe.realtime import get_doctype_room
+
+# Event the form and list view of WABA WhatsApp Message listen to
+MESSAGE_UPDATES_EVENT = "waba_message_updates"
+
+# Updates are published at most once per this many seconds
+COALESCE_WINDOW = 1
+
+# Beyond this many messages, views are told to reload instead
+MAX_PUBLISHED_MESSAGES = 500
+
+# Redis hash of the updates waiting to be published, message name -> update.
+# Kept long enough for the scheduler to publish them, should the job
+# publishing them be lost.
+PENDING_UPDATES_KEY = "waba_realtime_pending_updates"
+PENDING_UPDATES_TTL = 10 * 60
+
+# Set while a job is queued to publish the pending updates. Expires on its
+# own should the job never run.
+PUBLISH_SCHEDULED_KEY = "waba_realtime_publish_scheduled"
+PUBLISH_SCHEDULED_TTL = 60
+
+# Set for `COALESCE_WINDOW` after the pending updates are published
+LAST_PUBLISHED_KEY = "waba_realtime_last_published"
+
+
+def publish_message_updates(messages: List[Dict]):
+    """
+    Publishes new messages and status changes to the desk, once committed.
+
+    Updates are coalesced: only the latest state of a message is kept,
+    first within the transaction, then in Redis until the job publishing
+    them runs, at most once per `COALESCE_WINDOW` seconds. All the pending
+    updates are then published as a single event, see
+    `queue_pending_updates`. A storm of statuses therefore costs one event
+    per window, not one per status.
+
+    :param messages: The WABA WhatsApp Messages, as dicts or documents,
+                     with their `name`, `status` and, if known, `modified`,
+                     `type`, `from` and `to`.
+    :type messages: List[Dict]
+    """
+    if not messages:
+        return
+
+    updates = getattr(frappe.local, "waba_realtime_updates", None)
+    if updates is None:
+        updates = frappe.local.waba_realtime_updates = {}
+        frappe.db.after_commit.add(queue_pending_updates)
+        frappe.db.after_rollback.add(clear_transaction_updates)
+
+    for message in messages:
+        incoming = message.get("type") == "Incoming"
+        updates[message.get("name")] = {
+            "name": message.get("name"),
+            "status": message.get("status"),
+            "type": message.get("type"),
+            "contact": message.get("from") if incoming else message.get("to"),
+            "modified": str(message.get("modified") or ""),
+        }
+
+
+def queue_pending_updates():
+    """
+    Adds the updates of the committed transaction to the pending updates.
+
+    A job publishing the pending updates is enqueued, unless one already is.
+    It publishes them right away, or once `COALESCE_WINDOW` seconds have
+    passed since the last ones were, so that the last updates of a burst
+    are published at the end of the window, see `publish_pending_updates`.
+    """
+    updates = frappe.local.waba_realtime_updates
+    clear_transaction_updates()
+
+    cache = frappe.cache()
+    pending_key = cache.make_key(PENDING_UPDATES_KEY)
+    (
+        cache.pipeline()
+        .hset(
+            pending_key,
+            mapping={
+                name: json.dumps(update) for name, update in updates.items()
+            },
+        )
+        .expire(pending_key, PENDING_UPDATES_TTL)
+        .execute()
+    )
+
+    if cache.set(
+        cache.make_key(PUBLISH_SCHEDULED_KEY),
+        1,
+        nx=True,
+        ex=PUBLISH_SCHEDULED_TTL,
+    ):
+        frappe.enqueue(
+            "waba_integration.realtime.publish_pending_updates", queue="short"
+        )
+
+
+def clear_transaction_updates():
+    frappe.local.waba_realtime_updates = None
+
+
+def publish_pending_updates():
+    """
+    Publishes the pending updates as a single event.
+
+    Waits for the end of the current window first, at most
+    `COALESCE_WINDOW` seconds. The updates are then taken, the schedule is
+    cleared and a new window is started atomically, so that updates queued
+    afterwards are published by a new job, at the end of the new window.
+    Also run by the scheduler, in case a job was lost.
+    """
+    cache = frappe.cache()
+    remaining = cache.pttl(cache.make_key(LAST_PUBLISHED_KEY))
+    if remaining > 0:
+        time.sleep(min(remaining / 1000, COALESCE_WINDOW))
+
+    pending_key = cache.make_key(PENDING_UPDATES_KEY)
+    updates, *_ = (
+        cache.pipeline()
+        .hgetall(pending_key)
+        .delete(pending_key)
+        .delete(cache.make_key(PUBLISH_SCHEDULED_KEY))
+        .set(cache.make_key(LAST_PUBLISHED_KEY), 1, ex=COALESCE_WINDOW)
+        .execute()
+    )
+    if not updates:
+        return
+
+    if len(updates) > MAX_PUBLISHED_MESSAGES:
+        message = {"messages": [], "reload": True}
+    else:
+        message = {
+            "messages": [json.loads(update) for update in updates.values()],
+            "reload": False,
+        }
+
+    # Sent to the desk users viewing the list or a form of messages
+    frappe.publish_realtime(
+        MESSAGE_UPDATES_EVENT,
+        message,
+        room=get_doctype_room("WABA WhatsApp Message"),
+    )
@@ -0,0 +1,251 @@
+import hashlib
+import json
+from typing import Dict, Iterator, List, Set
+
+import frappe
+from waba_integration import graph_api
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    CachedWABASettings,
+    get_waba_settings,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_message_template.waba_whatsapp_message_template import (  # noqa
+    get_message_template,
+)
+
+# Templates fetched per page of `/message_templates`
+TEMPLATES_PAGE_SIZE = 100
+
+# Fields of a template fetched from the Graph API. All of them are hashed to
+# tell whether the template changed since the last sync.
+TEMPLATE_FIELDS = ("id", "name", "language", "status", "category", "components")  # noqa
+
+
+@frappe.whitelist()
+def enqueue_template_sync():
+    """Syncs the message templates of the Business Account in background."""
+    frappe.only_for("System Manager")
+
+    if not get_waba_settings().business_account_id:
+        frappe.throw("Set the Business Account ID in WABA Settings first.")
+
+    frappe.enqueue(
+        "waba_integration.template_sync.sync_message_templates",
+        job_id="waba_template_sync",
+        deduplicate=True,
+    )
+
+
+def sync_message_templates() -> Dict:
+    """
+    Scheduled job that syncs the message templates of the Business Account.
+
+    The templates are fetched page by page, following the cursors of the
+    Graph API. Only templates whose content changed, see `get_content_hash`,
+    are written, with their status, language, category and definition. The
+    `components` sent with a template are never overwritten, new templates
+    send none until they are filled in.
+
+    Templates synced before that Meta no longer returns are marked as
+    `Deleted`. The templates that can be sent are then loaded into the
+    document cache, see `warm_template_cache`.
+
+    :return: The number of templates `inserted`, `updated`, `unchanged` and
+             `deleted`.
+    :rtype: Dict
+    """
+    settings = get_waba_settings()
+    if not settings.enabled or not settings.business_account_id:
+        return {}
+
+    counts = frappe._dict(inserted=0, updated=0, unchanged=0, deleted=0)
+    synced = set()
+    for templates in get_template_pages(settings):
+        for name, outcome in upsert_templates(templates).items():
+            counts[outcome] += 1
+            synced.add(name)
+
+    counts.deleted = mark_deleted_templates(synced)
+    warm_template_cache()
+    return counts
+
+
+def get_template_pages(settings: CachedWABASettings) -> Iterator[List[Dict]]:
+    """
+    Fetches the message templates of the Business Account, page by page.
+
+    :param settings: The WABA Settings.
+    :type settings: CachedWABASettings
+    :raises frappe.exceptions.ValidationError: If a page can not be fetched.
+    :return: The templates of every page, as returned by the Graph API.
+    :rtype: Iterator[List[Dict]]
+    """  # noqa
+    params = {"fields": ",".join(TEMPLATE_FIELDS), "limit": TEMPLATES_PAGE_SIZE}  # noqa
+    while True:
+        response = graph_api.get(
+            f"{settings.business_account_id}/message_templates",
+            settings=settings,
+            endpoint="templates",
+            params=params,
+        )
+        if not response.ok:
+            frappe.throw(
+                f"Could not fetch the message templates: {graph_api.get_error_message(response)}"  # noqa
+            )
+
+        data = response.json()
+        yield data.get("data") or []
+
+        paging = data.get("paging") or {}
+        after = (paging.get("cursors") or {}).get("after")
+        if not paging.get("next") or not after:
+            return
+
+        params["after"] = after
+
+
+def upsert_templates(templates: List[Dict]) -> Dict[str, str]:
+    """
+    Inserts new templates and updates the ones that changed.
+
+    Templates are matched by name and language, including templates that
+    were created by hand before being synced.
+
+    :param templates: The templates, as returned by the Graph API.
+    :type templates: List[Dict]
+    :return: The outcome of every template (`inserted`, `updated` or
+             `unchanged`) by name of its WABA WhatsApp Message Template.
+    :rtype: Dict[str, str]
+    """
+    if not templates:
+        return {}
+
+    names = list({template["name"] for template in templates})
+    existing = {
+        (row.template_name or row.name, row.language_code): row
+        for row in frappe.get_all(
+            "WABA WhatsApp Message Template",
+            or_filters={
+                "template_name": ("in", names),
+                "name": ("in", names),
+            },
+            fields=["name", "template_name", "language_code", "content_hash"],
+        )
+    }
+
+    outcomes = {}
+    for template in templates:
+        content_hash = get_content_hash(template)
+        row = existing.get((template["name"], template.get("language")))
+        if row and row.content_hash == content_hash:
+            outcomes[row.name] = "unchanged"
+            continue
+
+        values = {
+            "template_name": template["name"],
+            "language_code": template.get("language"),
+            "status": frappe.unscrub(template.get("status") or ""),
+            "category": frappe.unscrub(template.get("category") or ""),
+            "template_id": template.get("id"),
+            "definition": json.dumps(template.get("components") or [], indent=1),  # noqa
+            "content_hash": content_hash,
+        }
+        if row:
+            template_doc = frappe.get_doc(
+                "WABA WhatsApp Message Template", row.name
+            )
+            template_doc.update(values)
+            template_doc.save(ignore_permissions=True)
+            outcomes[template_doc.name] = "updated"
+        else:
+            template_doc = frappe.get_doc(
+                {
+                    "doctype": "WABA WhatsApp Message Template",
+                    "name": get_new_template_name(template),
+                    "components": "[]",
+                    **values,
+                }
+            ).insert(ignore_permissions=True)
+            outcomes[template_doc.name] = "inserted"
+
+    return outcomes
+
+
+def mark_deleted_templates(synced: Set[str]) -> int:
+    """
+    Marks the synced templates that Meta no longer returns as `Deleted`.
+
+    :param synced: The names of the templates returned by this sync.
+    :type synced: Set[str]
+    :return: The number of templates marked as deleted.
+    :rtype: int
+    """
+    filters = {"template_id": ("is", "set"), "status": ("!=", "Deleted")}
+    if synced:
+        filters["name"] = ("not in", list(synced))
+
+    names = frappe.get_all(
+        "WABA WhatsApp Message Template", filters=filters, pluck="name"
+    )
+    if not names:
+        return 0
+
+    # The hash is cleared so that the template is updated if it comes back
+    frappe.db.set_value(
+        "WABA WhatsApp Message Template",
+        {"name": ("in", names)},
+        {"status": "Deleted", "content_hash": None},
+    )
+    for name in names:
+        frappe.clear_document_cache("WABA WhatsApp Message Template", name)
+
+    return len(names)
+
+
+def warm_template_cache():
+    """
+    Loads the templates that can be sent into the document cache.
+
+    The document cache is kept in Redis, so sends from every web and outbox
+    worker find the synced templates there. Compiled components are kept
+    per process, and are left for each process to compile on first use.
+    """
+    for name in frappe.get_all(
+        "WABA WhatsApp Message Template",
+        or_filters={"status": "Approved", "template_id": ("is", "not set")},
+        pluck="name",
+    ):
+        get_message_template(name)
+
+
+def get_content_hash(template: Dict) -> str:
+    """
+    Returns the hash of a template as returned by the Graph API.
+
+    :param template: The template.
+    :type template: Dict
+    :return: The sha256 of its `TEMPLATE_FIELDS`, hex encoded.
+    :rtype: str
+    """
+    content = {field: template.get(field) for field in TEMPLATE_FIELDS}
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def get_new_template_name(template: Dict) -> str:
+    """
+    Returns the name of a new WABA WhatsApp Message Template.
+
+    Templates are named after their name on Meta, with their language if
+    another language of the template already took it.
+
+    :param template: The template, as returned by the Graph API.
+    :type template: Dict
+    :return: The name.
+    :rtype: str
+    """
+    name = template["name"]
+    if frappe.db.exists("WABA WhatsApp Message Template", name):
+        name = f"{name}-{template.get('language')}"
+
+    return name
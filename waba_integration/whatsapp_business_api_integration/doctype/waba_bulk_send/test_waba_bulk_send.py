@@ -0,0 +1,130 @@
+# Copyright (c) 2022, Hussain Nagaria and Contributors
+# See license.txt
+
+from unittest.mock import Mock
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, get_datetime, now_datetime
+from waba_integration.dispatch import get_message_updates, get_outcome
+from waba_integration.outbox import (
+    claim_outbox_messages,
+    get_claimed_results,
+    send_outbox_chunks,
+)
+from waba_integration.rate_limit import take_tokens
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    get_waba_settings,
+)
+
+
+class TestWABABulkSend(FrappeTestCase):
+    def setUp(self):
+        self.settings = get_waba_settings()
+        self.bulk_send = f"test-{frappe.generate_hash(length=8)}"
+        cache = frappe.cache()
+        cache.delete(
+            cache.make_key(f"waba_token_bucket:{self.settings.phone_number_id}"),  # noqa
+            cache.make_key(f"waba_sending_paused:{self.settings.phone_number_id}"),  # noqa
+        )
+
+    def test_due_messages_are_claimed_once(self):
+        due = insert_outbox_message(self.bulk_send)
+        insert_outbox_message(
+            self.bulk_send, add_to_date(now_datetime(), minutes=5)
+        )
+
+        claimed = claim_outbox_messages(10, self.settings, self.bulk_send)
+        self.assertEqual([message.name for message in claimed], [due])
+        self.assertGreater(
+            get_datetime(claimed[0].next_attempt_at), now_datetime()
+        )
+
+        # Leased until sent, or until the worker sending it is gone
+        self.assertEqual(
+            claim_outbox_messages(10, self.settings, self.bulk_send), []
+        )
+
+    def test_failed_messages_back_off_until_max_attempts(self):
+        message = frappe._dict(attempts=0)
+        retryable = get_outcome(error="Timeout", retryable=True)
+
+        updates = get_message_updates(message, retryable, self.settings)
+        self.assertEqual(updates["status"], "Pending")
+        self.assertEqual(updates["in_outbox"], 1)
+        self.assertGreater(updates["next_attempt_at"], now_datetime())
+
+        message.attempts = self.settings.outbox_max_attempts - 1
+        updates = get_message_updates(message, retryable, self.settings)
+        self.assertEqual(updates["status"], "Failed")
+        self.assertEqual(updates["in_outbox"], 0)
+
+        final = get_outcome(error="Invalid parameter")
+        updates = get_message_updates(
+            frappe._dict(attempts=0), final, self.settings
+        )
+        self.assertEqual(updates["status"], "Failed")
+
+    def test_results_of_reclaimed_messages_are_not_saved(self):
+        kept, reclaimed = (
+            insert_outbox_message(self.bulk_send) for _ in range(2)
+        )
+        claim_token = claim_outbox_messages(
+            10, self.settings, self.bulk_send
+        )[0].claim_token
+
+        # The lease of one message expires, and another worker claims it
+        frappe.db.set_value(
+            "WABA WhatsApp Message",
+            reclaimed,
+            "next_attempt_at",
+            add_to_date(now_datetime(), minutes=-1),
+        )
+        self.assertEqual(
+            [
+                message.name
+                for message in claim_outbox_messages(
+                    10, self.settings, self.bulk_send
+                )
+            ],
+            [reclaimed],
+        )
+
+        results = get_claimed_results(
+            {kept: {"status": "Sent"}, reclaimed: {"status": "Sent"}},
+            claim_token,
+        )
+        self.assertEqual(
+            results, {kept: {"status": "Sent", "claim_token": None}}
+        )
+
+    def test_unused_tokens_are_returned(self):
+        send = Mock()
+        rate = self.settings.messages_per_second
+
+        send_outbox_chunks(send, self.settings, self.bulk_send)
+
+        send.assert_not_called()
+        self.assertEqual(
+            take_tokens(self.settings.phone_number_id, rate, rate), rate
+        )
+
+
+def insert_outbox_message(bulk_send: str, next_attempt_at=None) -> str:
+    message = frappe.get_doc(
+        {
+            "doctype": "WABA WhatsApp Message",
+            "type": "Outgoing",
+            "status": "Pending",
+            "message_type": "Text",
+            "message_body": "Hello",
+            "to": f"1555{frappe.generate_hash(length=8)}",
+            "in_outbox": 1,
+            "next_attempt_at": next_attempt_at,
+            "bulk_send": bulk_send,
+        }
+    )
+    # Inserted without hooks, so that it is not sent right away
+    message.set_new_name()
+    message.db_insert()
+    return message.name
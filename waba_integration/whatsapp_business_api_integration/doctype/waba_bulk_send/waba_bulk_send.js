@@ -0,0 +1,28 @@
+// Copyright (c) 2026, Hussain Nagaria and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("WABA Bulk Send", {
+  refresh: function (frm) {
+    frm.trigger("show_progress");
+
+    frappe.realtime.off("waba_bulk_send_progress");
+    frappe.realtime.on("waba_bulk_send_progress", (data) => {
+      if (data.name !== frm.doc.name) return;
+
+      Object.assign(frm.doc, data);
+      frm.refresh_fields();
+      frm.trigger("show_progress");
+    });
+  },
+
+  show_progress: function (frm) {
+    if (!frm.doc.total_recipients) return;
+
+    const done = frm.doc.sent + frm.doc.failed;
+    frm.dashboard.show_progress(
+      "Progress",
+      (done / frm.doc.total_recipients) * 100,
+      `${frm.doc.sent} sent, ${frm.doc.failed} failed of ${frm.doc.total_recipients}`
+    );
+  },
+});
@@ -0,0 +1,155 @@
+# Copyright (c) 2026, Hussain Nagaria and contributors
+# For license information, please see license.txt
+
+from typing import List
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_contact.waba_whatsapp_contact import (  # noqa
+    resolve_waba_whatsapp_contacts,
+    update_inbox_summaries,
+)
+
+# Fields set on the messages of a bulk send, see `create_bulk_send`
+BULK_MESSAGE_FIELDS = (
+    "type",
+    "status",
+    "to",
+    "message_type",
+    "message_body",
+    "message_template",
+    "document_type",
+    "document_name",
+    "attach_print",
+    "print_format",
+    "media_file",
+    "media_mime_type",
+    "media_id",
+    "media_uploaded",
+    "bulk_send",
+    "in_outbox",
+)
+
+# Fields of the message saved on the bulk send itself
+BULK_SEND_FIELDS = (
+    "message_type",
+    "message_body",
+    "message_template",
+    "document_type",
+    "document_name",
+)
+
+# Statuses of messages that were sent, whatever happened to them after
+SENT_STATUSES = ("Sent", "Delivered", "Read")
+
+
+class WABABulkSend(Document):
+    pass
+
+
+def create_bulk_send(recipients: List[str], **message) -> WABABulkSend:
+    """
+    Creates a WABA Bulk Send and its messages, and enqueues their sending.
+
+    The missing contacts and all the messages are inserted in bulk, as
+    `Pending` WABA WhatsApp Messages in the outbox, linked to the bulk send.
+
+    :param recipients: The WhatsApp IDs to send the message to.
+    :type recipients: List[str]
+    :param message: The `message_type`, `message_body`, `message_template`,
+                    `document_type`, `document_name`, `attach_print`,
+                    `print_format` and media fields of the message.
+    :return: The WABA Bulk Send.
+    :rtype: WABABulkSend
+    """  # noqa
+    bulk_send = frappe.get_doc(
+        {
+            "doctype": "WABA Bulk Send",
+            "total_recipients": len(recipients),
+            **{field: message.get(field) for field in BULK_SEND_FIELDS},
+        }
+    ).insert(ignore_permissions=True)
+
+    resolve_waba_whatsapp_contacts(recipients)
+
+    message_data = {
+        "type": "Outgoing",
+        "status": "Pending",
+        "bulk_send": bulk_send.name,
+        "in_outbox": 1,
+        **message,
+    }
+    timestamp = now()
+    user = frappe.session.user
+    messages = [
+        {
+            "name": frappe.generate_hash(length=10),
+            "creation": timestamp,
+            **message_data,
+            "to": recipient,
+        }
+        for recipient in recipients
+    ]
+    frappe.db.bulk_insert(
+        "WABA WhatsApp Message",
+        ("name", "creation", "modified", "owner", "modified_by")
+        + BULK_MESSAGE_FIELDS,
+        [
+            (message["name"], timestamp, timestamp, user, user)
+            + tuple(message.get(field) for field in BULK_MESSAGE_FIELDS)
+            for message in messages
+        ],
+    )
+    update_inbox_summaries(messages)
+
+    # The outbox depends on this module to update the progress
+    from waba_integration.outbox import enqueue_outbox_worker
+
+    enqueue_outbox_worker(bulk_send=bulk_send.name)
+
+    return bulk_send
+
+
+def update_bulk_send_progress(bulk_send: str):
+    """
+    Saves and publishes the progress of a WABA Bulk Send.
+
+    The progress is counted from the statuses of its messages, so it is
+    right whichever worker sent them.
+
+    :param bulk_send: The name of the WABA Bulk Send.
+    :type bulk_send: str
+    """
+    counts = dict(
+        frappe.get_all(
+            "WABA WhatsApp Message",
+            filters={"bulk_send": bulk_send},
+            fields=["status", "count(name) as count"],
+            group_by="status",
+            as_list=True,
+        )
+    )
+    pending = counts.get("Pending", 0)
+    failed = counts.get("Failed", 0)
+    sent = sum(counts.get(status, 0) for status in SENT_STATUSES)
+
+    if pending:
+        status = "In Progress" if sent or failed else "Queued"
+    else:
+        status = "Failed" if failed and not sent else "Completed"
+
+    progress = {"status": status, "sent": sent, "failed": failed}
+    frappe.db.set_value("WABA Bulk Send", bulk_send, progress)
+    frappe.db.commit()
+
+    frappe.publish_realtime(
+        "waba_bulk_send_progress",
+        {
+            "name": bulk_send,
+            "total_recipients": sent + failed + pending,
+            **progress,
+        },
+        doctype="WABA Bulk Send",
+        docname=bulk_send,
+    )
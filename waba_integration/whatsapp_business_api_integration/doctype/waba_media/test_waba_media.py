@@ -0,0 +1,142 @@
+# Copyright (c) 2026, Hussain Nagaria and Contributors
+# See license.txt
+
+import base64
+import dataclasses
+import hashlib
+import os
+from unittest.mock import Mock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from waba_integration.media import (
+    download_media_file,
+    get_sha256_hex,
+    get_upload,
+    upload_media_bulk,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    get_waba_settings,
+)
+
+
+class TestWABAMedia(FrappeTestCase):
+    def setUp(self):
+        self.content = frappe.generate_hash(length=64).encode() * 1000
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+
+    def test_sha256_is_normalized_to_hex(self):
+        digest = hashlib.sha256(self.content).digest()
+
+        self.assertEqual(
+            get_sha256_hex(base64.b64encode(digest).decode()), self.sha256
+        )
+        self.assertEqual(get_sha256_hex(self.sha256.upper()), self.sha256)
+        self.assertIsNone(get_sha256_hex("not a hash"))
+
+    def test_identical_media_is_downloaded_once(self):
+        get = Mock(return_value=FakeResponse(self.content))
+        with patch("waba_integration.media.graph_api.get", get):
+            first = download_media_file(
+                "https://example.com/media", "photo.jpg", self.sha256
+            )
+            second = download_media_file(
+                "https://example.com/media", "photo.jpg", self.sha256
+            )
+
+        get.assert_called_once()
+        self.addCleanup(remove_site_file, first.file_url)
+        self.assertEqual(second.file_url, first.file_url)
+        self.assertEqual(second.content_hash, first.content_hash)
+        self.assertEqual(
+            frappe.db.get_value("WABA Media", self.sha256, "file_url"),
+            first.file_url,
+        )
+
+    def test_corrupted_media_is_not_saved(self):
+        file_name = f"{frappe.generate_hash(length=8)}.jpg"
+        with patch(
+            "waba_integration.media.graph_api.get",
+            Mock(return_value=FakeResponse(self.content)),
+        ):
+            self.assertRaises(
+                frappe.ValidationError,
+                download_media_file,
+                "https://example.com/media",
+                file_name,
+                hashlib.sha256(b"other content").hexdigest(),
+            )
+
+        file_path = frappe.get_site_path("private", "files", file_name)
+        self.assertFalse(os.path.exists(file_path))
+        self.assertFalse(os.path.exists(f"{file_path}.part"))
+        self.assertFalse(frappe.db.exists("WABA Media", self.sha256))
+
+    def test_media_larger_than_the_limit_is_not_downloaded(self):
+        response = FakeResponse(
+            self.content, headers={"Content-Length": str(1024**4)}
+        )
+        with patch(
+            "waba_integration.media.graph_api.get", Mock(return_value=response)
+        ):
+            self.assertRaises(
+                frappe.ValidationError,
+                download_media_file,
+                "https://example.com/media",
+                "video.mp4",
+            )
+
+    def test_identical_files_are_uploaded_once(self):
+        file_urls = []
+        for _ in range(2):
+            file_url = f"/private/files/{frappe.generate_hash(length=8)}.jpg"
+            with open(frappe.get_site_path(file_url.lstrip("/")), "wb") as f:
+                f.write(self.content)
+            self.addCleanup(remove_site_file, file_url)
+            file_urls.append(file_url)
+
+        settings = dataclasses.replace(
+            get_waba_settings(), phone_number_id="test"
+        )
+        post_media = Mock(return_value=get_upload(media_id="4711"))
+        with patch("waba_integration.media.post_media", post_media):
+            uploads = upload_media_bulk(
+                dict.fromkeys(file_urls, "image/jpeg"), settings=settings
+            )
+            reused = upload_media_bulk(
+                {file_urls[0]: "image/jpeg"}, settings=settings
+            )
+
+        post_media.assert_called_once()
+        self.assertEqual(
+            {upload.media_id for upload in uploads.values()}, {"4711"}
+        )
+        self.assertEqual(reused[file_urls[0]].media_id, "4711")
+
+
+class FakeResponse:
+    """A streamed response of the Graph API media endpoint."""
+
+    def __init__(self, content: bytes, headers: dict = None):
+        self.content = content
+        self.ok = True
+        self.text = ""
+        self.headers = {
+            "Content-Type": "image/jpeg",
+            "Content-Length": str(len(content)),
+            **(headers or {}),
+        }
+
+    def iter_content(self, chunk_size: int):
+        for start in range(0, len(self.content), chunk_size):
+            end = start + chunk_size
+            yield self.content[start:end]
+
+    def close(self):
+        pass
+
+
+def remove_site_file(file_url: str):
+    file_path = frappe.get_site_path(file_url.lstrip("/"))
+    if os.path.exists(file_path):
+        os.remove(file_path)
@@ -1,9 +1,78 @@
 # Copyright (c) 2022, Hussain Nagaria and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from waba_integration.dispatch import save_send_results
+from waba_integration.whatsapp_business_api_integration.doctype.waba_message_status_update.waba_message_status_update import (  # noqa
+    apply_status_updates,
+    get_furthest_statuses,
+)
 
 
 class TestWABAMessageStatusUpdate(FrappeTestCase):
-	pass
+    def test_furthest_status_wins(self):
+        statuses = [
+            {"id": "wamid.1", "status": "sent"},
+            {"id": "wamid.1", "status": "read"},
+            {"id": "wamid.1", "status": "delivered"},
+            {"id": "wamid.2", "status": "sent"},
+        ]
+
+        self.assertEqual(
+            get_furthest_statuses(statuses),
+            {"wamid.1": "Read", "wamid.2": "Sent"},
+        )
+
+    def test_history_is_not_recorded_twice(self):
+        message_id = f"wamid.{frappe.generate_hash()}"
+        statuses = [
+            {"id": message_id, "status": "sent", "timestamp": "1"},
+            {"id": message_id, "status": "delivered", "timestamp": "2"},
+        ]
+
+        apply_status_updates(statuses[:1])
+        apply_status_updates(statuses)
+
+        self.assertEqual(
+            sorted(
+                frappe.get_all(
+                    "WABA Message Status Update",
+                    filters={"message_id": message_id},
+                    pluck="status",
+                )
+            ),
+            ["Delivered", "Sent"],
+        )
+
+    def test_statuses_received_before_the_message_id_are_applied(self):
+        message_id = f"wamid.{frappe.generate_hash()}"
+        message = frappe.get_doc(
+            {
+                "doctype": "WABA WhatsApp Message",
+                "type": "Outgoing",
+                "status": "Pending",
+                "message_type": "Text",
+                "message_body": "Hello",
+                "to": f"1555{frappe.generate_hash(length=8)}",
+            }
+        )
+        message.set_new_name()
+        message.db_insert()
+
+        # Meta reports the delivery before the outbox saved the message ID
+        apply_status_updates([{"id": message_id, "status": "delivered"}])
+        save_send_results({message.name: {"status": "Sent", "id": message_id}})
+
+        self.assertEqual(
+            frappe.db.get_value("WABA WhatsApp Message", message.name, "status"),  # noqa
+            "Delivered",
+        )
+        self.assertEqual(
+            frappe.db.get_value(
+                "WABA Message Status Update",
+                {"message_id": message_id},
+                "message",
+            ),
+            message.name,
+        )
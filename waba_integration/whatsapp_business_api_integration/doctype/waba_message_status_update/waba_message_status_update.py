@@ -1,8 +1,275 @@
 # Copyright (c) 2022, Hussain Nagaria and contributors
 # For license information, please see license.txt
 
-# import frappe
+from typing import Dict, List
+
+import frappe
 from frappe.model.document import Document
+from frappe.utils import add_to_date, now, now_datetime
+from waba_integration.realtime import publish_message_updates
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_contact.waba_whatsapp_contact import (  # noqa
+    refresh_last_message_statuses,
+)
+
+# How far along a message is, a status never moves a message backwards.
+# `Failed` is final, Meta only reports it for messages it could not deliver.
+STATUS_RANK = {
+    "Sent": 1,
+    "Delivered": 2,
+    "Read": 3,
+    "Failed": 4,
+}
+
+# Maximum number of messages updated by a single UPDATE statement
+STATUS_UPDATE_CHUNK_SIZE = 1000
+
+# Statuses that matched no message are applied again for this many hours,
+# see `apply_unmatched_statuses`
+UNMATCHED_STATUS_HOURS = 24
+
 
 class WABAMessageStatusUpdate(Document):
-	pass
+    pass
+
+
+def apply_status_updates(statuses: List[Dict]):
+    """
+    Applies a batch of status updates received from WABA.
+
+    All the statuses of the batch are coalesced per message, keeping only the
+    furthest one (Sent < Delivered < Read), which is written with a single
+    UPDATE that never moves a message back to an earlier status. Every status
+    is also recorded as a WABA Message Status Update, with a single insert.
+    Statuses of messages whose ID is not saved yet are recorded without a
+    `message`, and applied later, see `apply_unmatched_statuses`.
+
+    :param statuses: The `statuses` of a webhook payload.
+    :type statuses: List[Dict]
+    """  # noqa
+    statuses = [
+        status
+        for status in statuses
+        if status.get("id") and get_status(status) in STATUS_RANK
+    ]
+    if not statuses:
+        return
+
+    update_message_statuses(get_furthest_statuses(statuses))
+    insert_status_history(statuses)
+
+
+def get_furthest_statuses(statuses: List[Dict]) -> Dict[str, str]:
+    """
+    Coalesces status updates by message ID, keeping the furthest status.
+
+    :param statuses: The `statuses` of a webhook payload.
+    :type statuses: List[Dict]
+    :return: The furthest status of every message, by message ID.
+    :rtype: Dict[str, str]
+    """
+    furthest_statuses = {}
+    for status in statuses:
+        message_id, new_status = status.get("id"), get_status(status)
+        current_status = furthest_statuses.get(message_id)
+        if (
+            not current_status
+            or STATUS_RANK[new_status] > STATUS_RANK[current_status]
+        ):
+            furthest_statuses[message_id] = new_status
+
+    return furthest_statuses
+
+
+def update_message_statuses(furthest_statuses: Dict[str, str]):
+    """
+    Moves WABA WhatsApp Messages forward to the given statuses.
+
+    A message is only updated if the new status is further than the one it
+    already has, so a late `delivered` never overwrites `read`. The inbox
+    summaries of the contacts whose last message it is are updated as well,
+    and the messages that moved forward are published to the desk.
+
+    :param furthest_statuses: The new status of every message, by message ID.
+    :type furthest_statuses: Dict[str, str]
+    """
+    current_rank = " ".join(
+        f"when '{status}' then {rank}" for status, rank in STATUS_RANK.items()
+    )
+    message_ids = list(furthest_statuses)
+
+    for start in range(0, len(message_ids), STATUS_UPDATE_CHUNK_SIZE):
+        end = start + STATUS_UPDATE_CHUNK_SIZE
+        chunk = message_ids[start:end]
+        values = {"modified": now(), "message_ids": tuple(chunk)}
+        new_status, new_rank = [], []
+        for i, message_id in enumerate(chunk):
+            status = furthest_statuses[message_id]
+            values[f"id_{i}"] = message_id
+            values[f"status_{i}"] = status
+            new_status.append(f"when %(id_{i})s then %(status_{i})s")
+            new_rank.append(f"when %(id_{i})s then {STATUS_RANK[status]}")
+
+        frappe.db.sql(
+            f"""
+            update `tabWABA WhatsApp Message`
+            set
+                status = case id {" ".join(new_status)} end,
+                modified = %(modified)s
+            where
+                id in %(message_ids)s
+                and (case status {current_rank} else 0 end)
+                    < (case id {" ".join(new_rank)} end)
+            """,  # noqa
+            values,
+        )
+        refresh_last_message_statuses(message_ids=chunk)
+        publish_message_updates(
+            frappe.get_all(
+                "WABA WhatsApp Message",
+                filters={"id": ("in", chunk), "modified": values["modified"]},
+                fields=["name", "status", "type", "from", "to", "modified"],
+            )
+        )
+
+
+def insert_status_history(statuses: List[Dict]):
+    """
+    Records every status update as a WABA Message Status Update.
+
+    Statuses already recorded for a message are skipped, so that webhooks
+    processed again, e.g. when replayed, do not duplicate the history.
+
+    :param statuses: The `statuses` of a webhook payload.
+    :type statuses: List[Dict]
+    """
+    message_ids = list({status.get("id") for status in statuses})
+    recorded = set(
+        frappe.get_all(
+            "WABA Message Status Update",
+            filters={"message_id": ("in", message_ids)},
+            fields=["message_id", "status"],
+            as_list=True,
+        )
+    )
+    statuses = [
+        status
+        for status in statuses
+        if (status.get("id"), get_status(status)) not in recorded
+    ]
+    if not statuses:
+        return
+
+    message_names = dict(
+        frappe.get_all(
+            "WABA WhatsApp Message",
+            filters={"id": ("in", message_ids)},
+            fields=["id", "name"],
+            as_list=True,
+        )
+    )
+
+    timestamp = now()
+    user = frappe.session.user
+    frappe.db.bulk_insert(
+        "WABA Message Status Update",
+        (
+            "name",
+            "creation",
+            "modified",
+            "owner",
+            "modified_by",
+            "message",
+            "message_id",
+            "status",
+            "timestamp",
+            "recipient",
+        ),
+        [
+            (
+                frappe.generate_hash(length=10),
+                timestamp,
+                timestamp,
+                user,
+                user,
+                message_names.get(status.get("id")),
+                status.get("id"),
+                get_status(status),
+                status.get("timestamp"),
+                status.get("recipient_id"),
+            )
+            for status in statuses
+        ],
+    )
+
+
+def apply_unmatched_statuses(message_ids: List[str] = None):
+    """
+    Applies the statuses that matched no message when they were received.
+
+    Meta can report the status of a message before the transaction saving
+    its ID is committed, e.g. by the outbox. Such statuses are recorded
+    without a `message`. They are applied, and linked to their message, once
+    it is saved with its ID: right away by `save_send_results`, and by the
+    scheduler for the statuses received while that transaction was running.
+
+    :param message_ids: Only apply the statuses of these message IDs, every
+                        status received in the last `UNMATCHED_STATUS_HOURS`
+                        hours if not passed.
+    :type message_ids: List[str]
+    """
+    filters = {
+        "message": ("is", "not set"),
+        "creation": (
+            ">",
+            add_to_date(now_datetime(), hours=-UNMATCHED_STATUS_HOURS),
+        ),
+    }
+    if message_ids is not None:
+        if not message_ids:
+            return
+        filters["message_id"] = ("in", message_ids)
+
+    unmatched = frappe.get_all(
+        "WABA Message Status Update",
+        filters=filters,
+        fields=["name", "message_id as id", "status"],
+    )
+    if not unmatched:
+        return
+
+    message_ids = set(
+        frappe.get_all(
+            "WABA WhatsApp Message",
+            filters={"id": ("in", list({status.id for status in unmatched}))},
+            pluck="id",
+        )
+    )
+    matched = [status for status in unmatched if status.id in message_ids]
+    if not matched:
+        return
+
+    update_message_statuses(get_furthest_statuses(matched))
+    frappe.db.sql(
+        """
+        update `tabWABA Message Status Update`
+        set message = (
+            select name from `tabWABA WhatsApp Message`
+            where id = `tabWABA Message Status Update`.message_id
+            limit 1
+        )
+        where name in %(names)s
+        """,
+        {"names": tuple(status.name for status in matched)},
+    )
+
+
+def get_status(status: Dict) -> str:
+    """
+    Returns the status of a status update, as used in WABA WhatsApp Message.
+
+    :param status: A status update received from WABA.
+    :type status: Dict
+    :return: The status, e.g. `Delivered`.
+    :rtype: str
+    """
+    return (status.get("status") or "").title()
@@ -1,9 +1,26 @@
 # Copyright (c) 2022, Hussain Nagaria and Contributors
 # See license.txt
 
-# import frappe
 from frappe.tests.utils import FrappeTestCase
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    CachedWABASettings,
+)
 
 
 class TestWABASettings(FrappeTestCase):
-	pass
+    def test_cached_settings_are_typed(self):
+        settings = CachedWABASettings.from_dict(
+            {
+                "enabled": "1",
+                "api_version": "v19.0",
+                "webhook_batch_size": "25",
+                "webhook_queue": "",
+            },
+            access_token="token",
+        )
+
+        self.assertIs(settings.enabled, True)
+        self.assertEqual(settings.webhook_batch_size, 25)
+        self.assertEqual(settings.webhook_queue, "short")
+        self.assertEqual(settings.access_token, "token")
+        self.assertEqual(settings.api_base, "https://graph.facebook.com/v19.0")
@@ -1,8 +1,150 @@
 # Copyright (c) 2022, Hussain Nagaria and contributors
 # For license information, please see license.txt
 
-# import frappe
+from dataclasses import dataclass, fields
+from typing import Dict
+
+import frappe
 from frappe.model.document import Document
+from frappe.utils import cint, cstr, flt
+
+SETTINGS_CACHE_KEY = "waba_settings"
+
+# Per-process memo of the settings (and the decrypted access token) by site,
+# validated against the `modified` timestamp of the settings cached in Redis
+_settings_by_site: Dict[str, "CachedWABASettings"] = {}
+
 
 class WABASettings(Document):
-	pass
+    def on_update(self):
+        """Invalidate the cached settings in all processes."""
+        clear_waba_settings_cache()
+
+
+@dataclass(frozen=True)
+class CachedWABASettings:
+    """A read-only, typed snapshot of WABA Settings."""
+
+    modified: str = ""
+    enabled: bool = False
+    access_token: str = ""
+    phone_number_id: str = ""
+    api_version: str = ""
+    business_account_id: str = ""
+    webhook_verify_token: str = ""
+    automatically_download_images: bool = False
+    automatically_download_audio: bool = False
+    max_media_download_size: int = 100
+    process_webhooks_in_background: bool = False
+    webhook_queue: str = "short"
+    webhook_batch_size: int = 100
+    webhook_worker_concurrency: int = 2
+    webhook_log_sample_rate: float = 100.0
+    graph_api_url: str = "https://graph.facebook.com"
+    connection_pool_size: int = 10
+    max_retries: int = 3
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    bulk_send_concurrency: int = 8
+    outbox_max_attempts: int = 5
+    media_upload_concurrency: int = 4
+    messages_per_second: int = 80
+    use_async_graph_client: bool = False
+    async_concurrency: int = 50
+    # Not a field, the site the settings belong to, for threads that have no
+    # site context
+    site: str = ""
+
+    @property
+    def api_base(self) -> str:
+        """The base URL of the Graph API, for the configured API version."""
+        return f"{self.graph_api_url.rstrip('/')}/{self.api_version}"
+
+    @classmethod
+    def from_dict(cls, values: Dict, access_token: str = None):
+        """
+        Builds the settings from the raw values stored in the database.
+
+        Empty values fall back to the defaults of the class.
+
+        :param values: The values of WABA Settings, by fieldname.
+        :type values: Dict
+        :param access_token: The decrypted access token.
+        :type access_token: str
+        :return: The settings.
+        :rtype: CachedWABASettings
+        """
+        kwargs = {"access_token": cstr(access_token)}
+        for field in fields(cls):
+            value = values.get(field.name)
+            if field.name == "access_token" or value in (None, ""):
+                continue
+
+            if field.type is bool:
+                value = bool(cint(value))
+            elif field.type is int:
+                value = cint(value)
+            elif field.type is float:
+                value = flt(value)
+            else:
+                value = cstr(value)
+
+            kwargs[field.name] = value
+
+        return cls(**kwargs)
+
+
+def get_waba_settings() -> CachedWABASettings:
+    """
+    Returns the WABA Settings, including the decrypted access token.
+
+    The settings are memoized for the current request or job, and per process
+    as long as the settings cached in Redis have not changed. The database is
+    only hit, and the access token decrypted, after the settings are saved.
+
+    :return: The settings.
+    :rtype: CachedWABASettings
+    """
+    if settings := getattr(frappe.local, "waba_settings", None):
+        return settings
+
+    values = frappe.cache().get_value(
+        SETTINGS_CACHE_KEY, generator=load_waba_settings_values
+    )
+
+    settings = _settings_by_site.get(frappe.local.site)
+    if not settings or settings.modified != cstr(values.get("modified")):
+        access_token = frappe.utils.password.get_decrypted_password(
+            "WABA Settings",
+            "WABA Settings",
+            "access_token",
+            raise_exception=False,
+        )
+        settings = CachedWABASettings.from_dict(
+            {**values, "site": frappe.local.site}, access_token
+        )
+        _settings_by_site[frappe.local.site] = settings
+
+    frappe.local.waba_settings = settings
+    return settings
+
+
+def load_waba_settings_values() -> Dict:
+    """
+    Loads the raw values of WABA Settings from the database.
+
+    The access token is left out, it is never stored in Redis.
+
+    :return: The values of WABA Settings, by fieldname.
+    :rtype: Dict
+    """
+    values = frappe.db.get_singles_dict("WABA Settings")
+    values.pop("access_token", None)
+    values["modified"] = cstr(values.get("modified") or frappe.generate_hash())
+    return values
+
+
+def clear_waba_settings_cache():
+    """Clears the cached WABA Settings, they are reloaded on next access."""
+    frappe.cache().delete_value(SETTINGS_CACHE_KEY)
+    frappe.local.waba_settings = None
@@ -0,0 +1,78 @@
+# Copyright (c) 2026, Hussain Nagaria and Contributors
+# See license.txt
+
+import json
+import random
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import today
+from waba_integration.api.webhook import (
+    get_failures_summary,
+    process_payload,
+    replay_webhook_logs,
+)
+from waba_integration.benchmarks.webhooks import get_message, get_payload
+from waba_integration.whatsapp_business_api_integration.doctype.waba_webhook_dead_letter.waba_webhook_dead_letter import (  # noqa
+    insert_dead_letters,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_webhook_log.waba_webhook_log import (  # noqa
+    insert_webhook_log,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_message.waba_whatsapp_message import (  # noqa
+    create_waba_whatsapp_messages,
+)
+
+
+class TestWABAWebhookDeadLetter(FrappeTestCase):
+    def test_failed_events_are_dead_lettered_and_replayed(self):
+        rng = random.Random(17)
+        good = get_message(rng, "1555" + frappe.generate_hash(length=8), 0)
+        bad = get_message(rng, "1555" + frappe.generate_hash(length=8), 0)
+        payload = get_payload([good, bad], [], 1)
+
+        def create_messages(messages, contacts):
+            if any(message["id"] == bad["id"] for message in messages):
+                raise frappe.ValidationError("Bad message")
+            create_waba_whatsapp_messages(messages, contacts)
+
+        with patch(
+            "waba_integration.api.webhook.create_waba_whatsapp_messages",
+            create_messages,
+        ):
+            failures = process_payload(payload)
+
+        webhook_log = insert_webhook_log(
+            json.dumps(payload).encode(),
+            "Failed",
+            get_failures_summary(failures),
+        )
+        insert_dead_letters(failures, webhook_log)
+
+        dead_letters = frappe.get_all(
+            "WABA Webhook Dead Letter",
+            filters={"webhook_log": webhook_log},
+            fields=["event_type", "event_key", "payload", "status"],
+        )
+        self.assertEqual(len(dead_letters), 1)
+        self.assertEqual(dead_letters[0].event_type, "Message")
+        self.assertEqual(dead_letters[0].event_key, f"message:{bad['id']}")
+        self.assertEqual(json.loads(dead_letters[0].payload), bad)
+        self.assertEqual(dead_letters[0].status, "Open")
+
+        with patch("frappe.enqueue"), patch.object(frappe.db, "commit"):
+            self.assertGreaterEqual(replay_webhook_logs(today(), today()), 1)
+
+        self.assertEqual(
+            frappe.db.get_value("WABA Webhook Log", webhook_log, "status"),
+            "Queued",
+        )
+        self.assertEqual(
+            frappe.db.get_value(
+                "WABA Webhook Dead Letter",
+                {"webhook_log": webhook_log},
+                "status",
+            ),
+            "Replayed",
+        )
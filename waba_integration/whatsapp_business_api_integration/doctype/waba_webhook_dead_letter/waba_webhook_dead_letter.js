@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Hussain Nagaria and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('WABA Webhook Dead Letter', {
+	// refresh: function(frm) {
+
+	// }
+});
@@ -0,0 +1,55 @@
+# Copyright (c) 2026, Hussain Nagaria and contributors
+# For license information, please see license.txt
+
+from typing import Dict, List
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now
+
+# Fields set on dead letters, see `insert_dead_letters`
+DEAD_LETTER_FIELDS = ("event_type", "event_key", "payload", "error")
+
+
+class WABAWebhookDeadLetter(Document):
+    pass
+
+
+def insert_dead_letters(failures: List[Dict], webhook_log: str = None):
+    """
+    Bulk inserts the messages and statuses of a webhook that failed.
+
+    :param failures: The `event_type`, `event_key`, `payload` and `error` of
+                     every failed message or status.
+    :type failures: List[Dict]
+    :param webhook_log: The WABA Webhook Log of the webhook, if logged.
+    :type webhook_log: str
+    """
+    if not failures:
+        return
+
+    timestamp = now()
+    user = frappe.session.user
+    frappe.db.bulk_insert(
+        "WABA Webhook Dead Letter",
+        ("name", "creation", "modified", "owner", "modified_by", "status", "webhook_log")  # noqa
+        + DEAD_LETTER_FIELDS,
+        [
+            (
+                frappe.generate_hash(length=10),
+                timestamp,
+                timestamp,
+                user,
+                user,
+                "Open",
+                webhook_log,
+            )
+            + tuple(
+                frappe.as_json(failure.payload)
+                if field == "payload"
+                else failure.get(field)
+                for field in DEAD_LETTER_FIELDS
+            )
+            for failure in failures
+        ],
+    )
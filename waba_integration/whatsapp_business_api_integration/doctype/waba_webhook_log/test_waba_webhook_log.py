@@ -1,9 +1,148 @@
 # Copyright (c) 2022, Hussain Nagaria and Contributors
 # See license.txt
 
-# import frappe
+import random
+from unittest.mock import Mock, patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from waba_integration.api.webhook import process_payload
+from waba_integration.benchmarks.webhooks import get_message, get_payload
+from waba_integration.dedup import get_unseen
+from waba_integration.realtime import PENDING_UPDATES_KEY
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_contact.waba_whatsapp_contact import (  # noqa
+    KNOWN_CONTACTS_CACHE_KEY,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_message.waba_whatsapp_message import (  # noqa
+    create_waba_whatsapp_messages,
+)
 
 
 class TestWABAWebhookLog(FrappeTestCase):
-	pass
+    def setUp(self):
+        self.rng = random.Random(17)
+        self.cache = frappe.cache()
+        self.cache.delete(
+            self.cache.make_key(KNOWN_CONTACTS_CACHE_KEY),
+            self.cache.make_key(PENDING_UPDATES_KEY),
+        )
+        frappe.local.waba_realtime_updates = None
+
+    def test_failed_event_leaves_no_side_effects(self):
+        good = get_message(self.rng, "1555" + frappe.generate_hash(length=8), 0)  # noqa
+        bad = get_message(self.rng, "1555" + frappe.generate_hash(length=8), 0)  # noqa
+
+        def create_messages(messages, contacts):
+            create_waba_whatsapp_messages(messages, contacts)
+            if any(message["id"] == bad["id"] for message in messages):
+                raise frappe.ValidationError("Bad message")
+
+        with patch(
+            "waba_integration.api.webhook.create_waba_whatsapp_messages",
+            create_messages,
+        ), patch("frappe.enqueue"):
+            failures = process_payload(get_payload([good, bad], [], 1))
+            frappe.db.after_commit.run()
+
+        self.assertEqual(
+            [failure.event_key for failure in failures],
+            [f"message:{bad['id']}"],
+        )
+        self.assertTrue(
+            frappe.db.exists("WABA WhatsApp Message", {"id": good["id"]})
+        )
+        self.assertFalse(
+            frappe.db.exists("WABA WhatsApp Message", {"id": bad["id"]})
+        )
+
+        known_contacts, pending_updates = (
+            self.cache.pipeline()
+            .hkeys(self.cache.make_key(KNOWN_CONTACTS_CACHE_KEY))
+            .hkeys(self.cache.make_key(PENDING_UPDATES_KEY))
+            .execute()
+        )
+        self.assertEqual(
+            {contact.decode() for contact in known_contacts}, {good["from"]}
+        )
+        self.assertEqual(
+            {name.decode() for name in pending_updates},
+            {frappe.db.get_value("WABA WhatsApp Message", {"id": good["id"]})},
+        )
+
+        # The failed message is processed again if Meta redelivers it
+        self.assertEqual(
+            get_unseen([f"message:{good['id']}", f"message:{bad['id']}"]),
+            {f"message:{bad['id']}"},
+        )
+
+    def test_entries_are_processed_as_one_batch(self):
+        outgoing = frappe.get_doc(
+            {
+                "doctype": "WABA WhatsApp Message",
+                "type": "Outgoing",
+                "status": "Sent",
+                "message_type": "Text",
+                "message_body": "Hello",
+                "id": f"wamid.{frappe.generate_hash()}",
+            }
+        )
+        outgoing.set_new_name()
+        outgoing.db_insert()
+
+        messages = [
+            get_message(self.rng, "1555" + frappe.generate_hash(length=8), 0)  # noqa
+            for _ in range(4)
+        ]
+        status = {
+            "id": outgoing.id,
+            "status": "delivered",
+            "timestamp": "1",
+            "recipient_id": messages[0]["from"],
+        }
+        create_messages = Mock(wraps=create_waba_whatsapp_messages)
+
+        with patch(
+            "waba_integration.api.webhook.create_waba_whatsapp_messages",
+            create_messages,
+        ):
+            failures = process_payload(get_payload(messages, [status], 2))
+
+        self.assertEqual(failures, [])
+        create_messages.assert_called_once()
+        self.assertEqual(
+            set(
+                frappe.get_all(
+                    "WABA WhatsApp Message",
+                    filters={"id": ("in", [m["id"] for m in messages])},
+                    pluck="from",
+                )
+            ),
+            {message["from"] for message in messages},
+        )
+        for message in messages:
+            self.assertTrue(
+                frappe.db.exists("WABA WhatsApp Contact", message["from"])
+            )
+        self.assertEqual(
+            frappe.db.get_value("WABA WhatsApp Message", outgoing.name, "status"),  # noqa
+            "Delivered",
+        )
+
+    def test_duplicate_events_are_dropped(self):
+        message = get_message(self.rng, "1555" + frappe.generate_hash(length=8), 0)  # noqa
+        payload = get_payload([message, message], [], 1)
+        create_messages = Mock(wraps=create_waba_whatsapp_messages)
+
+        with patch(
+            "waba_integration.api.webhook.create_waba_whatsapp_messages",
+            create_messages,
+        ), patch("frappe.enqueue"):
+            process_payload(payload)
+            frappe.db.after_commit.run()
+
+            # Meta redelivers the webhook
+            process_payload(payload)
+
+        first, redelivered = create_messages.call_args_list
+        self.assertEqual(first.args[0], [message])
+        self.assertEqual(redelivered.args[0], [])
@@ -1,8 +1,139 @@
 # Copyright (c) 2022, Hussain Nagaria and contributors
 # For license information, please see license.txt
 
-# import frappe
+import base64
+import random
+import zlib
+from typing import Dict
+
+import frappe
 from frappe.model.document import Document
+from frappe.utils import add_to_date
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    get_waba_settings,
+)
+
+# Number of old logs deleted per transaction, see `clear_old_logs`
+PURGE_CHUNK_SIZE = 1000
+
 
 class WABAWebhookLog(Document):
-	pass
+    def onload(self):
+        # Compressed payloads are only decompressed to be viewed
+        if self.compressed_payload:
+            self.payload = decompress_payload(self.compressed_payload)
+
+    @staticmethod
+    def clear_old_logs(days: int = 30):
+        """
+        Deletes the logs older than `days`, called by Log Settings.
+
+        Logs are deleted in chunks, each in its own transaction, so that the
+        table is never locked for long. Logs still waiting to be processed
+        are kept.
+
+        :param days: The number of days to keep the logs for.
+        :type days: int
+        """
+        values = {
+            "before": add_to_date(None, days=-days),
+            "limit": PURGE_CHUNK_SIZE,
+        }
+        while log_names := frappe.db.sql(
+            """
+            select name from `tabWABA Webhook Log`
+            where
+                creation < %(before)s
+                and coalesce(status, '') not in ('Queued', 'Processing')
+            limit %(limit)s
+            """,
+            values,
+            pluck=True,
+        ):
+            frappe.db.delete("WABA Webhook Log", {"name": ("in", log_names)})
+            frappe.db.commit()
+
+
+def insert_webhook_log(data: bytes, status: str, error: str = None) -> str:
+    """
+    Inserts a WABA Webhook Log with the raw payload of a webhook.
+
+    The request body is stored as received, compressed, instead of being
+    parsed and serialized again.
+
+    :param data: The body of the webhook request.
+    :type data: bytes
+    :param status: The status of the log.
+    :type status: str
+    :param error: The traceback, if processing the webhook failed.
+    :type error: str
+    :return: The name of the log.
+    :rtype: str
+    """
+    return (
+        frappe.get_doc(
+            {
+                "doctype": "WABA Webhook Log",
+                "status": status,
+                "compressed_payload": compress_payload(data),
+                "error": error,
+            }
+        )
+        .insert(ignore_permissions=True)
+        .name
+    )
+
+
+def get_webhook_log_payload(log_name: str) -> str:
+    """
+    Returns the payload of a WABA Webhook Log, compressed or not.
+
+    :param log_name: The name of the log.
+    :type log_name: str
+    :return: The payload, as JSON.
+    :rtype: str
+    """
+    log: Dict = frappe.db.get_value(
+        "WABA Webhook Log",
+        log_name,
+        ["payload", "compressed_payload"],
+        as_dict=True,
+    )
+    if log.compressed_payload:
+        return decompress_payload(log.compressed_payload)
+
+    return log.payload
+
+
+def should_log_success() -> bool:
+    """
+    Tells whether a successfully processed webhook is kept in the logs.
+
+    :return: True for `Log Successful Webhooks` percent of the webhooks.
+    :rtype: bool
+    """
+    return random.uniform(0, 100) < get_waba_settings().webhook_log_sample_rate  # noqa
+
+
+def compress_payload(data: bytes) -> str:
+    """
+    Compresses a payload to be stored in a text field.
+
+    :param data: The payload.
+    :type data: bytes
+    :return: The payload, compressed with zlib and base64 encoded.
+    :rtype: str
+    """
+    return base64.b64encode(zlib.compress(data)).decode()
+
+
+def decompress_payload(compressed_payload: str) -> str:
+    """
+    Decompresses a payload stored by `compress_payload`.
+
+    :param compressed_payload: The compressed payload.
+    :type compressed_payload: str
+    :return: The payload.
+    :rtype: str
+    """
+    return zlib.decompress(base64.b64decode(compressed_payload)).decode()
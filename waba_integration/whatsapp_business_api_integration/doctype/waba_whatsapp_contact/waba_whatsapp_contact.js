@@ -1,8 +1,18 @@
 // Copyright (c) 2022, Hussain Nagaria and contributors
 // For license information, please see license.txt
 
-frappe.ui.form.on('WABA WhatsApp Contact', {
-	// refresh: function(frm) {
-
-	// }
+frappe.ui.form.on("WABA WhatsApp Contact", {
+  refresh: function (frm) {
+    if (frm.doc.unread_count) {
+      const btn = frm.add_custom_button("Mark as Seen", () => {
+        frappe
+          .call({
+            method: "waba_integration.api.messages.mark_conversation_seen",
+            args: { contact: frm.doc.name },
+            btn,
+          })
+          .then(() => frm.reload_doc());
+      });
+    }
+  },
 });
@@ -1,8 +1,444 @@
 # Copyright (c) 2022, Hussain Nagaria and contributors
 # For license information, please see license.txt
 
-# import frappe
+from typing import Dict, Iterable, List
+
+import frappe
 from frappe.model.document import Document
+from frappe.utils import cstr, now
+
+# Redis hash of the contacts known to exist, WhatsApp ID -> display name
+KNOWN_CONTACTS_CACHE_KEY = "waba_known_whatsapp_contacts"
+KNOWN_CONTACTS_CACHE_TTL = 24 * 60 * 60
+
+# The per-process memo is dropped once it grows past this many contacts
+KNOWN_CONTACTS_LOCAL_MAX = 100_000
+
+# Per-process memo of the known contacts by site, see `get_known_contacts`
+_known_contacts_by_site: Dict[str, Dict[str, str]] = {}
+
+# Inbox summary fields set from the last message, see `update_inbox_summaries`.
+# `last_message_at` comes last: MariaDB sees the values already assigned by
+# the previous fields of an UPDATE, so it is only replaced once they are.
+INBOX_SUMMARY_FIELDS = (
+    "last_message",
+    "last_message_type",
+    "last_message_status",
+    "last_message_preview",
+    "last_message_at",
+)
+
+# Number of characters of a message shown in the inbox
+INBOX_PREVIEW_LENGTH = 140
+
+# Maximum number of contacts updated by a single UPDATE statement
+INBOX_UPDATE_CHUNK_SIZE = 1000
+
 
 class WABAWhatsAppContact(Document):
-	pass
+    def on_update(self):
+        forget_contacts([self.name])
+
+    def after_rename(self, old, new, merge=False):
+        forget_contacts([old, new])
+
+    def on_trash(self):
+        forget_contacts([self.name])
+
+
+def resolve_waba_whatsapp_contacts(
+    whatsapp_ids: Iterable[str],
+    display_names: Dict[str, str] = None,
+    update_display_names: bool = False,
+):
+    """
+    Makes sure WABA WhatsApp Contacts exist for the given WhatsApp IDs.
+
+    Contacts already known to exist are skipped without touching the
+    database, see `get_known_contacts`. The others are written with a
+    single insert that ignores (or, with `update_display_names`, updates)
+    the contacts created in the meantime by another worker, so concurrent
+    webhooks for a new contact never fail on a duplicate entry.
+
+    :param whatsapp_ids: The WhatsApp IDs of the contacts.
+    :type whatsapp_ids: Iterable[str]
+    :param display_names: The display names of the contacts, by WhatsApp ID.
+    :type display_names: Dict[str, str]
+    :param update_display_names: Whether the display names replace the ones
+                                 of existing contacts, as for the profile
+                                 names of a webhook. Otherwise, they are only
+                                 set on new contacts.
+    :type update_display_names: bool
+    """  # noqa
+    display_names = {
+        whatsapp_id: display_name
+        for whatsapp_id, display_name in (display_names or {}).items()
+        if whatsapp_id and display_name
+    }
+    whatsapp_ids = {
+        whatsapp_id for whatsapp_id in whatsapp_ids if whatsapp_id
+    } | set(display_names)
+    if not whatsapp_ids:
+        return
+
+    known_contacts = get_known_contacts(whatsapp_ids)
+    to_write = [
+        whatsapp_id
+        for whatsapp_id in whatsapp_ids
+        if whatsapp_id not in known_contacts
+        or (
+            update_display_names
+            and whatsapp_id in display_names
+            and display_names[whatsapp_id] != known_contacts[whatsapp_id]
+        )
+    ]
+    if not to_write:
+        return
+
+    write_waba_whatsapp_contacts(to_write, display_names, update_display_names)
+
+    # Only remember the contacts once they are committed
+    written_contacts = {
+        whatsapp_id: display_names.get(whatsapp_id)
+        or known_contacts.get(whatsapp_id)
+        or ""
+        for whatsapp_id in to_write
+    }
+    frappe.db.after_commit.add(lambda: remember_contacts(written_contacts))
+
+
+def write_waba_whatsapp_contacts(
+    whatsapp_ids: List[str],
+    display_names: Dict[str, str],
+    update_display_names: bool = False,
+):
+    """
+    Inserts WABA WhatsApp Contacts with a single query, ignoring duplicates.
+
+    :param whatsapp_ids: The WhatsApp IDs of the contacts.
+    :type whatsapp_ids: List[str]
+    :param display_names: The display names of the contacts, by WhatsApp ID.
+    :type display_names: Dict[str, str]
+    :param update_display_names: Whether the display names of existing
+                                 contacts are updated instead of ignored.
+    :type update_display_names: bool
+    """
+    timestamp = now()
+    user = frappe.session.user
+    values = [
+        (
+            whatsapp_id,
+            whatsapp_id,
+            display_names.get(whatsapp_id),
+            timestamp,
+            timestamp,
+            user,
+            user,
+        )
+        for whatsapp_id in whatsapp_ids
+    ]
+    fields = (
+        "name",
+        "whatsapp_id",
+        "display_name",
+        "creation",
+        "modified",
+        "owner",
+        "modified_by",
+    )
+
+    if not update_display_names:
+        frappe.db.bulk_insert(
+            "WABA WhatsApp Contact", fields, values, ignore_duplicates=True
+        )
+        return
+
+    # Contacts without a display name are only inserted, never blanked out
+    insert_query = """
+        insert into `tabWABA WhatsApp Contact` ({fields})
+        values {values}
+    """.format(
+        fields=", ".join(f"`{field}`" for field in fields),
+        values=", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(values)),
+    )
+    frappe.db.multisql(
+        {
+            "mariadb": insert_query
+            + """
+            on duplicate key update
+                display_name = coalesce(values(display_name), display_name),
+                modified = if(
+                    values(display_name) is null, modified, values(modified)
+                )
+            """,
+            "postgres": insert_query.replace("`", '"')
+            + """
+            on conflict (name) do update set
+                display_name = coalesce(excluded.display_name, "tabWABA WhatsApp Contact".display_name),
+                modified = case
+                    when excluded.display_name is null
+                    then "tabWABA WhatsApp Contact".modified
+                    else excluded.modified
+                end
+            """,  # noqa
+        },
+        [value for row in values for value in row],
+    )
+
+
+def get_known_contacts(whatsapp_ids: Iterable[str]) -> Dict[str, str]:
+    """
+    Returns the contacts known to exist among the given WhatsApp IDs.
+
+    The contacts are looked up in a per-process memo first, then in a Redis
+    hash shared by all the workers of the site. Neither is authoritative:
+    a contact missing from both is simply written again.
+
+    :param whatsapp_ids: The WhatsApp IDs to look up.
+    :type whatsapp_ids: Iterable[str]
+    :return: The display names of the known contacts, by WhatsApp ID.
+    :rtype: Dict[str, str]
+    """
+    local_contacts = _known_contacts_by_site.setdefault(frappe.local.site, {})
+    known_contacts = {
+        whatsapp_id: local_contacts[whatsapp_id]
+        for whatsapp_id in whatsapp_ids
+        if whatsapp_id in local_contacts
+    }
+
+    if missing := [
+        whatsapp_id
+        for whatsapp_id in whatsapp_ids
+        if whatsapp_id not in known_contacts
+    ]:
+        cache = frappe.cache()
+        display_names = cache.hmget(
+            cache.make_key(KNOWN_CONTACTS_CACHE_KEY), missing
+        )
+        cached_contacts = {
+            whatsapp_id: cstr(display_name)
+            for whatsapp_id, display_name in zip(missing, display_names)
+            if display_name is not None
+        }
+        remember_locally(cached_contacts)
+        known_contacts.update(cached_contacts)
+
+    return known_contacts
+
+
+def remember_contacts(contacts: Dict[str, str]):
+    """
+    Adds contacts to the known contacts, in Redis and in this process.
+
+    :param contacts: The display names of the contacts, by WhatsApp ID.
+    :type contacts: Dict[str, str]
+    """
+    if not contacts:
+        return
+
+    cache = frappe.cache()
+    key = cache.make_key(KNOWN_CONTACTS_CACHE_KEY)
+    cache.pipeline().hset(key, mapping=contacts).expire(
+        key, KNOWN_CONTACTS_CACHE_TTL
+    ).execute()
+    remember_locally(contacts)
+
+
+def remember_locally(contacts: Dict[str, str]):
+    """
+    Adds contacts to the per-process memo of known contacts.
+
+    :param contacts: The display names of the contacts, by WhatsApp ID.
+    :type contacts: Dict[str, str]
+    """
+    local_contacts = _known_contacts_by_site.setdefault(frappe.local.site, {})
+    if len(local_contacts) + len(contacts) > KNOWN_CONTACTS_LOCAL_MAX:
+        local_contacts.clear()
+
+    local_contacts.update(contacts)
+
+
+def forget_contacts(whatsapp_ids: List[str]):
+    """
+    Removes contacts from the known contacts, when they change or go away.
+
+    Other processes may still remember them until their memo is dropped.
+
+    :param whatsapp_ids: The WhatsApp IDs of the contacts.
+    :type whatsapp_ids: List[str]
+    """
+    cache = frappe.cache()
+    cache.pipeline().hdel(
+        cache.make_key(KNOWN_CONTACTS_CACHE_KEY), *whatsapp_ids
+    ).execute()
+
+    local_contacts = _known_contacts_by_site.get(frappe.local.site, {})
+    for whatsapp_id in whatsapp_ids:
+        local_contacts.pop(whatsapp_id, None)
+
+
+def get_profile_names(contacts: List[Dict]) -> Dict[str, str]:
+    """
+    Returns the WhatsApp profile names from the `contacts` of a webhook.
+
+    :param contacts: The `contacts` of all the changes of a webhook payload.
+    :type contacts: List[Dict]
+    :return: The profile names, by WhatsApp ID.
+    :rtype: Dict[str, str]
+    """
+    return {
+        contact.get("wa_id"): (contact.get("profile") or {}).get("name")
+        for contact in contacts or []
+        if contact.get("wa_id")
+    }
+
+
+def update_inbox_summaries(messages: List[Dict]):
+    """
+    Updates the inbox summary of the contacts of newly inserted messages.
+
+    The summaries are updated incrementally, so the inbox never has to be
+    computed from the messages: the last message of every contact replaces
+    its current one unless it is older, and its unread incoming messages
+    are added to its `unread_count`. All the contacts are updated with a
+    single UPDATE, however many messages there are.
+
+    :param messages: The WABA WhatsApp Messages, as dicts or documents,
+                     with their `name`, `creation`, `type`, `from`, `to`,
+                     `status`, `message_type`, `message_body` and
+                     `media_caption`.
+    :type messages: List[Dict]
+    """
+    summaries = {}
+    for message in messages:
+        incoming = message.get("type") == "Incoming"
+        contact = message.get("from") if incoming else message.get("to")
+        if not contact:
+            continue
+
+        summary = summaries.setdefault(contact, frappe._dict(unread_count=0))
+        if incoming and message.get("status") == "Received":
+            summary.unread_count += 1
+
+        creation = str(message.get("creation"))
+        if not summary.last_message_at or creation >= summary.last_message_at:
+            summary.update(
+                last_message=message.get("name"),
+                last_message_type=message.get("type"),
+                last_message_status=message.get("status"),
+                last_message_preview=get_message_preview(message),
+                last_message_at=creation,
+            )
+
+    contacts = list(summaries)
+    for start in range(0, len(contacts), INBOX_UPDATE_CHUNK_SIZE):
+        end = start + INBOX_UPDATE_CHUNK_SIZE
+        chunk = contacts[start:end]
+        values = {"contacts": tuple(chunk)}
+        cases = {field: [] for field in INBOX_SUMMARY_FIELDS + ("unread_count",)}  # noqa
+        for i, contact in enumerate(chunk):
+            values[f"contact_{i}"] = contact
+            for field, case in cases.items():
+                values[f"{field}_{i}"] = summaries[contact][field]
+                case.append(f"when %(contact_{i})s then %({field}_{i})s")
+
+        new_values = {
+            field: f"case name {' '.join(case)} end"
+            for field, case in cases.items()
+        }
+        # Postgres does not compare timestamps with text, cast it explicitly
+        new_values["last_message_at"] = "cast({} as {})".format(
+            new_values["last_message_at"],
+            "timestamp" if frappe.db.db_type == "postgres" else "datetime(6)",
+        )
+        is_newer = (
+            "coalesce(last_message_at, '1900-01-01 00:00:00') <= "
+            + new_values["last_message_at"]
+        )
+        assignments = [
+            f"unread_count = unread_count + {new_values['unread_count']}"
+        ] + [
+            f"{field} = case when {is_newer} then {new_values[field]} else {field} end"  # noqa
+            for field in INBOX_SUMMARY_FIELDS
+        ]
+
+        frappe.db.sql(
+            f"""
+            update `tabWABA WhatsApp Contact`
+            set {", ".join(assignments)}
+            where name in %(contacts)s
+            """,
+            values,
+        )
+
+
+def refresh_last_message_statuses(
+    message_names: List[str] = None, message_ids: List[str] = None
+):
+    """
+    Copies the status of messages to the contacts they are the last one of.
+
+    :param message_names: The names of the messages whose status changed.
+    :type message_names: List[str]
+    :param message_ids: Or their WhatsApp message IDs.
+    :type message_ids: List[str]
+    """
+    if message_names:
+        condition = "last_message in %(messages)s"
+        messages = message_names
+    elif message_ids:
+        condition = """last_message in (
+            select name from `tabWABA WhatsApp Message`
+            where id in %(messages)s
+        )"""
+        messages = message_ids
+    else:
+        return
+
+    frappe.db.sql(
+        f"""
+        update `tabWABA WhatsApp Contact`
+        set last_message_status = (
+            select status from `tabWABA WhatsApp Message`
+            where name = `tabWABA WhatsApp Contact`.last_message
+        )
+        where {condition}
+        """,
+        {"messages": tuple(messages)},
+    )
+
+
+def decrement_unread_count(contact: str, count: int = 1):
+    """
+    Takes incoming messages marked as seen off the unread count of a contact.
+
+    :param contact: The WABA WhatsApp Contact.
+    :type contact: str
+    :param count: The number of messages marked as seen.
+    :type count: int
+    """
+    frappe.db.sql(
+        """
+        update `tabWABA WhatsApp Contact`
+        set unread_count = greatest(unread_count - %(count)s, 0)
+        where name = %(contact)s
+        """,
+        {"contact": contact, "count": count},
+    )
+
+
+def get_message_preview(message: Dict) -> str:
+    """
+    Returns the text of a message shown in the inbox.
+
+    :param message: The WABA WhatsApp Message.
+    :type message: Dict
+    :return: The body or caption of the message, shortened, or its type.
+    :rtype: str
+    """
+    text = message.get("message_body") or message.get("media_caption")
+    preview = " ".join(cstr(text).split())
+    if len(preview) > INBOX_PREVIEW_LENGTH:
+        preview = preview[: INBOX_PREVIEW_LENGTH - 1] + "…"
+
+    return preview or cstr(message.get("message_type"))
@@ -1,9 +1,167 @@
 # Copyright (c) 2022, Hussain Nagaria and Contributors
 # See license.txt
 
-# import frappe
+import random
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, now_datetime
+from waba_integration.api.messages import (
+    get_conversation,
+    get_inbox,
+    mark_conversation_seen,
+)
+from waba_integration.benchmarks.webhooks import get_message
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_message.waba_whatsapp_message import (  # noqa
+    create_waba_whatsapp_messages,
+)
 
 
 class TestWABAWhatsAppMessage(FrappeTestCase):
-	pass
+    def setUp(self):
+        self.contacts = [
+            insert_contact(f"1555{frappe.generate_hash(length=8)}")
+            for _ in range(2)
+        ]
+        self.messages = {
+            contact: insert_message(contact, minutes)
+            for minutes, contact in enumerate(self.contacts)
+        }
+
+    def tearDown(self):
+        frappe.set_user("Administrator")
+
+    def test_restricted_user_only_reads_permitted_contacts(self):
+        allowed, restricted = self.contacts
+        user = frappe.get_doc(
+            {
+                "doctype": "User",
+                "email": f"{frappe.generate_hash(length=8)}@example.com",
+                "first_name": "Restricted",
+                "send_welcome_email": 0,
+                "roles": [{"role": "System Manager"}],
+            }
+        ).insert(ignore_permissions=True)
+        frappe.get_doc(
+            {
+                "doctype": "User Permission",
+                "user": user.name,
+                "allow": "WABA WhatsApp Contact",
+                "for_value": allowed,
+            }
+        ).insert(ignore_permissions=True)
+
+        frappe.set_user(user.name)
+        contacts = [contact.name for contact in get_inbox()["contacts"]]
+        self.assertIn(allowed, contacts)
+        self.assertNotIn(restricted, contacts)
+
+        self.assertEqual(
+            [message.name for message in get_conversation(allowed)["messages"]],  # noqa
+            [self.messages[allowed]],
+        )
+        self.assertEqual(get_conversation(restricted)["messages"], [])
+
+        with patch("waba_integration.api.messages.graph_api.post") as post:
+            self.assertEqual(mark_conversation_seen(restricted), 0)
+        post.assert_not_called()
+        self.assertEqual(
+            frappe.db.get_value(
+                "WABA WhatsApp Message", self.messages[restricted], "status"
+            ),
+            "Received",
+        )
+
+    def test_conversation_is_paged_newest_first(self):
+        contact = self.contacts[0]
+        for minutes in range(2, 7):
+            insert_message(
+                contact, minutes, "Outgoing" if minutes % 2 else "Incoming"
+            )
+        expected = frappe.get_all(
+            "WABA WhatsApp Message",
+            or_filters={"from": contact, "to": contact},
+            order_by="creation desc, name desc",
+            pluck="name",
+        )
+
+        pages = get_conversation_pages(contact, limit=2)
+
+        self.assertEqual(len(expected), 6)
+        self.assertEqual([len(page) for page in pages], [2, 2, 2])
+        self.assertEqual(sum(pages, []), expected)
+
+    def test_messages_created_together_are_paged_once(self):
+        contact = self.contacts[0]
+        creation = add_to_date(now_datetime(), minutes=10)
+        for _ in range(5):
+            insert_message(contact, creation=creation)
+
+        pages = get_conversation_pages(contact, limit=2)
+
+        names = sum(pages, [])
+        self.assertEqual([len(page) for page in pages], [2, 2, 2])
+        self.assertEqual(len(set(names)), 6)
+        self.assertEqual(names[-1], self.messages[contact])
+
+    def test_burst_is_listed_in_the_order_it_arrived(self):
+        rng = random.Random(18)
+        contact = f"1555{frappe.generate_hash(length=8)}"
+        messages = [get_message(rng, contact, 0) for _ in range(5)]
+
+        with patch("frappe.enqueue"):
+            names = create_waba_whatsapp_messages(messages)
+
+        self.assertEqual(
+            sum(get_conversation_pages(contact, limit=2), []),
+            list(reversed(names)),
+        )
+
+
+def get_conversation_pages(contact: str, limit: int) -> list:
+    pages, before = [], None
+    while True:
+        page = get_conversation(contact, before=before, limit=limit)
+        pages.append([message.name for message in page["messages"]])
+        before = page["next_cursor"]
+        if not before:
+            return pages
+
+
+def insert_contact(whatsapp_id: str) -> str:
+    return (
+        frappe.get_doc(
+            {
+                "doctype": "WABA WhatsApp Contact",
+                "whatsapp_id": whatsapp_id,
+                "last_message_at": now_datetime(),
+            }
+        )
+        .insert(ignore_permissions=True)
+        .name
+    )
+
+
+def insert_message(
+    contact: str, minutes: int = 0, type: str = "Incoming", creation=None
+) -> str:
+    incoming = type == "Incoming"
+    message = frappe.get_doc(
+        {
+            "doctype": "WABA WhatsApp Message",
+            "type": type,
+            "status": "Received" if incoming else "Sent",
+            "message_type": "Text",
+            "message_body": "Hello",
+            "id": f"wamid.{frappe.generate_hash()}",
+            "from" if incoming else "to": contact,
+        }
+    )
+    # Inserted without hooks, only the rows are needed
+    message.set_new_name()
+    message.creation = message.modified = creation or add_to_date(
+        now_datetime(), minutes=minutes
+    )
+    message.db_insert()
+    return message.name
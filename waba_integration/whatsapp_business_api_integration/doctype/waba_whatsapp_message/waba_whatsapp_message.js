@@ -2,6 +2,29 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on("WABA WhatsApp Message", {
+  setup: function (frm) {
+    // New statuses are patched in, without reloading the whole document
+    frappe.realtime.doctype_subscribe(frm.doctype);
+    frappe.realtime.on("waba_message_updates", (data) => {
+      if (!frm.doc || frm.is_new()) return;
+
+      const update = data.messages.find((m) => m.name === frm.doc.name);
+      if (update && update.modified && !frm.is_dirty()) {
+        Object.assign(frm.doc, {
+          status: update.status,
+          modified: update.modified,
+        });
+        frm.refresh();
+      } else if (
+        (update || data.reload) &&
+        cur_frm === frm &&
+        !frm.is_dirty()
+      ) {
+        frm.reload_doc();
+      }
+    });
+  },
+
   refresh: function (frm) {
     if (!frm.doc.id) {
       const btn = frm.add_custom_button("Send Message", () => {
@@ -1,30 +1,77 @@
 # Copyright (c) 2022, Hussain Nagaria and contributors
 # For license information, please see license.txt
 
+import hashlib
 import json
 import mimetypes
-from typing import Dict
+import os
+from datetime import timedelta
+from typing import Dict, List
 
 import frappe
-import requests
 from frappe.model.document import Document
-from frappe.utils import nowdate
-from frappe.utils.safe_exec import get_safe_globals
+from frappe.utils import now_datetime, nowdate
+from waba_integration import graph_api, metrics
+from waba_integration.dispatch import get_response_outcome
+from waba_integration.media import (
+    download_media_file,
+    get_file_path,
+    insert_file,
+    upload_media_file,
+)
+from waba_integration.outbox import add_to_outbox
+from waba_integration.rate_limit import pause_sending
+from waba_integration.realtime import publish_message_updates
+from waba_integration.whatsapp_business_api_integration.doctype.waba_message_status_update.waba_message_status_update import (  # noqa
+    apply_status_updates,
+    apply_unmatched_statuses,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    get_waba_settings,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_contact.waba_whatsapp_contact import (  # noqa
+    decrement_unread_count,
+    get_profile_names,
+    refresh_last_message_statuses,
+    resolve_waba_whatsapp_contacts,
+    update_inbox_summaries,
+)
+from waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_message_template.waba_whatsapp_message_template import (  # noqa
+    get_message_template,
+    get_safe_frappe,
+    render_components,
+)
 
 MEDIA_TYPES = ("image", "sticker", "document", "audio", "video")
 
+# Rendered PDFs are reused for this long, as long as the document is unchanged
+REFERENCE_PDF_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Fields set on incoming messages, see `get_incoming_message_data`
+INCOMING_MESSAGE_FIELDS = (
+    "type",
+    "status",
+    "from",
+    "id",
+    "message_type",
+    "message_body",
+    "media_id",
+    "media_mime_type",
+    "media_hash",
+    "media_filename",
+    "media_caption",
+)
+
+# Composite indexes, by name, see `on_doctype_update`
+MESSAGE_INDEXES = {
+    "from_creation_index": ["`from`", "creation"],
+    "to_creation_index": ["`to`", "creation"],
+    "status_type_index": ["status", "type"],
+    "document_type_document_name_index": ["document_type", "document_name"],
+}
 
-class WABAWhatsAppMessage(Document):
-    def __init__(self, *args, **kwargs):
-        """
-        Initializes the WABA WhatsApp Message.
-
-        The `access_token` is set to `None`, it is set when the access token is
-        fetched from the WABA Settings.
-        """
-        super().__init__(*args, **kwargs)
-        self._access_token = None
 
+class WABAWhatsAppMessage(Document):
     def validate(self):
         """
         Validate that the WABA WhatsApp Message can be sent.
@@ -32,8 +79,7 @@ class WABAWhatsAppMessage(Document):
         This method checks if the WABA WhatsApp Message is enabled, the image attachment
         is valid, and sets the preview html if the message type is an audio or a video.
         """  # noqa
-        settings = frappe.get_single("WABA Settings")
-        if not settings.enabled:
+        if not get_waba_settings().enabled:
             frappe.throw("WhatsApp Business API integration is not enabled.")
 
         self.validate_image_attachment()
@@ -68,6 +114,20 @@ class WABAWhatsAppMessage(Document):
         if self.attach_print:
             self.generate_reference_pdf()
 
+        update_inbox_summaries([self])
+        publish_message_updates([self])
+
+    def on_update(self):
+        # Keep the inbox summary of the contact in sync with the status
+        doc_before_save = self.get_doc_before_save()
+        if not doc_before_save or doc_before_save.status == self.status:
+            return
+
+        refresh_last_message_statuses([self.name])
+        publish_message_updates([self])
+        if doc_before_save.status == "Received" and self.type == "Incoming":
+            decrement_unread_count(self.get("from"))
+
     def generate_reference_pdf(self):
         """
         Generate a reference PDF for the WABA WhatsApp Message.
@@ -79,28 +139,13 @@ class WABAWhatsAppMessage(Document):
         The language of the PDF is set to the system's language.
         """  # noqa
         if self.attach_print:
-            system_language = frappe.db.get_single_value(
-                "System Settings", "language"
-            )  # noqa
-            pdf_print = frappe.attach_print(
+            pdf_attachment = create_reference_pdf(
                 self.document_type,
                 self.document_name,
-                print_format=self.print_format or "Standard",
-                lang=system_language,
-            )
-
-            pdf_attachment = frappe.get_doc(
-                {
-                    "doctype": "File",
-                    "file_name": pdf_print["fname"],  # noqa
-                    "is_private": 1,
-                    "content": pdf_print["fcontent"],
-                    "attached_to_doctype": self.doctype,
-                    "attached_to_name": self.name,
-                    "attached_to_field": "media_file",
-                }
+                self.print_format,
+                self.doctype,
+                self.name,
             )
-            pdf_attachment.save(ignore_permissions=True)
 
             self.db_set("media_mime_type", "application/pdf")
             self.db_set("media_file", pdf_attachment.file_url)
@@ -138,23 +183,49 @@ class WABAWhatsAppMessage(Document):
         If the message type is Template, the template components are rendered and sent as a WhatsApp
         template message.
 
+        If the phone number is rate limited or the API fails temporarily, the message is
+        queued in the outbox instead, to be sent again later.
+
         Returns a dictionary containing the response from the WhatsApp Business API.
         """  # noqa
-        if not self.to:
-            frappe.throw("Recepient (`to`) is required to send message.")
+        response_data = self.get_request_data()
+        phone_number_id = get_waba_settings().phone_number_id
+        response = graph_api.post(
+            f"{phone_number_id}/messages", endpoint="send", json=response_data
+        )
+
+        if response.ok:
+            self.id = response.json().get("messages")[0]["id"]
+            self.status = "Sent"
+            self.save(ignore_permissions=True)
+            apply_unmatched_statuses([self.id])
+            return response.json()
 
-        access_token = frappe.utils.password.get_decrypted_password(
-            "WABA Settings", "WABA Settings", "access_token"
+        outcome = get_response_outcome(response)
+        if not outcome.retryable or self.is_new():
+            frappe.throw(outcome.error)
+
+        if outcome.pause:
+            pause_sending(phone_number_id, outcome.pause)
+
+        add_to_outbox([self.name])
+        self.reload()
+        frappe.msgprint(
+            f"The message could not be sent right now ({outcome.error}), it will be sent again from the outbox."  # noqa
         )
-        api_version = frappe.db.get_single_value(
-            "WABA Settings", "api_version"
-        )  # noqa
-        api_base = f"https://graph.facebook.com/{api_version}"
-        phone_number_id = frappe.db.get_single_value(
-            "WABA Settings", "phone_number_id"
-        )  # noqa
+        return {}
+
+    def get_request_data(self) -> Dict:
+        """
+        Builds the body of the request that sends this message.
+
+        It validates that the WABA WhatsApp Message has a receipient set, that media is
+        uploaded for media messages and renders the components of template messages.
 
-        endpoint = f"{api_base}/{phone_number_id}/messages"
+        Returns the request data, as expected by the `/messages` endpoint.
+        """  # noqa
+        if not self.to:
+            frappe.throw("Recepient (`to`) is required to send message.")
 
         response_data = {
             "messaging_product": "whatsapp",
@@ -188,79 +259,49 @@ class WABAWhatsAppMessage(Document):
                 ] = self.media_caption  # noqa
 
         if self.message_type == "Template":
-            waba_template = frappe.get_doc(
-                "WABA WhatsApp Message Template",
-                self.message_template,
-            )
-
-            doc = frappe.get_doc(self.document_type, self.document_name)
-            context = get_context(doc)
-            context["message"] = self
+            waba_template = get_message_template(self.message_template)
+            waba_template.validate_can_be_sent()
 
-            template_components = frappe.render_template(
-                waba_template.components, context
-            )
-            template_components = json.loads(template_components)
+            get_doc = None
+            if self.document_type and self.document_name:
+                get_doc = lambda: frappe.get_doc(  # noqa: E731
+                    self.document_type, self.document_name
+                )
 
             response_data["template"] = {
-                "name": waba_template.name,
+                "name": waba_template.template_name or waba_template.name,
                 "language": {"code": waba_template.language_code},
-                "components": template_components,
+                "components": render_components(
+                    waba_template, self, get_doc
+                ),
             }
 
-        response = requests.post(
-            endpoint,
-            json=response_data,
-            headers={
-                "Authorization": "Bearer " + access_token,
-                "Content-Type": "application/json",
-            },
-        )
-
-        if response.ok:
-            self.id = response.json().get("messages")[0]["id"]
-            self.status = "Sent"
-            self.save(ignore_permissions=True)
-            return response.json()
-        else:
-            frappe.throw(response.json().get("error").get("message"))
+        return response_data
 
     @frappe.whitelist()
     def download_media(self) -> Dict:
         """
         Download media from WhatsApp Business API.
 
-        This method downloads the media from WhatsApp Business API and saves it as a file
-        in the file system. It sets the `media_file` field to the URL of the saved file
-        and, if the message type is Image, sets the `media_image` field to the same URL
-        which is used to display the image preview.
+        This method streams the media from WhatsApp Business API into a private file,
+        checking its size and hash, see `download_media_file`. It sets the `media_file`
+        field to the URL of the saved file and, if the message type is Image, sets the
+        `media_image` field to the same URL which is used to display the image preview.
 
         Returns a dictionary with the file document.
         """  # noqa
         url = self.get_media_url()
-        access_token = self.get_access_token()
-        response = requests.get(
+        file_doc = download_media_file(
             url,
-            headers={
-                "Authorization": "Bearer " + access_token,
-            },
+            get_media_extention(
+                self, self.media_mime_type or "application/octet-stream"
+            ),
+            self.media_hash,
+            attached_to_doctype="WABA WhatsApp Message",
+            attached_to_name=self.name,
+            attached_to_field="media_file",
         )
 
-        file_name = get_media_extention(
-            self, response.headers.get("Content-Type")
-        )  # noqa
-        file_doc = frappe.get_doc(
-            {
-                "doctype": "File",
-                "file_name": file_name,
-                "content": response.content,
-                "attached_to_doctype": "WABA WhatsApp Message",
-                "attached_to_name": self.name,
-                "attached_to_field": "media_file",
-                "is_private": True,
-            }
-        ).insert(ignore_permissions=True)
-
         self.set("media_file", file_doc.file_url)
 
         # Will be used to display image preview
@@ -269,7 +310,7 @@ class WABAWhatsAppMessage(Document):
 
         self.save()
 
-        return file_doc.as_dict()
+        return file_doc
 
     def get_media_url(self) -> str:
         """
@@ -280,21 +321,7 @@ class WABAWhatsAppMessage(Document):
         if not self.media_id:
             frappe.throw("`media_id` is missing.")
 
-        access_token = frappe.utils.password.get_decrypted_password(
-            "WABA Settings", "WABA Settings", "access_token"
-        )
-        api_version = frappe.db.get_single_value(
-            "WABA Settings", "api_version"
-        )  # noqa
-        api_base = f"https://graph.facebook.com/{api_version}"
-
-        access_token = self.get_access_token()
-        response = requests.get(
-            f"{api_base}/{self.media_id}",
-            headers={
-                "Authorization": "Bearer " + access_token,
-            },
-        )
+        response = graph_api.get(self.media_id, endpoint="media_url")
 
         if not response.ok:
             frappe.throw("Error fetching media URL")
@@ -307,15 +334,11 @@ class WABAWhatsAppMessage(Document):
 
         The access token is used to authenticate with the Facebook Graph API.
         It is stored as a password in the WABA Settings doctype and decrypted
-        on the fly.
+        once per process, see `get_waba_settings`.
 
         Returns the decrypted access token.
         """
-        if self._access_token is None:
-            self._access_token = frappe.utils.password.get_decrypted_password(
-                "WABA Settings", "WABA Settings", "access_token"
-            )
-        return self._access_token
+        return get_waba_settings().access_token
 
     @frappe.whitelist()
     def upload_media(self):
@@ -328,8 +351,8 @@ class WABAWhatsAppMessage(Document):
         If the `media_mime_type` is not set, it is guessed using the Python
         `mimetypes` module.
 
-        The method uses the `requests` library to send a multi-part form data
-        to the WhatsApp Business API.
+        The method uses the shared Graph API client to send a multi-part form
+        data to the WhatsApp Business API.
 
         If the upload is successful, the `media_uploaded` field is set to `True`
         and the `media_id` field is updated with the media ID returned by the
@@ -347,50 +370,14 @@ class WABAWhatsAppMessage(Document):
         if not self.media_file:
             frappe.throw("`media_file` is required to upload media.")
 
-        media_file_path = frappe.get_doc(
-            "File", {"file_url": self.media_file}
-        ).get_full_path()
-        access_token = self.get_access_token()
-        access_token = frappe.utils.password.get_decrypted_password(
-            "WABA Settings", "WABA Settings", "access_token"
-        )
-        api_version = frappe.db.get_single_value(
-            "WABA Settings", "api_version"
-        )  # noqa
-        api_base = f"https://graph.facebook.com/{api_version}"
-
-        phone_number_id = frappe.db.get_single_value(
-            "WABA Settings", "phone_number_id"
-        )  # noqa
-
         if not self.media_mime_type:
             self.media_mime_type = mimetypes.guess_type(self.media_file)[0]
 
-        # Way to send multi-part form data
-        # Ref: https://stackoverflow.com/a/35974071
-        form_data = {
-            "file": (
-                "file",
-                open(media_file_path, "rb"),
-                self.media_mime_type,
-            ),
-            "messaging_product": (None, "whatsapp"),
-            "type": (None, self.media_mime_type),
-        }
-        response = requests.post(
-            f"{api_base}/{phone_number_id}/media",
-            files=form_data,
-            headers={
-                "Authorization": "Bearer " + access_token,
-            },
+        self.media_id = upload_media_file(
+            self.media_file, self.media_mime_type
         )
-
-        if response.ok:
-            self.media_id = response.json().get("id")
-            self.media_uploaded = True
-            self.save(ignore_permissions=True)
-        else:
-            frappe.throw(response.json().get("error").get("message"))
+        self.media_uploaded = True
+        self.save(ignore_permissions=True)
 
     @frappe.whitelist()
     def mark_as_seen(self):
@@ -413,31 +400,15 @@ class WABAWhatsAppMessage(Document):
         if self.type != "Incoming":
             frappe.throw("Only incoming messages can be marked as seen.")
 
-        access_token = frappe.utils.password.get_decrypted_password(
-            "WABA Settings", "WABA Settings", "access_token"
-        )
-        api_version = frappe.db.get_single_value(
-            "WABA Settings", "api_version"
-        )  # noqa
-        api_base = f"https://graph.facebook.com/{api_version}"
-
-        phone_number_id = frappe.db.get_single_value(
-            "WABA Settings", "phone_number_id"
-        )  # noqa
-        endpoint = f"{api_base}/{phone_number_id}/messages"
-        access_token = self.get_access_token()
-
-        response = requests.post(
-            endpoint,
+        phone_number_id = get_waba_settings().phone_number_id
+        response = graph_api.post(
+            f"{phone_number_id}/messages",
+            endpoint="mark_as_seen",
             json={
                 "messaging_product": "whatsapp",
                 "status": "read",
                 "message_id": self.id,
             },
-            headers={
-                "Authorization": "Bearer " + access_token,
-                "Content-Type": "application/json",
-            },
         )
 
         if response.ok:
@@ -447,6 +418,125 @@ class WABAWhatsAppMessage(Document):
             frappe.throw(response.json().get("error").get("message"))
 
 
+def on_doctype_update():
+    """
+    Adds the indexes used to read conversations and references.
+
+    Conversations are read by contact and creation, see `get_conversation`.
+    """
+    for index_name, fields in MESSAGE_INDEXES.items():
+        frappe.db.add_index("WABA WhatsApp Message", fields, index_name)
+
+
+def create_reference_pdf(
+    document_type: str,
+    document_name: str,
+    print_format: str,
+    attached_to_doctype: str = None,
+    attached_to_name: str = None,
+) -> Document:
+    """
+    Renders the print of a document as a PDF and saves it as a private File.
+
+    The PDF is rendered in the system's language, with the Standard print
+    format if no print format is given.
+
+    The PDF is rendered at most once per version of the document: the File
+    of an earlier render with the same document `modified`, print format and
+    language is reused, see `get_reference_pdf_cache_key`. Since the content
+    is the same, so is the media ID it is uploaded with, see
+    `upload_media_file`.
+
+    :param document_type: The DocType of the document to print.
+    :type document_type: str
+    :param document_name: The name of the document to print.
+    :type document_name: str
+    :param print_format: The print format to use.
+    :type print_format: str
+    :param attached_to_doctype: The DocType the File is attached to, if any.
+    :type attached_to_doctype: str
+    :param attached_to_name: The document the File is attached to, if any.
+    :type attached_to_name: str
+    :return: The File.
+    :rtype: Document
+    """
+    system_language = frappe.db.get_single_value("System Settings", "language")
+    print_format = print_format or "Standard"
+    attached_to_field = "media_file" if attached_to_name else None
+
+    cache_key = get_reference_pdf_cache_key(
+        document_type, document_name, print_format, system_language
+    )
+    if (file_url := frappe.cache().get_value(cache_key)) and (
+        rendered_file := frappe.db.get_value(
+            "File",
+            {"file_url": file_url},
+            ["file_name", "file_size", "content_hash"],
+            as_dict=True,
+        )
+    ):
+        if os.path.exists(get_file_path(file_url)):
+            return insert_file(
+                rendered_file.file_name,
+                file_url,
+                rendered_file.file_size,
+                rendered_file.content_hash,
+                attached_to_doctype,
+                attached_to_name,
+                attached_to_field,
+            )
+
+    pdf_print = frappe.attach_print(
+        document_type,
+        document_name,
+        print_format=print_format,
+        lang=system_language,
+    )
+
+    pdf_attachment = frappe.get_doc(
+        {
+            "doctype": "File",
+            "file_name": pdf_print["fname"],
+            "is_private": 1,
+            "content": pdf_print["fcontent"],
+            "attached_to_doctype": attached_to_doctype,
+            "attached_to_name": attached_to_name,
+            "attached_to_field": attached_to_field,
+        }
+    ).save(ignore_permissions=True)
+
+    frappe.cache().set_value(
+        cache_key,
+        pdf_attachment.file_url,
+        expires_in_sec=REFERENCE_PDF_CACHE_TTL,
+    )
+    return pdf_attachment
+
+
+def get_reference_pdf_cache_key(
+    document_type: str, document_name: str, print_format: str, language: str
+) -> str:
+    """
+    Returns the cache key of the rendered PDF of a version of a document.
+
+    :param document_type: The DocType of the document.
+    :type document_type: str
+    :param document_name: The name of the document.
+    :type document_name: str
+    :param print_format: The print format.
+    :type print_format: str
+    :param language: The language of the print.
+    :type language: str
+    :return: The cache key.
+    :rtype: str
+    """
+    modified = frappe.db.get_value(document_type, document_name, "modified")
+    version = json.dumps(
+        [document_type, document_name, str(modified), print_format, language]
+    )
+    return f"waba_reference_pdf:{hashlib.sha256(version.encode()).hexdigest()}"  # noqa
+
+
 def get_context(doc):
     """
     Returns a context dictionary that can be used to render a template.
@@ -462,7 +552,7 @@ def get_context(doc):
     return {
         "doc": doc,
         "nowdate": nowdate,
-        "frappe": get_safe_globals().get("frappe"),
+        "frappe": get_safe_frappe(),
     }  # noqa
 
 
@@ -482,21 +572,140 @@ def create_waba_whatsapp_message(message: Dict) -> WABAWhatsAppMessage:
     :rtype: WABAWhatsAppMessage
     :raises Exception: Logs an error if there is a problem downloading media.
     """  # noqa
-    message_type = message.get("type")
+    resolve_waba_whatsapp_contacts([message.get("from")])
 
-    # Create whatsapp contact doc if not exists
-    received_from = message.get("from")
-    if not frappe.db.exists("WABA WhatsApp Contact", {"name": received_from}):
-        frappe.get_doc(
-            {
-                "doctype": "WABA WhatsApp Contact",
-                "whatsapp_id": received_from,
-            }
-        ).insert(ignore_permissions=True)
+    message_data = get_incoming_message_data(message)
+    message_data["doctype"] = "WABA WhatsApp Message"
+    message_doc = frappe.get_doc(message_data).insert(ignore_permissions=True)
+
+    if message_doc.message_type in get_automatic_download_types():
+        download_media_as_administrator(message_doc)
+
+    return message_doc
+
+
+def create_waba_whatsapp_messages(
+    messages: List[Dict], contacts: List[Dict] = None
+) -> List[str]:
+    """
+    Bulk inserts WABA WhatsApp Messages for the incoming messages of a webhook.
+
+    Unlike `create_waba_whatsapp_message`, the number of queries does not grow
+    with the number of messages: the senders are resolved as contacts with at
+    most a single insert, which also saves their profile names, and the
+    messages are inserted with another one. Media to be downloaded
+    automatically is downloaded by a single background job, once the
+    messages are committed, see `download_incoming_media`.
+
+    Every message gets its own `creation`, a microsecond apart in the order
+    of the webhook, so that a burst of messages is listed, and paged, in the
+    order it arrived in, see `get_conversation`.
+
+    Messages that already exist (same message ID) are skipped.
+
+    :param messages: The `messages` of all the changes of a webhook payload.
+    :type messages: List[Dict]
+    :param contacts: The `contacts` of all the changes of a webhook payload.
+    :type contacts: List[Dict]
+    :return: The names of the inserted WABA WhatsApp Messages.
+    :rtype: List[str]
+    """  # noqa
+    if not messages:
+        return []
+
+    with metrics.measure(
+        "waba_webhook_stage_duration_seconds", stage="contacts"
+    ):
+        resolve_waba_whatsapp_contacts(
+            (message.get("from") for message in messages),
+            get_profile_names(contacts),
+            update_display_names=True,
+        )
+
+    received_at = now_datetime()
+    user = frappe.session.user
+    names, values = [], []
+    for position, message in enumerate(messages):
+        message_data = get_incoming_message_data(message)
+        name = frappe.generate_hash(length=10)
+        timestamp = received_at + timedelta(microseconds=position)
+        names.append(name)
+        values.append(
+            (name, timestamp, timestamp, user, user)
+            + tuple(message_data.get(field) for field in INCOMING_MESSAGE_FIELDS)  # noqa
+        )
+
+    frappe.db.bulk_insert(
+        "WABA WhatsApp Message",
+        ("name", "creation", "modified", "owner", "modified_by")
+        + INCOMING_MESSAGE_FIELDS,
+        values,
+        ignore_duplicates=True,
+    )
+
+    # Messages skipped as duplicates are not returned
+    inserted_messages = frappe.get_all(
+        "WABA WhatsApp Message",
+        filters={"name": ("in", names)},
+        order_by="creation asc",
+        fields=[
+            "name",
+            "creation",
+            "modified",
+            "type",
+            "from",
+            "status",
+            "message_type",
+            "message_body",
+            "media_caption",
+        ],
+    )
+    update_inbox_summaries(inserted_messages)
+    publish_message_updates(inserted_messages)
+
+    download_types = get_automatic_download_types()
+    downloads = [
+        message.name
+        for message in inserted_messages
+        if message.message_type in download_types
+    ]
+    if downloads:
+        frappe.enqueue(
+            "waba_integration.whatsapp_business_api_integration.doctype.waba_whatsapp_message.waba_whatsapp_message.download_incoming_media",  # noqa
+            queue="short",
+            enqueue_after_commit=True,
+            messages=downloads,
+        )
+
+    return names
+
+
+def download_incoming_media(messages: List[str]):
+    """
+    Background job that downloads the media of incoming messages.
+
+    :param messages: The names of the WABA WhatsApp Messages.
+    :type messages: List[str]
+    """
+    for name in messages:
+        download_media_as_administrator(
+            frappe.get_doc("WABA WhatsApp Message", name)
+        )
+
+
+def get_incoming_message_data(message: Dict) -> Dict:
+    """
+    Maps an incoming message of a webhook to WABA WhatsApp Message fields.
+
+    :param message: A message from the `messages` of a webhook payload.
+    :type message: Dict
+    :return: The field values of the WABA WhatsApp Message.
+    :rtype: Dict
+    """
+    message_type = message.get("type")
 
     message_data = frappe._dict(
         {
-            "doctype": "WABA WhatsApp Message",
             "type": "Incoming",
             "status": "Received",
             "from": message.get("from"),
@@ -520,32 +729,49 @@ def create_waba_whatsapp_message(message: Dict) -> WABAWhatsAppMessage:
         )  # noqa
         message_data["media_caption"] = message.get("document").get("caption")
 
-    message_doc = frappe.get_doc(message_data).insert(ignore_permissions=True)
+    return message_data
 
-    wants_automatic_image_downloads = frappe.db.get_single_value(
-        "WABA Settings", "automatically_download_images"
-    )
 
-    wants_automatic_audio_downloads = frappe.db.get_single_value(
-        "WABA Settings", "automatically_download_audio"
-    )
-    if (
-        message_doc.message_type == "Image" and wants_automatic_image_downloads
-    ) or (  # noqa
-        message_doc.message_type == "Audio" and wants_automatic_audio_downloads
-    ):
-        try:
-            current_user = frappe.session.user
-            frappe.set_user("Administrator")
-            message_doc.download_media()
-            frappe.set_user(current_user)
-        except Exception:
-            frappe.log_error(
-                f"WABA: Problem downloading {message_doc.message_type}",
-                frappe.get_traceback(),
-            )
+def get_automatic_download_types() -> List[str]:
+    """
+    Returns the message types whose media is downloaded on arrival.
 
-    return message_doc
+    :return: The message types, as configured in WABA Settings.
+    :rtype: List[str]
+    """
+    settings = get_waba_settings()
+
+    download_types = []
+    if settings.automatically_download_images:
+        download_types.append("Image")
+
+    if settings.automatically_download_audio:
+        download_types.append("Audio")
+
+    return download_types
+
+
+def download_media_as_administrator(message_doc: WABAWhatsAppMessage):
+    """
+    Downloads the media of an incoming message on behalf of Administrator.
+
+    Webhooks are received as Guest, who can not create files. Errors are
+    logged instead of raised, the message can still be downloaded manually.
+
+    :param message_doc: The incoming message.
+    :type message_doc: WABAWhatsAppMessage
+    """
+    current_user = frappe.session.user
+    frappe.set_user("Administrator")
+    try:
+        message_doc.download_media()
+    except Exception:
+        frappe.log_error(
+            f"WABA: Problem downloading {message_doc.message_type}",
+            frappe.get_traceback(),
+        )
+    finally:
+        frappe.set_user(current_user)
 
 
 def process_status_update(status: Dict):
@@ -555,12 +781,7 @@ def process_status_update(status: Dict):
     :param status: Status update received from WABA
     :type status: dict
     """  # noqa
-    message_id = status.get("id")
-    status = status.get("status")
-
-    frappe.db.set_value(
-        "WABA WhatsApp Message", {"id": message_id}, "status", status.title()
-    )
+    apply_status_updates([status])
 
 
 def get_media_extention(
@@ -0,0 +1,30 @@
+// Copyright (c) 2026, Hussain Nagaria and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings["WABA WhatsApp Message"] = {
+  onload: function (listview) {
+    frappe.realtime.doctype_subscribe(listview.doctype);
+    frappe.realtime.on("waba_message_updates", (data) => {
+      const rows = {};
+      listview.data.forEach((row) => (rows[row.name] = row));
+
+      // Messages that just arrived or were just created are not listed yet
+      const has_new_messages = data.messages.some(
+        (m) => !rows[m.name] && ["Received", "Pending"].includes(m.status)
+      );
+      if (data.reload || has_new_messages) {
+        listview.refresh();
+        return;
+      }
+
+      const updates = data.messages.filter((m) => rows[m.name]);
+      if (!updates.length) return;
+
+      updates.forEach((m) => {
+        rows[m.name].status = m.status;
+        if (m.modified) rows[m.name].modified = m.modified;
+      });
+      listview.render();
+    });
+  },
+};
@@ -1,9 +1,92 @@
 # Copyright (c) 2024, Hussain Nagaria and Contributors
 # See license.txt
 
-# import frappe
+import dataclasses
+from unittest.mock import Mock, patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from waba_integration.template_sync import sync_message_templates
+from waba_integration.whatsapp_business_api_integration.doctype.waba_settings.waba_settings import (  # noqa
+    get_waba_settings,
+)
 
 
 class TestWABAWhatsAppMessageTemplate(FrappeTestCase):
-	pass
+    def setUp(self):
+        frappe.local.waba_settings = dataclasses.replace(
+            get_waba_settings(), enabled=True, business_account_id="123"
+        )
+        self.templates = [
+            get_template(f"test_{frappe.generate_hash(length=8)}")
+            for _ in range(3)
+        ]
+
+    def tearDown(self):
+        frappe.local.waba_settings = None
+
+    def test_templates_are_synced_page_by_page(self):
+        first_page, second_page = self.templates[:2], self.templates[2:]
+        get = Mock(
+            side_effect=lambda *args, **kwargs: get_response(
+                second_page
+                if kwargs["params"].get("after")
+                else first_page,
+                after=None if kwargs["params"].get("after") else "cursor",
+            )
+        )
+
+        with patch("waba_integration.template_sync.graph_api.get", get):
+            counts = sync_message_templates()
+            self.assertEqual(get.call_count, 2)
+            self.assertEqual(counts.inserted, 3)
+            for template in self.templates:
+                self.assertEqual(
+                    frappe.db.get_value(
+                        "WABA WhatsApp Message Template",
+                        template["name"],
+                        ["template_id", "status", "language_code"],
+                    ),
+                    (template["id"], "Approved", "en_US"),
+                )
+
+            # Unchanged templates are not written again
+            counts = sync_message_templates()
+            self.assertEqual((counts.unchanged, counts.updated), (3, 0))
+
+            # Templates Meta no longer returns are marked as deleted
+            second_page = []
+            sync_message_templates()
+            self.assertEqual(
+                [
+                    frappe.db.get_value(
+                        "WABA WhatsApp Message Template",
+                        template["name"],
+                        "status",
+                    )
+                    for template in self.templates
+                ],
+                ["Approved", "Approved", "Deleted"],
+            )
+
+
+def get_template(name: str) -> dict:
+    return {
+        "id": frappe.generate_hash(length=10),
+        "name": name,
+        "language": "en_US",
+        "status": "APPROVED",
+        "category": "UTILITY",
+        "components": [{"type": "BODY", "text": "Hello"}],
+    }
+
+
+def get_response(templates: list, after: str = None) -> Mock:
+    data = {"data": templates}
+    if after:
+        data["paging"] = {
+            "cursors": {"after": after},
+            "next": "https://graph.facebook.com/next",
+        }
+
+    return Mock(ok=True, json=Mock(return_value=data))
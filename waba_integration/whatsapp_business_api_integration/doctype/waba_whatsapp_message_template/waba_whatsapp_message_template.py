@@ -1,8 +1,148 @@
 # Copyright (c) 2024, Hussain Nagaria and contributors
 # For license information, please see license.txt
 
-# import frappe
+import json
+from typing import Callable, Dict, List, Tuple
+
+import frappe
 from frappe.model.document import Document
+from frappe.utils import cstr, nowdate
+from frappe.utils.safe_exec import get_safe_globals
+from jinja2 import TemplateError, meta
+
+# Per-process compiled components by site and template name, along with the
+# `modified` of the template they were compiled from
+_compiled_components_by_template: Dict[Tuple[str, str], Dict] = {}
+
 
 class WABAWhatsAppMessageTemplate(Document):
-	pass
+    def can_be_sent(self) -> bool:
+        """
+        Whether the template can be sent: approved by Meta, or maintained by
+        hand and never synced from the Business Account.
+        """
+        return not self.status or self.status == "Approved"
+
+    def validate_can_be_sent(self):
+        """
+        Rejects templates Meta would reject, without calling the Graph API.
+
+        :raises frappe.exceptions.ValidationError: If the template is not
+                                                   approved.
+        """  # noqa
+        if not self.can_be_sent():
+            frappe.throw(
+                f"Template {self.name} can not be sent, its status on WhatsApp is {self.status}."  # noqa
+            )
+
+
+def get_message_template(template_name: str) -> WABAWhatsAppMessageTemplate:
+    """
+    Returns a WABA WhatsApp Message Template from the document cache.
+
+    The cache is cleared by Frappe whenever the template is saved.
+
+    :param template_name: The name of the template.
+    :type template_name: str
+    :return: The template.
+    :rtype: WABAWhatsAppMessageTemplate
+    """
+    return frappe.get_cached_doc("WABA WhatsApp Message Template", template_name)  # noqa
+
+
+def render_components(
+    template: WABAWhatsAppMessageTemplate,
+    message: Document = None,
+    get_doc: Callable[[], Document] = None,
+) -> List[Dict]:
+    """
+    Renders the `components` of a template for a message.
+
+    The components are compiled once per version of the template, see
+    `get_compiled_components`, and the context is only built as far as the
+    components use it: the referenced document is only loaded if they use
+    `doc`, and the safe `frappe` globals only if they use `frappe`.
+
+    :param template: The template.
+    :type template: WABAWhatsAppMessageTemplate
+    :param message: The WABA WhatsApp Message, available as `message`.
+    :type message: Document
+    :param get_doc: Returns the referenced document, available as `doc`.
+    :type get_doc: Callable[[], Document]
+    :raises frappe.exceptions.ValidationError: If the components can not be
+                                               rendered.
+    :return: The components, as expected by the `/messages` endpoint.
+    :rtype: List[Dict]
+    """  # noqa
+    compiled = get_compiled_components(template)
+    context = {"doc": None, "message": message, "nowdate": nowdate}
+
+    if get_doc and "doc" in compiled.variables:
+        context["doc"] = get_doc()
+
+    if "frappe" in compiled.variables:
+        context["frappe"] = get_safe_frappe()
+
+    try:
+        return json.loads(compiled.template.render(context))
+    except TemplateError:
+        frappe.throw(
+            title="Error in Template",
+            msg=f"<pre>{frappe.get_traceback()}</pre>",
+        )
+
+
+def get_compiled_components(template: WABAWhatsAppMessageTemplate) -> Dict:
+    """
+    Returns the compiled Jinja template of the `components` of a template.
+
+    Compiled components are kept per process, until the template changes.
+
+    :param template: The template.
+    :type template: WABAWhatsAppMessageTemplate
+    :raises frappe.exceptions.ValidationError: If the components are not a
+                                               valid template.
+    :return: The compiled `template` and the `variables` it uses.
+    :rtype: Dict
+    """  # noqa
+    key = (frappe.local.site, template.name)
+    compiled = _compiled_components_by_template.get(key)
+    if compiled and compiled.modified == cstr(template.modified):
+        return compiled
+
+    source = template.components or "[]"
+    # Same restriction as `frappe.render_template`
+    if ".__" in source:
+        frappe.throw("Illegal template")
+
+    jenv = frappe.get_jenv()
+    try:
+        compiled = frappe._dict(
+            modified=cstr(template.modified),
+            template=jenv.from_string(source),
+            variables=meta.find_undeclared_variables(jenv.parse(source)),
+        )
+    except TemplateError:
+        frappe.throw(
+            title="Error in Template",
+            msg=f"<pre>{frappe.get_traceback()}</pre>",
+        )
+
+    _compiled_components_by_template[key] = compiled
+    return compiled
+
+
+def get_safe_frappe() -> Dict:
+    """
+    Returns the `frappe` namespace of the safe globals, used in templates.
+
+    The safe globals are costly to build, so they are built once per request
+    or job. They are not kept per process, since they include the session.
+
+    :return: The `frappe` namespace.
+    :rtype: Dict
+    """
+    if not getattr(frappe.local, "waba_safe_frappe", None):
+        frappe.local.waba_safe_frappe = get_safe_globals().get("frappe")
+
+    return frappe.local.waba_safe_frappe
@@ -0,0 +1,28 @@
+// Copyright (c) 2026, Hussain Nagaria and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings["WABA WhatsApp Message Template"] = {
+  get_indicator: function (doc) {
+    if (!doc.status) return;
+    const colors = { Approved: "green", Pending: "orange", Rejected: "red" };
+    return [
+      __(doc.status),
+      colors[doc.status] || "gray",
+      `status,=,${doc.status}`,
+    ];
+  },
+  onload: function (listview) {
+    if (!frappe.user.has_role("System Manager")) return;
+
+    listview.page.add_inner_button(__("Sync from WhatsApp"), () => {
+      frappe
+        .call("waba_integration.template_sync.enqueue_template_sync")
+        .then(() =>
+          frappe.show_alert({
+            message: __("Templates are being synced, refresh in a moment"),
+            indicator: "blue",
+          })
+        );
+    });
+  },
+};